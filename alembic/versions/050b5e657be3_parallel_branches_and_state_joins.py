@@ -0,0 +1,51 @@
+"""Parallel branches and state joins
+
+Revision ID: 050b5e657be3
+Revises: b3c686725265
+Create Date: 2026-10-17 10:12:41.318204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '050b5e657be3'
+down_revision: Union[str, None] = 'b3c686725265'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Parallel 分支执行: 父执行与分支路径
+    op.add_column('workflow_executions', sa.Column('parent_run_id', sa.String(36), nullable=True))
+    op.add_column('workflow_executions', sa.Column('branch_path', sa.String(1024), nullable=True))
+    op.create_index('idx_wf_parent', 'workflow_executions', ['parent_run_id'])
+
+    # 创建 state_joins 表
+    op.create_table(
+        'state_joins',
+        sa.Column('join_id', sa.String(36), primary_key=True),
+        sa.Column('run_id', sa.String(36), sa.ForeignKey('workflow_executions.run_id'), nullable=False),
+        sa.Column('shard_id', sa.Integer(), nullable=False),
+        sa.Column('state_name', sa.String(255), nullable=False),
+        sa.Column('children', sa.Text(), nullable=True),
+        sa.Column('total', sa.Integer(), nullable=False),
+        sa.Column('completed', sa.Integer(), nullable=False, server_default=sa.text("0")),
+        sa.Column('status', sa.String(50), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False, server_default=sa.text("CURRENT_TIMESTAMP"))
+    )
+    op.create_index('idx_state_joins_run', 'state_joins', ['run_id', 'state_name'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('idx_state_joins_run', table_name='state_joins')
+    op.drop_table('state_joins')
+    op.drop_index('idx_wf_parent', table_name='workflow_executions')
+    with op.batch_alter_table('workflow_executions') as batch_op:
+        batch_op.drop_column('branch_path')
+        batch_op.drop_column('parent_run_id')
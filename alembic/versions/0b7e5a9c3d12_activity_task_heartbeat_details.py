@@ -0,0 +1,30 @@
+"""Activity task heartbeat details
+
+Revision ID: 0b7e5a9c3d12
+Revises: f2d83c61b7a4
+Create Date: 2026-10-17 18:57:16.208351
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0b7e5a9c3d12'
+down_revision: Union[str, None] = 'f2d83c61b7a4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # 心跳携带的进度信息 (之前的 heartbeat_details 只是实例属性, 从未落库)
+    op.add_column('activity_tasks', sa.Column('heartbeat_details', sa.Text(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table('activity_tasks') as batch_op:
+        batch_op.drop_column('heartbeat_details')
@@ -0,0 +1,32 @@
+"""Activity task claim lease
+
+Revision ID: 3f8d2b6c1e47
+Revises: 7c2e41d9a8f3
+Create Date: 2026-10-17 15:21:37.118230
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f8d2b6c1e47'
+down_revision: Union[str, None] = '7c2e41d9a8f3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # 任务认领: worker 标识与租约到期时间
+    op.add_column('activity_tasks', sa.Column('worker_id', sa.String(255), nullable=True))
+    op.add_column('activity_tasks', sa.Column('lease_expiry', sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table('activity_tasks') as batch_op:
+        batch_op.drop_column('lease_expiry')
+        batch_op.drop_column('worker_id')
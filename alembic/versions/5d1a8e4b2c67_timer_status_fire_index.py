@@ -0,0 +1,29 @@
+"""Timer status fire index
+
+Revision ID: 5d1a8e4b2c67
+Revises: 0b7e5a9c3d12
+Create Date: 2026-10-17 19:34:52.670193
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5d1a8e4b2c67'
+down_revision: Union[str, None] = '0b7e5a9c3d12'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # 定时器 worker: WHERE status = 'scheduled' AND fire_at <= :until ORDER BY fire_at
+    op.create_index('idx_timers_status_fire', 'timers', ['status', 'fire_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('idx_timers_status_fire', table_name='timers')
@@ -0,0 +1,32 @@
+"""Map state cursor on state joins
+
+Revision ID: 7c2e41d9a8f3
+Revises: 050b5e657be3
+Create Date: 2026-10-17 14:05:12.904417
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7c2e41d9a8f3'
+down_revision: Union[str, None] = '050b5e657be3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Map 状态: 元素任务起始 seq 与派发游标
+    op.add_column('state_joins', sa.Column('base_seq', sa.Integer(), nullable=True))
+    op.add_column('state_joins', sa.Column('next_index', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table('state_joins') as batch_op:
+        batch_op.drop_column('next_index')
+        batch_op.drop_column('base_seq')
@@ -66,7 +66,7 @@ def upgrade() -> None:
         sa.Column('attributes', sa.Text(), nullable=True),
         sa.Column('attr_version', sa.Integer(), nullable=False, server_default=sa.text("1")),
         sa.Column('timestamp', sa.DateTime(), nullable=False, server_default=sa.text("CURRENT_TIMESTAMP")),
-        sa.Column('archived', sa.Boolean(), nullable=False, server_default=sa.text("0"))
+        sa.Column('archived', sa.Boolean(), nullable=False, server_default=sa.false())
     )
     op.create_index('idx_wf_events', 'workflow_events', ['run_id', 'event_id'])
     op.create_index('idx_wf_events_shard', 'workflow_events', ['shard_id', 'run_id', 'event_id'])
@@ -0,0 +1,48 @@
+"""Shard leases
+
+Revision ID: 9c3f1e7a5b48
+Revises: 5d1a8e4b2c67
+Create Date: 2026-10-17 20:41:08.315927
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9c3f1e7a5b48'
+down_revision: Union[str, None] = '5d1a8e4b2c67'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # 创建 shard_leases 表: 每个分片一行, 记录持有者与租约
+    op.create_table(
+        'shard_leases',
+        sa.Column('shard_id', sa.Integer(), primary_key=True),
+        sa.Column('owner', sa.String(255), nullable=True),
+        sa.Column('lease_expiry', sa.DateTime(), nullable=True),
+        sa.Column('version', sa.Integer(), nullable=False, server_default=sa.text("1"))
+    )
+    # 创建 shard_members 表: 存活的 worker
+    op.create_table(
+        'shard_members',
+        sa.Column('member_id', sa.String(255), primary_key=True),
+        sa.Column('heartbeat_at', sa.DateTime(), nullable=False),
+        sa.Column('lease_expiry', sa.DateTime(), nullable=False)
+    )
+    # 按分片认领任务与扫描定时器
+    op.create_index('idx_activity_shard_status', 'activity_tasks', ['shard_id', 'status', 'scheduled_at'], unique=False)
+    op.create_index('idx_timers_shard_status_fire', 'timers', ['shard_id', 'status', 'fire_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('idx_timers_shard_status_fire', table_name='timers')
+    op.drop_index('idx_activity_shard_status', table_name='activity_tasks')
+    op.drop_table('shard_members')
+    op.drop_table('shard_leases')
@@ -0,0 +1,45 @@
+"""Template DSL digest
+
+Revision ID: a7d4c9e2f156
+Revises: 9c3f1e7a5b48
+Create Date: 2026-10-17 22:15:37.402816
+
+"""
+import hashlib
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a7d4c9e2f156'
+down_revision: Union[str, None] = '9c3f1e7a5b48'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # 模板缓存的键: (template_id, version, dsl_digest)
+    op.add_column('workflow_templates', sa.Column('dsl_digest', sa.String(32), nullable=True))
+
+    # 为已有模板补上摘要
+    templates = sa.table(
+        'workflow_templates',
+        sa.column('template_id', sa.String),
+        sa.column('dsl_definition', sa.Text),
+        sa.column('dsl_digest', sa.String),
+    )
+    conn = op.get_bind()
+    rows = conn.execute(sa.select(templates.c.template_id, templates.c.dsl_definition)).all()
+    for template_id, dsl_definition in rows:
+        digest = hashlib.blake2b(dsl_definition.encode("utf-8"), digest_size=16).hexdigest()
+        conn.execute(
+            templates.update().where(templates.c.template_id == template_id).values(dsl_digest=digest)
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('workflow_templates', 'dsl_digest')
@@ -0,0 +1,33 @@
+"""Timer types for activity retry
+
+Revision ID: c41f7a2d8e35
+Revises: 8a4e5c2f9b10
+Create Date: 2026-10-17 17:12:48.306615
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c41f7a2d8e35'
+down_revision: Union[str, None] = '8a4e5c2f9b10'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # 定时器用途: 已有的定时器都是推进工作流的定时器
+    op.add_column('timers', sa.Column('timer_type', sa.String(50), nullable=False, server_default=sa.text("'workflow'")))
+    # activity_retry 定时器要重新调度的活动任务
+    op.add_column('timers', sa.Column('task_token', sa.String(36), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table('timers') as batch_op:
+        batch_op.drop_column('task_token')
+        batch_op.drop_column('timer_type')
@@ -0,0 +1,30 @@
+"""Activity task error type
+
+Revision ID: e6b09d3a4f21
+Revises: c41f7a2d8e35
+Create Date: 2026-10-17 17:48:05.912734
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e6b09d3a4f21'
+down_revision: Union[str, None] = 'c41f7a2d8e35'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # 失败的错误名 (例如 Http.ServerError, States.Timeout), 为空时按 States.TaskFailed 处理
+    op.add_column('activity_tasks', sa.Column('error_type', sa.String(255), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table('activity_tasks') as batch_op:
+        batch_op.drop_column('error_type')
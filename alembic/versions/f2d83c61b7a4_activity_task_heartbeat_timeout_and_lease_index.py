@@ -0,0 +1,32 @@
+"""Activity task heartbeat timeout and lease index
+
+Revision ID: f2d83c61b7a4
+Revises: e6b09d3a4f21
+Create Date: 2026-10-17 18:21:39.447102
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f2d83c61b7a4'
+down_revision: Union[str, None] = 'e6b09d3a4f21'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('activity_tasks', sa.Column('heartbeat_seconds', sa.Integer(), nullable=True))
+    # 回收器: WHERE status = 'running' AND lease_expiry <= now ORDER BY lease_expiry
+    op.create_index('idx_activity_status_lease', 'activity_tasks', ['status', 'lease_expiry'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('idx_activity_status_lease', table_name='activity_tasks')
+    with op.batch_alter_table('activity_tasks') as batch_op:
+        batch_op.drop_column('heartbeat_seconds')
@@ -2,10 +2,12 @@
 
 import uuid
 from datetime import datetime, UTC
-from typing import Optional, List
+from typing import Optional, List, Collection
 from stepflow.infrastructure.models import ActivityTask
-from stepflow.infrastructure.repositories.activity_task_repository import ActivityTaskRepository
+from stepflow.infrastructure.repositories.activity_task_repository import ActivityTaskRepository, lease_deadline
 from stepflow.interfaces.websocket.connection_manager import manager
+from stepflow.infrastructure.dispatch_notifier import dispatch_notifier, ACTIVITY_CHANNEL
+from stepflow.infrastructure.heartbeat_buffer import heartbeat_buffer
 
 class ActivityTaskService:
     def __init__(self, repo: ActivityTaskRepository):
@@ -22,7 +24,9 @@ class ActivityTaskService:
             input=input_data,
             scheduled_at=datetime.now(UTC)
         )
-        return await self.repo.create(task)
+        task = await self.repo.create(task)
+        dispatch_notifier.notify(ACTIVITY_CHANNEL)
+        return task
 
     async def get_task(self, task_token: str) -> Optional[ActivityTask]:
         """获取活动任务"""
@@ -32,57 +36,177 @@ class ActivityTaskService:
         """获取特定工作流执行的所有活动任务"""
         return await self.repo.get_by_run_id(run_id)
 
-    async def get_scheduled_tasks(self, limit: int = 10) -> List[ActivityTask]:
-        """获取待处理的任务"""
-        return await self.repo.get_by_status("scheduled", limit)
+    async def claim_tasks(
+        self,
+        worker_id: str,
+        limit: int = 10,
+        lease_seconds: int = 300,
+        shard_ids: Optional[Collection[int]] = None
+    ) -> List[ActivityTask]:
+        """原子地认领一批待处理任务, 同一任务只会被一个 worker 认领 (shard_ids 限定认领的分片)"""
+        return await self.repo.claim_scheduled(worker_id, limit, lease_seconds, shard_ids)
 
-    async def mark_tasks_as_running(self, task_tokens: List[str]) -> None:
-        """标记任务为运行中"""
-        for token in task_tokens:
-            await self.repo.update_status(token, "running")
+    async def release_tasks(self, worker_id: str, task_tokens: List[str]) -> int:
+        """把 worker 已认领但尚未执行的任务交还, 返回交还的数量"""
+        return await self.repo.release_claimed(worker_id, task_tokens)
 
-    async def start_task(self, task_token: str) -> None:
+    async def list_expired_tasks(
+        self,
+        now: datetime,
+        limit: int = 100,
+        shard_ids: Optional[Collection[int]] = None
+    ) -> List[ActivityTask]:
+        """租约已到期的 running 任务 (worker 失联或任务超时)"""
+        return await self.repo.list_expired(now, limit, shard_ids)
+
+    async def requeue_expired_tasks(self, task_tokens: List[str], now: datetime) -> int:
+        """把 worker 失联的任务重新放回队列, 返回实际恢复的数量"""
+        return await self.repo.requeue_expired(task_tokens, now)
+
+    async def take_over_expired_tasks(
+        self,
+        task_tokens: List[str],
+        owner: str,
+        now: datetime,
+        lease_seconds: int = 300
+    ) -> List[ActivityTask]:
+        """接管超时的任务, 由接管者按失败处理"""
+        return await self.repo.take_over_expired(task_tokens, owner, now, lease_seconds)
+
+    async def _finish(self, task: ActivityTask, commit: bool) -> ActivityTask:
+        # commit=False 时只登记修改, 由调用方 (例如 advance_workflow) 在同一事务中提交
+        if commit:
+            return await self.repo.save(task)
+        return self.repo.stage(task)
+
+    async def start_task(self, task_token: str, commit: bool = True) -> ActivityTask:
         """标记任务为开始执行"""
         task = await self.repo.get_by_token(task_token)
         if not task:
             raise ValueError(f"Task with token {task_token} not found")
         
+        task.status = "running"
         task.started_at = datetime.now(UTC)
-        await self.repo.save(task)
+        return await self._finish(task, commit)
+
+    async def _finish_result(
+        self,
+        task_token: str,
+        owner: Optional[ActivityTask],
+        commit: bool,
+        **values
+    ) -> Optional[ActivityTask]:
+        """
+        写入任务结果. owner 为 worker 认领时拿到的任务时, 用条件 UPDATE 确认任务仍由它持有,
+        已被回收器接管或重新排队时不写入并返回 None
+        """
+        if owner is not None:
+            task = await self.repo.finish_if_owned(task_token, owner.worker_id, values)
+            if task is None:
+                return None
+            if commit:
+                await self.repo.db.commit()
+        else:
+            task = await self.repo.get_by_token(task_token)
+            if not task:
+                raise ValueError(f"Task with token {task_token} not found")
+            for key, value in values.items():
+                setattr(task, key, value)
+            task = await self._finish(task, commit)
+        if not commit and task.status in ("completed", "failed"):
+            # 由同一事务中的推进消费: Map 按本次结束的元素任务原子地累加汇合计数
+            self.repo.db.info.setdefault("finished_tasks", []).append((task.run_id, task.seq, task.status))
+        return task
 
-    async def complete_task(self, task_token: str, result_data: str) -> None:
+    async def complete_task(
+        self,
+        task_token: str,
+        result_data: str,
+        commit: bool = True,
+        owner: Optional[ActivityTask] = None
+    ) -> Optional[ActivityTask]:
         """标记任务为完成"""
-        task = await self.repo.get_by_token(task_token)
-        if not task:
-            raise ValueError(f"Task with token {task_token} not found")
-        
-        task.status = "completed"
-        task.completed_at = datetime.now(UTC)
-        task.result = result_data
-        await self.repo.save(task)
+        return await self._finish_result(
+            task_token, owner, commit,
+            status="completed",
+            completed_at=datetime.now(UTC),
+            result=result_data
+        )
 
-    async def fail_task(self, task_token: str, reason: str, details: str = None) -> None:
-        """标记任务为失败"""
-        task = await self.repo.get_by_token(task_token)
-        if not task:
-            raise ValueError(f"Task with token {task_token} not found")
-        
-        task.status = "failed"
-        task.completed_at = datetime.now(UTC)
-        task.error = reason  # 确保错误原因被保存
-        task.error_details = details  # 确保错误详情被保存
-        await self.repo.save(task)
+    async def fail_task(
+        self,
+        task_token: str,
+        reason: str,
+        details: str = None,
+        commit: bool = True,
+        error_type: Optional[str] = None,
+        owner: Optional[ActivityTask] = None
+    ) -> Optional[ActivityTask]:
+        """标记任务为失败, error_type 为匹配 Catch 的错误名 (为空时按 States.TaskFailed 处理)"""
+        return await self._finish_result(
+            task_token, owner, commit,
+            status="failed",
+            completed_at=datetime.now(UTC),
+            error=reason,
+            error_type=error_type,
+            error_details=details
+        )
 
-    async def heartbeat_task(self, task_token: str, details: Optional[str] = None) -> Optional[ActivityTask]:
-        """更新活动任务心跳"""
+    async def retry_task(
+        self,
+        task_token: str,
+        reason: str,
+        details: str = None,
+        commit: bool = True,
+        error_type: Optional[str] = None,
+        owner: Optional[ActivityTask] = None
+    ) -> Optional[ActivityTask]:
+        """
+        任务失败但还可以重试: 记录本次失败并释放认领, 状态改为 retrying,
+        等待 activity_retry 定时器到期后由 reschedule_tasks 重新调度
+        """
+        return await self._finish_result(
+            task_token, owner, commit,
+            status="retrying",
+            completed_at=datetime.now(UTC),
+            error=reason,
+            error_type=error_type,
+            error_details=details,
+            worker_id=None,
+            lease_expiry=None
+        )
+
+    async def reschedule_tasks(self, task_tokens: List[str], commit: bool = True) -> int:
+        """
+        批量重新调度等待重试的任务 (attempt + 1), 返回重新调度的数量;
+        commit=False 时与定时器的触发一起提交
+        """
+        count = await self.repo.reschedule_retrying(task_tokens, datetime.now(UTC))
+        if commit:
+            await self.repo.db.commit()
+        return count
+
+    async def heartbeat_task(
+        self,
+        task_token: str,
+        details: Optional[str] = None,
+        lease_seconds: int = 300
+    ) -> Optional[ActivityTask]:
+        """
+        记录活动任务心跳并续租: 心跳先进入进程内的缓冲,
+        同一任务的多次心跳合并后由 heartbeat_buffer 定期批量写入
+        """
         task = await self.repo.get_by_token(task_token)
         if not task or task.status != "running":
             return None
         
-        task.last_heartbeat_at = datetime.now(UTC)
-        if details:
-            task.heartbeat_details = details
-        return await self.repo.update(task)
+        now = datetime.now(UTC)
+        # 心跳续租: 下一次心跳 (或执行超时) 之前不会被回收
+        heartbeat_buffer.record(
+            task_token, task.worker_id, now, lease_deadline(task, now, lease_seconds), details,
+            current_expiry=task.lease_expiry
+        )
+        return task
 
     async def cancel_task(self, task_token: str) -> Optional[ActivityTask]:
         """取消一个活动任务"""
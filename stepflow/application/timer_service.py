@@ -5,14 +5,24 @@ from datetime import datetime
 from typing import Optional, List
 from stepflow.infrastructure.models import Timer
 from stepflow.infrastructure.repositories.timer_repository import TimerRepository
+from stepflow.infrastructure.dispatch_notifier import dispatch_notifier, TIMER_CHANNEL
 
 class TimerService:
     def __init__(self, repo: TimerRepository):
         self.repo = repo
 
-    async def schedule_timer(self, run_id: str, shard_id: int, fire_at: datetime) -> Timer:
+    async def schedule_timer(
+        self,
+        run_id: str,
+        shard_id: int,
+        fire_at: datetime,
+        timer_type: str = "workflow",
+        task_token: Optional[str] = None,
+        commit: bool = True
+    ) -> Timer:
         """
-        创建一个新的定时器, 初始状态 scheduled
+        创建一个新的定时器, 初始状态 scheduled.
+        commit=False 时只登记到会话中, 由调用方提交后再通知 TIMER_CHANNEL
         """
         timer_id = str(uuid.uuid4())
         t = Timer(
@@ -21,8 +31,14 @@ class TimerService:
             shard_id=shard_id,
             fire_at=fire_at,
             status="scheduled",
+            timer_type=timer_type,
+            task_token=task_token,
         )
-        return await self.repo.create(t)
+        if not commit:
+            return self.repo.stage(t)
+        t = await self.repo.create(t)
+        dispatch_notifier.notify(TIMER_CHANNEL)
+        return t
 
     async def cancel_timer(self, timer_id: str) -> bool:
         """
@@ -37,10 +53,10 @@ class TimerService:
         await self.repo.update(t)
         return True
 
-    async def fire_timer(self, timer_id: str) -> bool:
+    async def fire_timer(self, timer_id: str, commit: bool = True) -> bool:
         """
         将定时器标记为 fired
-        (在外部调用时, 可能还要触发 workflow logic)
+        (在外部调用时, 可能还要触发 workflow logic; commit=False 时与其一起提交)
         """
         t = await self.repo.get_by_id(timer_id)
         if not t:
@@ -48,9 +64,20 @@ class TimerService:
         if t.status != "scheduled":
             return False
         t.status = "fired"
-        await self.repo.update(t)
+        if commit:
+            await self.repo.update(t)
         return True
 
+    async def fire_timers(self, timer_ids: List[str], commit: bool = True) -> List[str]:
+        """
+        批量触发定时器, 返回实际标记为 fired 的 timer_id
+        (commit=False 时与调用方的其他修改一起提交)
+        """
+        fired = await self.repo.mark_fired(timer_ids)
+        if commit:
+            await self.repo.db.commit()
+        return fired
+
     async def delete_timer(self, timer_id: str) -> bool:
         """
         物理删除, 如果不想物理删, 也可以只更新 status
@@ -1,12 +1,13 @@
 # stepflow/application/workflow_execution_service.py
 
 import uuid
-import json
 from datetime import datetime, UTC
 from typing import Optional, List, Dict
 from stepflow.infrastructure.models import WorkflowExecution
 from stepflow.infrastructure.repositories.workflow_execution_repository import WorkflowExecutionRepository
 from stepflow.interfaces.websocket.connection_manager import manager
+from stepflow.infrastructure import codec
+from stepflow.infrastructure.sharding import shard_for
 
 class WorkflowExecutionService:
     def __init__(self, repo: WorkflowExecutionRepository):
@@ -16,20 +17,23 @@ class WorkflowExecutionService:
         self,
         template_id: str,
         workflow_id: Optional[str] = None,
-        shard_id: int = 1,
+        shard_id: Optional[int] = None,
         workflow_type: str = "DefaultFlow",
         initial_input: Optional[Dict] = None
     ) -> WorkflowExecution:
         """
-        启动一个新的工作流执行, 并返回该记录
+        启动一个新的工作流执行, 并返回该记录.
+        未指定 shard_id 时按 run_id 的哈希分配分片
         """
         run_id = str(uuid.uuid4())
+        if shard_id is None:
+            shard_id = shard_for(run_id)
 
         if not workflow_id:
             workflow_id = f"wf-{uuid.uuid4()}"  # 或自行指定
 
         # 如果 initial_input 是 dict，就转成 JSON字符串以存储
-        input_str = json.dumps(initial_input) if initial_input else None
+        input_str = codec.dumps(initial_input) if initial_input else None
 
         wf_exec = WorkflowExecution(
             run_id=run_id,
@@ -5,6 +5,7 @@ from datetime import datetime
 from typing import Optional, List
 from stepflow.infrastructure.models import WorkflowTemplate
 from stepflow.infrastructure.repositories.workflow_template_repository import WorkflowTemplateRepository
+from stepflow.domain.engine.template_cache import template_cache
 
 class WorkflowTemplateService:
     def __init__(self, repo: WorkflowTemplateRepository):
@@ -15,6 +16,8 @@ class WorkflowTemplateService:
         """
         创建新的工作流模板
         """
+        # 同一 template_id 可能在删除后被重新创建, 丢弃旧的编译结果
+        template_cache.invalidate(template.template_id)
         return await self.repo.create(template)
 
     async def get_template(self, template_id: str) -> Optional[WorkflowTemplate]:
@@ -25,15 +28,19 @@ class WorkflowTemplateService:
 
     async def update_template(self, template: WorkflowTemplate) -> WorkflowTemplate:
         """
-        更新工作流模板
+        更新工作流模板 (调用方修改 dsl_definition 时应同时递增 version)
         """
-        return await self.repo.update(template)
+        updated = await self.repo.update(template)
+        template_cache.invalidate(template.template_id)
+        return updated
 
     async def delete_template(self, template_id: str) -> bool:
         """
         删除工作流模板
         """
-        return await self.repo.delete(template_id)
+        deleted = await self.repo.delete(template_id)
+        template_cache.invalidate(template_id)
+        return deleted
 
     async def list_templates(self) -> List[WorkflowTemplate]:
         """
@@ -52,4 +52,13 @@ class WorkflowVisibilityService:
         return await self.repo.delete(run_id)
 
     async def list_vis_by_status(self, status: str) -> List[WorkflowVisibility]:
-        return await self.repo.list_by_status(status)
\ No newline at end of file
+        return await self.repo.list_by_status(status)
+
+    async def list_by_status(self, status: str, offset: int = 0, limit: Optional[int] = None) -> List[WorkflowVisibility]:
+        return await self.repo.list_by_status(status, offset, limit)
+
+    async def list_by_workflow_type(self, workflow_type: str, offset: int = 0, limit: Optional[int] = None) -> List[WorkflowVisibility]:
+        return await self.repo.list_by_workflow_type(workflow_type, offset, limit)
+
+    async def list_all(self, offset: int = 0, limit: Optional[int] = None) -> List[WorkflowVisibility]:
+        return await self.repo.list_all(offset, limit)
@@ -1,7 +1,7 @@
 # stepflow/domain/dsl_model.py
 from typing import Dict, List, Optional, Union, Any
 from pydantic import BaseModel, Field
-from typing_extensions import Literal
+from typing_extensions import Annotated, Literal
 
 #
 # 1. Retry & Catch
@@ -15,6 +15,7 @@ class RetryPolicy(BaseModel):
 class CatchDefinition(BaseModel):
     ErrorEquals: List[str]
     Next: str
+    ResultPath: Optional[str] = "$"  # 错误对象 {"Error", "Cause"} 写入上下文的位置
 
 #
 # 2. 各种状态类型
@@ -31,7 +32,7 @@ class StateBase(BaseModel):
 
 class TaskState(StateBase):
     """任务状态"""
-    Type: str = "Task"
+    Type: Literal["Task"] = "Task"
     Resource: Optional[str] = None
     ActivityType: Optional[str] = None  # 自定义字段，指定活动类型
     Parameters: Optional[Dict[str, Any]] = None  # 添加 Parameters 属性
@@ -48,13 +49,13 @@ class ChoiceRule(BaseModel):
 
 class ChoiceState(StateBase):
     """选择状态"""
-    Type: str = "Choice"
+    Type: Literal["Choice"] = "Choice"
     Choices: List[Dict[str, Any]]
     Default: Optional[str] = None
 
 class WaitState(StateBase):
     """等待状态"""
-    Type: str = "Wait"
+    Type: Literal["Wait"] = "Wait"
     Seconds: Optional[int] = None
     SecondsPath: Optional[str] = None
     Timestamp: Optional[str] = None
@@ -62,30 +63,40 @@ class WaitState(StateBase):
 
 class PassState(StateBase):
     """传递状态"""
-    Type: str = "Pass"
+    Type: Literal["Pass"] = "Pass"
     Result: Optional[Any] = None
     ResultPath: Optional[str] = None
 
 class ParallelBranch(BaseModel):
+    """并行分支, 结构与顶层工作流相同"""
     StartAt: str
-    States: Dict[str, Union["TaskState", "ChoiceState", "WaitState", "ParallelState", "PassState", "FailState", "SucceedState"]]
+    States: Dict[str, "StateUnion"]
 
 class ParallelState(StateBase):
     """并行状态"""
-    Type: str = "Parallel"
-    Branches: List[Dict[str, Any]]
+    Type: Literal["Parallel"] = "Parallel"
+    Branches: List[ParallelBranch]
+    Retry: Optional[List[Dict[str, Any]]] = None
+    Catch: Optional[List[Dict[str, Any]]] = None
+
+class MapState(StateBase):
+    """映射状态: 对 ItemsPath 指向的数组中每个元素执行 Iterator"""
+    Type: Literal["Map"] = "Map"
+    ItemsPath: Optional[str] = None
+    Iterator: ParallelBranch
+    MaxConcurrency: int = 0  # 0 表示使用引擎默认窗口
     Retry: Optional[List[Dict[str, Any]]] = None
     Catch: Optional[List[Dict[str, Any]]] = None
 
 class FailState(StateBase):
     """失败状态"""
-    Type: str = "Fail"
+    Type: Literal["Fail"] = "Fail"
     Error: Optional[str] = None
     Cause: Optional[str] = None
 
 class SucceedState(StateBase):
     """成功状态"""
-    Type: str = "Succeed"
+    Type: Literal["Succeed"] = "Succeed"
 
 # 处理嵌套引用 (Parallel Branch)
 from typing import TYPE_CHECKING
@@ -94,21 +105,31 @@ if TYPE_CHECKING:
     ChoiceState.model_rebuild()
     WaitState.model_rebuild()
     ParallelState.model_rebuild()
+    MapState.model_rebuild()
     PassState.model_rebuild()
     FailState.model_rebuild()
     SucceedState.model_rebuild()
 
-# 大 Union
-StateUnion = Union[
-    TaskState, 
-    ChoiceState, 
-    WaitState, 
-    ParallelState, 
-    PassState, 
-    FailState, 
-    SucceedState
+# 大 Union, 按 Type 字段区分具体状态类型
+StateUnion = Annotated[
+    Union[
+        TaskState, 
+        ChoiceState, 
+        WaitState, 
+        ParallelState, 
+        MapState,
+        PassState, 
+        FailState, 
+        SucceedState
+    ],
+    Field(discriminator="Type"),
 ]
 
+# 分支内的 States 引用了 StateUnion, 需要在其定义之后重建
+ParallelBranch.model_rebuild()
+ParallelState.model_rebuild()
+MapState.model_rebuild()
+
 #
 # 3. 顶层 WorkflowDSL
 #
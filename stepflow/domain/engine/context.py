@@ -0,0 +1,172 @@
+# stepflow/domain/engine/context.py
+# 工作流上下文 (memo) 的写时复制封装: 每次推进只解码一次,
+# 记录被修改的顶层键, 序列化时只重新编码脏的子树
+
+import copy
+import json
+import os
+import re
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Set, Tuple, Union
+
+from stepflow.domain.engine.path_utils import as_path
+from stepflow.infrastructure import codec
+
+# 进程内缓存的已解码上下文数量
+CONTEXT_CACHE_SIZE = int(os.environ.get("STEPFLOW_CONTEXT_CACHE_SIZE", "256"))
+
+# 扫描顶层键需要 raw_decode 定位每个值的边界, 只有标准库解码器提供
+_decoder = json.JSONDecoder()
+_WS = re.compile(r"[ \t\n\r]*")
+
+def _scan_object(text: str) -> Optional[Tuple[Dict[str, Any], Dict[str, str]]]:
+    """
+    解码顶层 JSON 对象, 同时记录每个顶层键对应的原始文本片段,
+    这样未修改的键在重新序列化时无需再次编码. 不是对象时返回 None
+    """
+    idx = _WS.match(text, 0).end()
+    if text[idx:idx + 1] != "{":
+        return None
+    idx = _WS.match(text, idx + 1).end()
+    data: Dict[str, Any] = {}
+    fragments: Dict[str, str] = {}
+    if text[idx:idx + 1] == "}":
+        return data, fragments
+    while True:
+        key, idx = _decoder.raw_decode(text, idx)
+        idx = _WS.match(text, idx).end()
+        if text[idx:idx + 1] != ":":
+            raise ValueError(f"Expecting ':' at position {idx}")
+        idx = _WS.match(text, idx + 1).end()
+        value, end = _decoder.raw_decode(text, idx)
+        data[key] = value
+        fragments[key] = text[idx:end]
+        idx = _WS.match(text, end).end()
+        if text[idx:idx + 1] == "}":
+            return data, fragments
+        if text[idx:idx + 1] != ",":
+            raise ValueError(f"Expecting ',' at position {idx}")
+        idx = _WS.match(text, idx + 1).end()
+
+class WorkflowContext:
+    """
+    已解码的工作流上下文.
+
+    - 读取 (get) 直接返回内部对象, 调用方不得原地修改
+    - 写入 (set/replace) 前会先深拷贝被修改的顶层子树, 与 fork 出来的其他上下文互不影响
+    - dumps 复用未修改顶层键的已编码片段, 只重新编码脏键
+    """
+
+    __slots__ = ("data", "memo", "_fragments", "_dirty", "_owned")
+
+    def __init__(self, data: Dict[str, Any], memo: Optional[str] = None, fragments: Optional[Dict[str, str]] = None):
+        self.data = data
+        # 与 data 对应的序列化文本 (wf_exec.memo), 修改后在 dumps 时更新
+        self.memo = memo
+        self._fragments: Dict[str, str] = fragments if fragments is not None else {}
+        self._dirty: Set[str] = set()
+        self._owned: Set[str] = set()
+
+    @classmethod
+    def loads(cls, memo: Optional[str]) -> "WorkflowContext":
+        if not memo:
+            return cls({}, memo)
+        scanned = _scan_object(memo)
+        if scanned is not None:
+            data, fragments = scanned
+            return cls(data, memo, fragments)
+        data = codec.loads(memo)
+        return cls(data if isinstance(data, dict) else {"value": data}, memo)
+
+    def fork(self) -> "WorkflowContext":
+        """浅复制出一个新上下文, 共享未修改的子树与已编码片段"""
+        return WorkflowContext(dict(self.data), self.memo, dict(self._fragments))
+
+    def get(self, path: Union[str, Tuple, None]) -> Any:
+        """按路径读取 (只读)"""
+        return as_path(path).get(self.data)
+
+    def set(self, path: Union[str, Tuple, None], value: Any) -> None:
+        """按路径写入, "$" 表示替换整个上下文"""
+        path = as_path(path)
+        if not path:
+            self.replace(value)
+            return
+        key = path[0]
+        if key in self.data and key not in self._owned:
+            # 写时复制: 只复制被修改的顶层子树
+            self.data[key] = copy.deepcopy(self.data[key])
+        self._owned.add(key)
+        path.set(self.data, value)
+        self._mark_dirty(key)
+
+    def replace(self, value: Any) -> None:
+        """用新的根对象替换整个上下文 (例如 OutputPath 或 ResultPath 为 "$")"""
+        root = dict(value) if isinstance(value, dict) else {"value": value}
+        self.data = root
+        self._fragments = {}
+        self._owned = set()
+        self._dirty = set(root)
+        self.memo = None
+
+    def _mark_dirty(self, key: str) -> None:
+        self._dirty.add(key)
+        self._fragments.pop(key, None)
+        self.memo = None
+
+    @property
+    def dirty_keys(self) -> Set[str]:
+        return set(self._dirty)
+
+    def dumps(self) -> str:
+        """序列化为 JSON 文本, 未修改的顶层键直接复用已编码片段"""
+        if self.memo is not None and not self._dirty:
+            return self.memo
+        parts = []
+        for key, value in self.data.items():
+            fragment = self._fragments.get(key)
+            if fragment is None:
+                fragment = codec.dumps(value)
+                self._fragments[key] = fragment
+            parts.append(f"{codec.dumps(key)}:{fragment}")
+        self.memo = "{" + ",".join(parts) + "}"
+        self._dirty.clear()
+        return self.memo
+
+class ContextCache:
+    """
+    进程内按 run_id 缓存最近提交的上下文 (LRU).
+    只有当数据库中的 memo 与缓存时的文本完全一致时才复用, 复用时 fork 出独立副本
+    """
+
+    def __init__(self, max_size: int = CONTEXT_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, WorkflowContext]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def load(self, run_id: str, memo: Optional[str]) -> WorkflowContext:
+        cached = self._entries.get(run_id)
+        if cached is not None and memo is not None and cached.memo == memo:
+            self._entries.move_to_end(run_id)
+            return cached.fork()
+        return WorkflowContext.loads(memo)
+
+    def put(self, run_id: str, ctx: WorkflowContext) -> None:
+        ctx.dumps()
+        self._entries[run_id] = ctx.fork()
+        # 之后 ctx 与缓存共享全部子树, 再次修改前都需要复制
+        ctx._owned = set()
+        self._entries.move_to_end(run_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, run_id: str) -> None:
+        self._entries.pop(run_id, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+# 进程级共享实例
+context_cache = ContextCache()
@@ -1,296 +1,860 @@
 # stepflow/domain/engine/execution_engine_async.py
 
-import json
+import os
+import copy
+import uuid
 import asyncio
 import logging
-from typing import Optional
-from datetime import datetime, UTC
+from typing import Any, Awaitable, Callable, List, Optional
+from datetime import datetime, timedelta, UTC
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
+from sqlalchemy.orm.exc import StaleDataError
 
 from stepflow.domain.dsl_model import (
     WorkflowDSL, StateUnion, TaskState, ChoiceState,
-    WaitState, ParallelState, PassState, FailState, SucceedState
+    WaitState, ParallelState, MapState, PassState, FailState, SucceedState
 )
-from stepflow.domain.engine.path_utils import get_value_by_path, set_value_by_path, resolve_path_references, merge_with_path_references
+from stepflow.domain.engine.path_utils import get_value_by_path, set_value_by_path
+from stepflow.domain.engine.context import WorkflowContext, context_cache
+from stepflow.domain.engine.retry import max_attempts, error_matches, TASK_FAILED_ERROR, RUNTIME_ERROR
+from stepflow.domain.engine.template_cache import CompiledCatcher, CompiledState, CompiledGraph, CompiledWorkflow, template_cache
 
 from stepflow.infrastructure.models import (
     WorkflowExecution, WorkflowTemplate, ActivityTask, WorkflowEvent,
-    WorkflowVisibility
+    WorkflowVisibility, StateJoin, Timer
 )
 from stepflow.infrastructure.repositories.workflow_execution_repository import WorkflowExecutionRepository
-from stepflow.infrastructure.repositories.workflow_template_repository import WorkflowTemplateRepository
-from stepflow.infrastructure.repositories.workflow_event_repository import WorkflowEventRepository
 from stepflow.infrastructure.repositories.activity_task_repository import ActivityTaskRepository
-from stepflow.infrastructure.repositories.workflow_visibility_repository import WorkflowVisibilityRepository
+from stepflow.infrastructure.repositories.state_join_repository import StateJoinRepository
+from stepflow.infrastructure.repositories.timer_repository import TimerRepository
+from stepflow.infrastructure.dispatch_notifier import dispatch_notifier, ACTIVITY_CHANNEL, TIMER_CHANNEL
+from stepflow.infrastructure import codec
+from stepflow.infrastructure.event_writer import buffer_event
 
 logger = logging.getLogger(__name__)
 
+# 单次推进中最多连续执行的同步状态数, 防止 Choice 循环占满一次推进
+MAX_INLINE_STEPS = int(os.environ.get("STEPFLOW_MAX_INLINE_STEPS", "100"))
+
+# 不依赖外部事件、可以在内存中直接执行完的状态类型
+# (Wait 登记定时器后阻塞, 与 Task 一样一旦进入就在同一次推进中执行)
+INLINE_STATE_TYPES = {"Pass", "Choice", "Fail", "Succeed"}
+
+# Wait 状态使用的定时器类型, 到期后由定时器 worker 推进工作流
+WAIT_TIMER_TYPE = "workflow"
+
+TERMINAL_STATUSES = ("completed", "failed", "canceled")
+
+# 尚未结束的活动任务状态 (retrying: 失败后等待重试定时器)
+ACTIVE_TASK_STATUSES = ("scheduled", "running", "retrying")
+
+# 乐观锁冲突 (其他推进已修改同一执行) 时的最大重试次数
+ADVANCE_MAX_RETRIES = int(os.environ.get("STEPFLOW_ADVANCE_MAX_RETRIES", "5"))
+
+# Map 未指定 MaxConcurrency 时同时在途的元素任务数
+MAP_DEFAULT_CONCURRENCY = int(os.environ.get("STEPFLOW_MAP_DEFAULT_CONCURRENCY", "100"))
+
 async def parse_workflow_dsl(dsl_text: str) -> WorkflowDSL:
-    data = json.loads(dsl_text)
+    data = codec.loads(dsl_text)
     return WorkflowDSL(**data)
 
-async def advance_workflow(db: AsyncSession, run_id: str) -> None:
-    """推进工作流执行"""
+async def advance_workflow(
+    db: AsyncSession,
+    run_id: str,
+    prepare: Optional[Callable[[], Awaitable[Any]]] = None
+) -> None:
+    """
+    推进工作流执行 (inline run-to-block):
+    在内存中连续执行同步状态 (Pass/Choice/Fail/Succeed),
+    直到遇到真正需要等待外部事件的状态 (Task/Wait/Parallel/Map) 或工作流结束,
+    最后统一提交一次.
+
+    一次推进最多连续执行 MAX_INLINE_STEPS 个同步状态; 超出时 (包括同一事务中推进的分支或父执行)
+    先提交这一批, 再在新的事务中继续推进, 直到所有执行都阻塞在真正的等待上或结束.
+
+    prepare 用于把触发本次推进的修改 (例如活动任务的结果) 登记到同一事务中,
+    与推进的结果一起提交; 回滚后它登记的修改会丢失, 因此每次重试前都重新执行.
+
+    提交时按 (run_id, version) 比较并交换; 如果另一次推进 (worker 回调、API、定时器)
+    已经先修改了同一执行, 回滚并重新加载后重试, 不会覆盖对方写入的状态
+    """
+    pending = [run_id]
+    while pending:
+        current = pending.pop(0)
+        await advance_with_retries(db, current, prepare)
+        prepare = None
+        for yielded in db.info.pop("yielded_runs", []):
+            if yielded not in pending:
+                pending.append(yielded)
+
+async def advance_with_retries(
+    db: AsyncSession,
+    run_id: str,
+    prepare: Optional[Callable[[], Awaitable[Any]]] = None
+) -> None:
+    """在一个事务中推进一次, 版本冲突时回滚并重试"""
+    for attempt in range(1, ADVANCE_MAX_RETRIES + 1):
+        try:
+            if prepare is not None:
+                await prepare()
+            await advance_workflow_once(db, run_id)
+            if db.new or db.dirty or db.deleted:
+                # 执行不存在或已结束时推进提前返回, 仍要提交 prepare 登记的修改
+                await db.commit()
+            return
+        except StaleDataError:
+            await db.rollback()
+            db.info.pop("activity_tasks_scheduled", None)
+            db.info.pop("timers_scheduled", None)
+            db.info.pop("yielded_runs", None)
+            if attempt == ADVANCE_MAX_RETRIES:
+                raise
+            logger.info(f"工作流 {run_id} 版本冲突, 重新加载后重试 ({attempt}/{ADVANCE_MAX_RETRIES})")
+            await asyncio.sleep(0.01 * attempt)
+        finally:
+            # prepare 登记的任务结果只属于这一次尝试, 重试时由 prepare 重新登记
+            db.info.pop("finished_tasks", None)
+
+async def advance_workflow_once(db: AsyncSession, run_id: str) -> None:
+    """加载最新版本的执行并推进一次, 版本冲突时由 advance_workflow 重试"""
     # 获取工作流执行
     exec_repo = WorkflowExecutionRepository(db)
     wf_exec = await exec_repo.get_by_run_id(run_id)
+    if not wf_exec:
+        logger.warning(f"工作流执行不存在: {run_id}")
+        return
     
     # 如果工作流已经完成或失败，则不需要推进
-    if wf_exec.status in ["completed", "failed", "canceled"]:
+    if wf_exec.status in TERMINAL_STATUSES:
         return
     
-    # 获取工作流模板
-    tpl_repo = WorkflowTemplateRepository(db)
+    # 获取已编译的工作流模板 (按 template_id + version 缓存)
+    # 模板不存在或无法编译 (DSL 校验失败) 时执行永远无法推进, 直接按 States.Runtime 失败
     try:
-        tpl = await tpl_repo.get_by_id(wf_exec.template_id)
-        if not tpl:
-            print(f"Warning: Template {wf_exec.template_id} not found")
-            return
-    except Exception as e:
-        print(f"Error getting template: {str(e)}")
+        compiled = await template_cache.load(db, wf_exec.template_id)
+    except ValueError as e:
+        logger.exception(f"工作流 {run_id} 的模板 {wf_exec.template_id} 无法编译")
+        fail_workflow(db, wf_exec, RUNTIME_ERROR, f"Invalid workflow template {wf_exec.template_id}: {e}")
+        await db.commit()
+        return
+    if not compiled:
+        logger.error(f"工作流 {run_id} 的模板 {wf_exec.template_id} 不存在")
+        fail_workflow(db, wf_exec, RUNTIME_ERROR, f"Workflow template {wf_exec.template_id} not found")
+        await db.commit()
         return
-    
-    # 解析 DSL
-    # 先拿 template
-    dsl = await parse_workflow_dsl(tpl.dsl_definition)
+
+    # Parallel 分支执行对应模板中的一个子图
+    graph = compiled.graph_for(wf_exec.branch_path)
 
     # 当前状态名
-    current_state_name = wf_exec.current_state_name
-    if not current_state_name:
-        # 首次执行
-        current_state_name = dsl.StartAt
-        wf_exec.current_state_name = current_state_name
-        await exec_repo.update(wf_exec)
+    resuming = True
+    if not wf_exec.current_state_name:
+        # 首次执行: 以启动输入作为初始上下文
+        wf_exec.current_state_name = graph.start_at
+        if not wf_exec.memo:
+            wf_exec.memo = wf_exec.input or "{}"
+        resuming = False
+
+    await run_to_block(db, wf_exec, graph, resuming)
+
+    # 分支执行结束 => 通知父执行汇合
+    if wf_exec.parent_run_id and wf_exec.status in TERMINAL_STATUSES:
+        await close_branch(db, compiled, wf_exec)
 
-    state_def = dsl.States[current_state_name]
+    # 提交
+    await db.commit()
+
+    # 缓存本次推进后的上下文, 同一进程的下一次推进可以跳过解码
+    ctx = getattr(wf_exec, "_context", None)
+    if wf_exec.status in TERMINAL_STATUSES:
+        context_cache.invalidate(wf_exec.run_id)
+    elif ctx is not None and ctx.memo is wf_exec.memo:
+        context_cache.put(wf_exec.run_id, ctx)
+
+    # 提交后再唤醒 worker, 保证 worker 能看到新调度的任务
+    if db.info.pop("activity_tasks_scheduled", False):
+        dispatch_notifier.notify(ACTIVITY_CHANNEL)
+    if db.info.pop("timers_scheduled", False):
+        dispatch_notifier.notify(TIMER_CHANNEL)
+
+async def run_to_block(db: AsyncSession, wf_exec: WorkflowExecution, graph: CompiledGraph, resuming: bool) -> int:
+    """
+    从 wf_exec.current_state_name 开始连续执行状态, 返回本次执行的状态数.
+
+    resuming=True 表示当前状态在之前的推进中已经进入过 (例如 Task 已调度, 正等待结果).
+    阻塞型状态 (Task/Parallel/Map) 一旦进入就会在同一次推进中执行, 以保证它们的外部记录
+    (ActivityTask 等) 与状态转移一起提交; MAX_INLINE_STEPS 只限制同步状态的数量,
+    超出时把执行记入 db.info["yielded_runs"], 由 advance_workflow 提交后继续推进.
+    """
+    steps = 0
+    while wf_exec.status == "running":
+        state = graph.states[wf_exec.current_state_name]
+        if steps >= MAX_INLINE_STEPS and state.type in INLINE_STATE_TYPES:
+            # 同步状态过多 (例如 Choice 循环): 提交这一批后由 advance_workflow 在新的事务中继续
+            db.info.setdefault("yielded_runs", []).append(wf_exec.run_id)
+            break
+
+        proceed = await execute_state(db, wf_exec, state, resuming)
+        resuming = False
+        steps += 1
+        if not proceed:
+            break
+    return steps
+
+async def execute_state(db: AsyncSession, wf_exec: WorkflowExecution, state: CompiledState, resuming: bool) -> bool:
+    """执行单个状态, 返回 True 表示可以继续执行下一个状态"""
+    state_def = state.definition
 
     # 根据类型分发
     if isinstance(state_def, TaskState):
-        await handle_task_state(db, wf_exec, dsl, state_def)
+        return await handle_task_state(db, wf_exec, state, resuming)
     elif isinstance(state_def, ChoiceState):
-        await handle_choice_state(db, wf_exec, dsl, state_def)
+        return await handle_choice_state(db, wf_exec, state)
     elif isinstance(state_def, WaitState):
-        await handle_wait_state(db, wf_exec, dsl, state_def)
+        return await handle_wait_state(db, wf_exec, state, resuming)
     elif isinstance(state_def, ParallelState):
-        await handle_parallel_state(db, wf_exec, dsl, state_def)
+        return await handle_parallel_state(db, wf_exec, state, resuming)
+    elif isinstance(state_def, MapState):
+        return await handle_map_state(db, wf_exec, state, resuming)
     elif isinstance(state_def, PassState):
-        await handle_pass_state(db, wf_exec, dsl, state_def)
+        return await handle_pass_state(db, wf_exec, state)
     elif isinstance(state_def, FailState):
-        await handle_fail_state(db, wf_exec, state_def)
+        return await handle_fail_state(db, wf_exec, state_def)
     elif isinstance(state_def, SucceedState):
-        await handle_succeed_state(db, wf_exec)
+        return await handle_succeed_state(db, wf_exec)
+    return False
 
-    # 提交
-    await db.commit()
+def record_event(db: AsyncSession, wf_exec: WorkflowExecution, event_type: str, attributes: Optional[dict] = None) -> int:
+    """
+    暂存一条工作流事件, 提交时与本次推进的其他事件一起批量写入.
+    返回按 current_event_id 分配的 event_id
+    """
+    return buffer_event(db, wf_exec, event_type, codec.dumps(attributes) if attributes is not None else None)
 
-async def handle_task_state(db: AsyncSession, wf_exec: WorkflowExecution, dsl: WorkflowDSL, state_def: TaskState):
-    """处理任务状态节点"""
-    # 读取上下文
-    memo_json = json.loads(wf_exec.memo) if wf_exec.memo else {}
-    
-    # 获取输入参数
+def complete_workflow(db: AsyncSession, wf_exec: WorkflowExecution, output: Any, encoded: Optional[str] = None) -> None:
+    """将工作流标记为完成, result 为最后一个状态的输出 (encoded 为已编码好的输出)"""
+    wf_exec.status = "completed"
+    wf_exec.close_time = datetime.now(UTC)
+    wf_exec.result = encoded if encoded is not None else codec.dumps(output)
+    record_event(db, wf_exec, "WorkflowExecutionCompleted")
+
+def fail_workflow(db: AsyncSession, wf_exec: WorkflowExecution, error: str, cause: Optional[str] = None) -> None:
+    """将工作流标记为失败"""
+    wf_exec.status = "failed"
+    wf_exec.close_time = datetime.now(UTC)
+    wf_exec.result = codec.dumps({"error": error, "cause": cause})
+    record_event(db, wf_exec, "WorkflowExecutionFailed", {"error": error, "cause": cause})
+
+def load_context(wf_exec: WorkflowExecution) -> WorkflowContext:
+    """
+    获取执行的上下文: 同一次推进中只解码一次 memo,
+    进程内缓存的 memo 与数据库一致时直接复用已解码的对象
+    """
+    ctx = getattr(wf_exec, "_context", None)
+    if ctx is None or ctx.memo is not wf_exec.memo:
+        ctx = context_cache.load(wf_exec.run_id, wf_exec.memo)
+        wf_exec._context = ctx
+    return ctx
+
+def save_context(wf_exec: WorkflowExecution, ctx: WorkflowContext) -> None:
+    """把上下文写回 memo, 只重新编码被修改的顶层键"""
+    wf_exec.memo = ctx.dumps()
+    wf_exec._context = ctx
+
+def finish_state(db: AsyncSession, wf_exec: WorkflowExecution, state: CompiledState, ctx: WorkflowContext) -> bool:
+    """应用 OutputPath 并转移到 Next (或结束工作流), 返回 True 表示可以继续执行"""
+    out_data = ctx.get(state.output_path)
+    if state.output_path:
+        ctx.replace(out_data)
+    save_context(wf_exec, ctx)
+    if state.end:
+        # 输出就是上下文本身时直接复用刚编码的 memo
+        complete_workflow(db, wf_exec, out_data, wf_exec.memo if isinstance(out_data, dict) else None)
+    elif state.next_state:
+        wf_exec.current_state_name = state.next_state
+    else:
+        # 既没有 Next 也没有 End => DSL 不完整, 停在当前状态
+        logger.warning(f"状态 {state.name} 既没有 Next 也没有 End")
+        return False
+    return True
+
+async def handle_task_state(db: AsyncSession, wf_exec: WorkflowExecution, state: CompiledState, resuming: bool = False) -> bool:
+    """
+    处理任务状态节点:
+    - 刚进入该状态 => 调度一个新的活动任务并阻塞
+    - 恢复执行 => 检查最近的活动任务, 已完成则写入结果并继续, 未完成则继续等待
+    """
+    activity_repo = ActivityTaskRepository(db)
+    latest = await activity_repo.get_latest_by_run_id(wf_exec.run_id)
+
+    if resuming and latest is not None:
+        if latest.status in ACTIVE_TASK_STATUSES:
+            # 仍在执行中 (或等待重试)
+            return False
+        if latest.status == "completed":
+            return complete_task_state(db, wf_exec, state, latest)
+        if latest.status in ("failed", "canceled"):
+            error_name = latest.error_type or TASK_FAILED_ERROR
+            record_event(db, wf_exec, "ActivityTaskFailed", {
+                "task_token": latest.task_token,
+                "error": latest.error,
+                "error_type": error_name
+            })
+            catcher = find_catcher(state, error_name) if latest.status == "failed" else None
+            if catcher is not None:
+                return catch_task_error(db, wf_exec, state, catcher, error_name, latest.error)
+            fail_workflow(db, wf_exec, f"Activity task failed: {latest.error}", latest.error_details)
+            return False
+
+    schedule_activity_task(db, wf_exec, state, latest.seq + 1 if latest else 1)
+    return False
+
+def find_catcher(state: CompiledState, error_name: str) -> Optional[CompiledCatcher]:
+    """按声明顺序找到第一个匹配错误名的 Catch"""
+    return next((c for c in state.catchers if error_matches(c.error_equals, error_name)), None)
+
+def catch_task_error(
+    db: AsyncSession,
+    wf_exec: WorkflowExecution,
+    state: CompiledState,
+    catcher: CompiledCatcher,
+    error_name: str,
+    cause: Optional[str]
+) -> bool:
+    """Catch 匹配: 把 {"Error", "Cause"} 写入 ResultPath 并转移到 Catch 的 Next, 与任务失败在同一事务中提交"""
+    ctx = load_context(wf_exec)
+    ctx.set(catcher.result_path, {"Error": error_name, "Cause": cause})
+    save_context(wf_exec, ctx)
+    record_event(db, wf_exec, "TaskStateCaught", {
+        "state": state.name,
+        "error": error_name,
+        "next": catcher.next_state
+    })
+    wf_exec.current_state_name = catcher.next_state
+    return True
+
+def build_task_input(state: CompiledState, context: Any) -> Any:
+    """根据 InputPath/Parameters 从上下文构造活动任务的输入"""
+    state_def: TaskState = state.definition
     input_data = {}
     
     # 1. 首先从 InputPath 获取输入
-    if hasattr(state_def, 'InputPath') and state_def.InputPath:
-        input_data = get_value_by_path(memo_json, state_def.InputPath) or {}
+    if state_def.InputPath:
+        input_data = get_value_by_path(context, state.input_path) or {}
         logger.debug(f"从 InputPath {state_def.InputPath} 获取输入: {input_data}")
     
     # 2. 然后处理 Parameters
-    if hasattr(state_def, 'Parameters') and state_def.Parameters:
+    if state_def.Parameters:
         # 如果有 Parameters，使用它们替换或扩展输入
-        if isinstance(state_def.Parameters, dict):
-            # 解析 Parameters 中的路径引用
-            parameters = merge_with_path_references(state_def.Parameters, memo_json)
+        if state.parameters is not None:
+            # 用预编译的模板解析 Parameters 中的路径引用
+            parameters = state.parameters.render(context)
             logger.debug(f"解析后的参数: {parameters}")
             
-            # 更新输入数据
+            # 更新输入数据 (InputPath 取到的是上下文中的对象, 合并前先复制)
             if isinstance(input_data, dict):
-                input_data.update(parameters)
+                input_data = {**input_data, **parameters}
             else:
                 input_data = parameters
         else:
             logger.warning(f"Parameters 不是字典: {state_def.Parameters}")
-    
-    # 转换为 JSON 字符串
-    input_json = json.dumps(input_data)
-    logger.debug(f"最终输入参数: {input_json}")
-    
-    # 创建活动任务
-    task_token = str(uuid.uuid4())
-    new_task = ActivityTask(
-        task_token=task_token,
+    return input_data
+
+def new_activity_task(db: AsyncSession, wf_exec: WorkflowExecution, state: CompiledState, seq: int, context: Any) -> ActivityTask:
+    """构造并暂存一个待调度的活动任务 (不写事件), 提交后会通知 worker"""
+    db.info["activity_tasks_scheduled"] = True
+    task = ActivityTask(
+        task_token=str(uuid.uuid4()),
         run_id=wf_exec.run_id,
-        activity_type=state_def.ActivityType,
+        shard_id=wf_exec.shard_id,
+        seq=seq,
+        activity_type=state.definition.ActivityType,
         status="scheduled",
-        input=input_json,
+        input=codec.dumps(build_task_input(state, context)),
+        attempt=1,
+        max_attempts=max_attempts(state.retriers),
+        retry_policy=state.retry_policy,
+        timeout_seconds=state.definition.TimeoutSeconds,
+        heartbeat_seconds=state.definition.HeartbeatSeconds,
         scheduled_at=datetime.now(UTC)
     )
-    db.add(new_task)
+    db.add(task)
+    return task
+
+def schedule_activity_task(db: AsyncSession, wf_exec: WorkflowExecution, state: CompiledState, seq: int) -> ActivityTask:
+    """根据 InputPath/Parameters 构造输入并调度活动任务"""
+    state_def: TaskState = state.definition
+    # 读取上下文
+    ctx = load_context(wf_exec)
+    
+    # 创建活动任务
+    new_task = new_activity_task(db, wf_exec, state, seq, ctx.data)
+    logger.debug(f"最终输入参数: {new_task.input}")
     
     # 记录事件
-    new_evt = WorkflowEvent(
-        run_id=wf_exec.run_id,
-        event_type="ACTIVITY_SCHEDULED",
-        event_time=datetime.now(UTC),
-        attributes=json.dumps({
-            "activity_type": state_def.ActivityType,
-            "task_token": task_token
-        })
-    )
-    db.add(new_evt)
+    record_event(db, wf_exec, "ActivityTaskScheduled", {
+        "activity_type": state_def.ActivityType,
+        "task_token": new_task.task_token
+    })
     
     # 更新工作流状态
-    wf_exec.current_state_name = state_def.Name
-    
-    # 提交
-    await db.commit()
-    logger.info(f"已调度活动任务: {task_token}, 类型: {state_def.ActivityType}")
-
-async def handle_choice_state(db: AsyncSession, wf_exec: WorkflowExecution, dsl: WorkflowDSL, state_def: ChoiceState):
-    memo_json = json.loads(wf_exec.memo) if wf_exec.memo else {}
-    choice_input = get_value_by_path(memo_json, state_def.InputPath) or {}
-    next_state = None
-    for c in state_def.Choices:
-        val = get_value_by_path(choice_input, c.Variable)
-        if val == c.StringEquals:
-            next_state = c.Next
-            break
-    if not next_state and state_def.Default:
-        next_state = state_def.Default
+    wf_exec.current_state_name = state.name
+    logger.info(f"已调度活动任务: {new_task.task_token}, 类型: {state_def.ActivityType}")
+    return new_task
+
+def complete_task_state(db: AsyncSession, wf_exec: WorkflowExecution, state: CompiledState, task: ActivityTask) -> bool:
+    """把已完成活动任务的结果按 ResultPath 写入上下文, 然后转移到下一个状态"""
+    ctx = load_context(wf_exec)
+    result = codec.loads(task.result) if task.result else {}
+    ctx.set(state.result_path, result)
+    record_event(db, wf_exec, "TaskStateFinished", {
+        "task_token": task.task_token,
+        "next": state.next_state
+    })
+    return finish_state(db, wf_exec, state, ctx)
+
+def choose_next(state: CompiledState, context: Any) -> Optional[str]:
+    """按顺序匹配 Choice 规则, 返回下一个状态名 (无匹配且无 Default 时返回 None)"""
+    choice_input = get_value_by_path(context, state.input_path) or {}
+    for c in state.choices:
+        val = get_value_by_path(choice_input, c.variable)
+        if val == c.rule.StringEquals:
+            return c.next_state
+    return state.default
+
+async def handle_choice_state(db: AsyncSession, wf_exec: WorkflowExecution, state: CompiledState) -> bool:
+    next_state = choose_next(state, load_context(wf_exec).data)
 
     if not next_state:
         # no match => fail
         wf_exec.status = "failed"
         wf_exec.close_time = datetime.now(UTC)
-        new_evt = WorkflowEvent(
-            run_id=wf_exec.run_id,
-            shard_id=wf_exec.shard_id,
-            event_id=0,
-            event_type="ChoiceNoMatch"
-        )
-        db.add(new_evt)
-    else:
-        wf_exec.current_state_name = next_state
-        new_evt = WorkflowEvent(
-            run_id=wf_exec.run_id,
-            shard_id=wf_exec.shard_id,
-            event_id=0,
-            event_type="ChoiceMatched",
-            attributes=json.dumps({"next": next_state})
-        )
-        db.add(new_evt)
+        record_event(db, wf_exec, "ChoiceNoMatch")
+        return False
 
-    await db.commit()
+    wf_exec.current_state_name = next_state
+    record_event(db, wf_exec, "ChoiceMatched", {"next": next_state})
+    return True
 
-async def handle_wait_state(db: AsyncSession, wf_exec: WorkflowExecution, dsl: WorkflowDSL, state_def: WaitState):
-    # 省略: 可能要看 timers
-    if state_def.End:
-        wf_exec.status = "completed"
-        wf_exec.close_time = datetime.now(UTC)
-    elif state_def.Next:
-        wf_exec.current_state_name = state_def.Next
+async def handle_wait_state(db: AsyncSession, wf_exec: WorkflowExecution, state: CompiledState, resuming: bool = False) -> bool:
+    """
+    处理等待状态节点:
+    - 刚进入该状态 => 按 Seconds/SecondsPath/Timestamp/TimestampPath 计算到期时间,
+      登记一个持久化的定时器后阻塞, 等待期间不占用任何协程或会话; 到期时间已过则直接继续
+    - 恢复执行 => 定时器已触发 (或被取消) 则继续, 否则继续等待
+    """
+    ctx = load_context(wf_exec)
+    if resuming:
+        if await TimerRepository(db).has_scheduled(wf_exec.run_id, WAIT_TIMER_TYPE):
+            return False
+        record_event(db, wf_exec, "WaitStateFinished", {"state": state.name})
+        return finish_state(db, wf_exec, state, ctx)
 
-    await db.commit()
+    now = datetime.now(UTC)
+    try:
+        fire_at = wait_deadline(state, ctx.get(state.input_path), now)
+    except ValueError as e:
+        fail_workflow(db, wf_exec, f"Wait state {state.name} failed", str(e))
+        return False
+    if fire_at is None or fire_at <= now:
+        return finish_state(db, wf_exec, state, ctx)
 
-async def handle_parallel_state(db: AsyncSession, wf_exec: WorkflowExecution, dsl: WorkflowDSL, state_def: ParallelState):
-    # 并行分支 => 需要自定义
-    # ...
-    await db.commit()
+    timer = schedule_wait_timer(db, wf_exec, fire_at)
+    record_event(db, wf_exec, "WaitStateStarted", {
+        "state": state.name,
+        "timer_id": timer.timer_id,
+        "fire_at": fire_at.isoformat()
+    })
+    wf_exec.current_state_name = state.name
+    return False
 
-async def handle_pass_state(db: AsyncSession, wf_exec: WorkflowExecution, dsl: WorkflowDSL, state_def: PassState):
-    memo_json = json.loads(wf_exec.memo) if wf_exec.memo else {}
-    if state_def.Result:
-        merged = set_value_by_path(memo_json, state_def.ResultPath, state_def.Result)
+def wait_deadline(state: CompiledState, wait_input: Any, now: datetime) -> Optional[datetime]:
+    """Wait 状态的到期时间 (带时区的 UTC), 没有指定等待时长时返回 None"""
+    state_def: WaitState = state.definition
+    if state_def.Timestamp is not None or state.timestamp_path is not None:
+        value = state_def.Timestamp if state_def.Timestamp is not None else get_value_by_path(wait_input, state.timestamp_path)
+        return parse_timestamp(value)
+    if state_def.Seconds is not None:
+        seconds = state_def.Seconds
+    elif state.seconds_path is not None:
+        seconds = get_value_by_path(wait_input, state.seconds_path)
     else:
-        merged = memo_json
-    out_data = get_value_by_path(merged, state_def.OutputPath)
-    if not isinstance(out_data, dict):
-        out_data = {"value": out_data}
-    wf_exec.memo = json.dumps(out_data)
-    if state_def.End:
-        wf_exec.status = "completed"
-        wf_exec.close_time = datetime.now(UTC)
-    elif state_def.Next:
-        wf_exec.current_state_name = state_def.Next
+        return None
+    if isinstance(seconds, bool) or not isinstance(seconds, (int, float)) or seconds < 0:
+        raise ValueError(f"Wait seconds must be a non-negative number, got {seconds!r}")
+    return now + timedelta(seconds=seconds)
 
-    await db.commit()
+def parse_timestamp(value: Any) -> datetime:
+    """解析 ISO 8601 时间戳, 不带时区时按 UTC 处理"""
+    if not isinstance(value, str):
+        raise ValueError(f"Wait timestamp must be an ISO 8601 string, got {value!r}")
+    try:
+        timestamp = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"Invalid wait timestamp: {value!r}")
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=UTC)
+    return timestamp
 
-async def handle_fail_state(db: AsyncSession, wf_exec: WorkflowExecution, state_def: FailState):
-    wf_exec.status = "failed"
-    wf_exec.close_time = datetime.now(UTC)
-    new_evt = WorkflowEvent(
+def schedule_wait_timer(db: AsyncSession, wf_exec: WorkflowExecution, fire_at: datetime) -> Timer:
+    """暂存 Wait 状态的定时器, 与状态转移一起提交, 提交后唤醒定时器 worker"""
+    db.info["timers_scheduled"] = True
+    timer = Timer(
+        timer_id=str(uuid.uuid4()),
         run_id=wf_exec.run_id,
         shard_id=wf_exec.shard_id,
-        event_id=0,
-        event_type="WorkflowExecutionFailed",
-        attributes=json.dumps({"error": state_def.Error, "cause": state_def.Cause})
+        fire_at=fire_at,
+        status="scheduled",
+        timer_type=WAIT_TIMER_TYPE,
     )
-    db.add(new_evt)
-    await db.commit()
+    db.add(timer)
+    return timer
 
-async def handle_succeed_state(db: AsyncSession, wf_exec: WorkflowExecution):
-    wf_exec.status = "completed"
-    wf_exec.close_time = datetime.now(UTC)
-    new_evt = WorkflowEvent(
+async def handle_parallel_state(db: AsyncSession, wf_exec: WorkflowExecution, state: CompiledState, resuming: bool = False) -> bool:
+    """
+    处理并行状态节点:
+    - 刚进入该状态 => 为每个分支创建子执行并推进到各自的第一个阻塞点
+    - 恢复执行 => 所有分支完成后把各分支输出 (按分支顺序) 写入 ResultPath 并继续
+    """
+    join = None
+    if resuming:
+        join = await StateJoinRepository(db).get_open(wf_exec.run_id, state.name)
+    if join is None:
+        return await start_parallel_branches(db, wf_exec, state)
+    if join.completed < join.total:
+        return False
+    return await join_parallel_branches(db, wf_exec, state, join)
+
+async def start_parallel_branches(db: AsyncSession, wf_exec: WorkflowExecution, state: CompiledState) -> bool:
+    """创建分支子执行与汇合记录, 并在本次推进中执行各分支直到阻塞"""
+    branch_input = load_context(wf_exec).get(state.input_path)
+    if not isinstance(branch_input, dict):
+        branch_input = {"value": branch_input}
+    branch_input_json = codec.dumps(branch_input)
+    path_prefix = f"{wf_exec.branch_path}/" if wf_exec.branch_path else ""
+
+    children = []
+    for index, branch in enumerate(state.branches):
+        child = WorkflowExecution(
+            run_id=str(uuid.uuid4()),
+            workflow_id=f"{wf_exec.workflow_id}/{state.name}/{index}",
+            shard_id=wf_exec.shard_id,
+            template_id=wf_exec.template_id,
+            current_state_name=branch.start_at,
+            status="running",
+            workflow_type=wf_exec.workflow_type,
+            input=branch_input_json,
+            memo=branch_input_json,
+            start_time=datetime.now(UTC),
+            parent_run_id=wf_exec.run_id,
+            branch_path=f"{path_prefix}{state.name}/{index}",
+        )
+        db.add(child)
+        children.append(child)
+
+    join = StateJoin(
+        join_id=str(uuid.uuid4()),
         run_id=wf_exec.run_id,
         shard_id=wf_exec.shard_id,
-        event_id=0,
-        event_type="WorkflowExecutionSucceeded"
+        state_name=state.name,
+        children=codec.dumps([c.run_id for c in children]),
+        total=len(children),
+        completed=0,
+        status="open",
     )
-    db.add(new_evt)
-    await db.commit()
+    StateJoinRepository(db).add(join)
+    record_event(db, wf_exec, "ParallelStateStarted", {
+        "join_id": join.join_id,
+        "branches": [c.run_id for c in children]
+    })
 
-async def handle_activity_task_failed(task_token: str, reason: str, details: Optional[str] = None) -> None:
-    """处理活动任务失败"""
-    # 创建仓库
-    from stepflow.infrastructure.database import AsyncSessionLocal
-    
-    async with AsyncSessionLocal() as session:
-        activity_repo = ActivityTaskRepository(session)
-        execution_repo = WorkflowExecutionRepository(session)
-        event_repo = WorkflowEventRepository(session)
-        visibility_repo = WorkflowVisibilityRepository(session)
-        
-        # 获取任务
-        task = await activity_repo.get_by_token(task_token)
-        if not task:
-            logger.error(f"活动任务失败处理: 找不到任务 {task_token}")
+    # 各分支的第一个活动任务在同一次提交中调度, 由 worker 并发执行
+    for child, branch in zip(children, state.branches):
+        await run_to_block(db, child, branch, resuming=False)
+
+    failed = next((c for c in children if c.status in ("failed", "canceled")), None)
+    if failed is not None:
+        await fail_parallel_state(db, wf_exec, join, failed)
+        return False
+
+    join.completed = sum(1 for c in children if c.status == "completed")
+    if join.completed < join.total:
+        return False
+    return await join_parallel_branches(db, wf_exec, state, join, children)
+
+async def join_parallel_branches(
+    db: AsyncSession,
+    wf_exec: WorkflowExecution,
+    state: CompiledState,
+    join: StateJoin,
+    children: Optional[List[WorkflowExecution]] = None
+) -> bool:
+    """所有分支完成: 按分支顺序合并输出到父执行上下文, 关闭汇合记录并转移状态"""
+    run_ids = codec.loads(join.children)
+    if children is None:
+        children = await WorkflowExecutionRepository(db).list_by_run_ids(run_ids)
+    by_run_id = {c.run_id: c for c in children}
+    outputs = [
+        codec.loads(by_run_id[r].result) if by_run_id[r].result else None
+        for r in run_ids
+    ]
+
+    join.status = "closed"
+    ctx = load_context(wf_exec)
+    ctx.set(state.result_path, outputs)
+    record_event(db, wf_exec, "ParallelStateFinished", {
+        "join_id": join.join_id,
+        "next": state.next_state
+    })
+    return finish_state(db, wf_exec, state, ctx)
+
+async def fail_parallel_state(db: AsyncSession, wf_exec: WorkflowExecution, join: StateJoin, failed: WorkflowExecution) -> None:
+    """任一分支失败 => 取消其余分支 (连同嵌套的分支) 并让父执行失败"""
+    join.status = "closed"
+    siblings = await WorkflowExecutionRepository(db).list_by_run_ids(codec.loads(join.children))
+    await cancel_executions(db, [s for s in siblings if s.status == "running"])
+    fail_workflow(db, wf_exec, "States.BranchFailed", failed.result)
+
+async def cancel_executions(db: AsyncSession, executions: List[WorkflowExecution]) -> None:
+    """
+    在当前事务中取消这些执行及其所有仍在运行的后代分支,
+    并取消它们尚未结束的活动任务与尚未触发的定时器, 避免被取消的分支继续占用 worker
+    """
+    exec_repo = WorkflowExecutionRepository(db)
+    now = datetime.now(UTC)
+    canceled: List[str] = []
+    while executions:
+        for execution in executions:
+            execution.status = "canceled"
+            execution.close_time = now
+            record_event(db, execution, "WorkflowExecutionCanceled")
+        run_ids = [e.run_id for e in executions]
+        canceled.extend(run_ids)
+        executions = await exec_repo.list_running_children(run_ids)
+    await ActivityTaskRepository(db).cancel_for_runs(canceled, now)
+    await TimerRepository(db).cancel_for_runs(canceled)
+
+async def close_branch(db: AsyncSession, compiled: CompiledWorkflow, child: WorkflowExecution) -> None:
+    """
+    分支执行结束后在同一事务中通知父执行:
+    完成则原子地累加汇合计数, 最后一个完成的分支负责继续推进父执行
+    """
+    exec_repo = WorkflowExecutionRepository(db)
+    join_repo = StateJoinRepository(db)
+    while child.parent_run_id and child.status in TERMINAL_STATUSES:
+        parent = await exec_repo.get_by_run_id(child.parent_run_id)
+        if parent is None or parent.status != "running":
             return
-        
-        # 获取工作流执行
-        execution = await execution_repo.get_by_run_id(task.run_id)
-        if not execution:
-            logger.error(f"活动任务失败处理: 找不到工作流执行 {task.run_id}")
+        state_name = child.branch_path.rsplit("/", 2)[-2]
+        join = await join_repo.get_open(parent.run_id, state_name)
+        if join is None:
             return
-        
-        # 记录任务失败事件
-        await event_repo.create_event(
-            run_id=task.run_id,
-            event_type="ACTIVITY_TASK_FAILED",
-            event_data=json.dumps({
-                "task_token": task_token,
-                "activity_type": task.activity_type,
-                "reason": reason,
-                "details": details
-            })
+
+        if child.status != "completed":
+            await fail_parallel_state(db, parent, join, child)
+        else:
+            completed = await join_repo.increment_completed(join)
+            if completed < join.total:
+                return
+            await run_to_block(db, parent, compiled.graph_for(parent.branch_path), resuming=True)
+
+        # 嵌套的 Parallel: 父执行本身也可能是一个分支
+        child = parent
+
+async def handle_map_state(db: AsyncSession, wf_exec: WorkflowExecution, state: CompiledState, resuming: bool = False) -> bool:
+    """
+    处理映射状态节点:
+    每个元素在内存中执行 Iterator 的纯数据状态, 遇到 Task 时调度一个活动任务 (seq = base_seq + 下标),
+    同时在途的任务数不超过 MaxConcurrency, 每次恢复时按滑动窗口补派后续元素;
+    全部元素完成后按元素顺序把结果写入 ResultPath
+    """
+    activity_repo = ActivityTaskRepository(db)
+    join_repo = StateJoinRepository(db)
+    ctx = load_context(wf_exec)
+    items = ctx.get(state.items_path)
+    if not isinstance(items, list):
+        fail_workflow(db, wf_exec, "States.ItemsNotArray", f"ItemsPath of state '{state.name}' does not point to an array")
+        return False
+
+    join = await join_repo.get_open(wf_exec.run_id, state.name) if resuming else None
+    if join is None:
+        latest = await activity_repo.get_latest_by_run_id(wf_exec.run_id)
+        join = StateJoin(
+            join_id=str(uuid.uuid4()),
+            run_id=wf_exec.run_id,
+            shard_id=wf_exec.shard_id,
+            state_name=state.name,
+            total=len(items),
+            completed=0,
+            base_seq=latest.seq + 1 if latest else 1,
+            next_index=0,
+            status="open",
         )
-        
-        # 更新工作流执行状态为失败
-        execution.status = "failed"
-        execution.end_time = datetime.now(UTC)
-        execution.result = json.dumps({
-            "error": f"Activity task failed: {reason}",
-            "details": details
+        join_repo.add(join)
+        record_event(db, wf_exec, "MapStateStarted", {
+            "join_id": join.join_id,
+            "items": join.total
         })
-        await execution_repo.update(execution)
-        
-        # 更新工作流可见性
-        visibility = await visibility_repo.get_by_run_id(task.run_id)
-        if visibility:
-            visibility.status = "failed"
-            visibility.end_time = datetime.now(UTC)
-            await visibility_repo.update(visibility)
-        
-        logger.info(f"工作流 {task.run_id} 因活动任务 {task_token} 失败而终止: {reason}")
\ No newline at end of file
+    else:
+        # 只统计本事务中结束的元素任务, 在汇合记录上原子地累加:
+        # 并发结束的最后两个元素不会都看到对方仍在途, 也不需要每次按状态统计整个区间
+        finished = take_finished_tasks(db, wf_exec.run_id, join.base_seq, join.base_seq + join.next_index)
+        failed = [seq for _, seq, status in finished if status != "completed"]
+        if failed:
+            await fail_map_state(db, wf_exec, join, "States.ItemFailed", f"{len(failed)} item task(s) of state '{state.name}' failed")
+            return False
+        if finished:
+            await join_repo.increment_completed(join, len(finished))
+
+    # 滑动窗口: 按汇合计数补派元素直到在途任务数达到上限 (直接结束的元素在派发时计入)
+    window = state.max_concurrency or MAP_DEFAULT_CONCURRENCY
+    while join.next_index < join.total and join.next_index - join.completed < window:
+        start = join.next_index
+        end = min(join.total, start + window - (join.next_index - join.completed))
+        if not await join_repo.advance_cursor(join, start, end):
+            # 并发的推进已经派发了这一批, 由它负责后续
+            return False
+        ended = 0
+        for index in range(start, end):
+            outcome, item_state, item_context = run_map_item(state.iterator, state.iterator.start_at, copy.deepcopy(items[index]))
+            if outcome == "fail":
+                await fail_map_item(db, wf_exec, state, join, index, item_state)
+                return False
+            if outcome == "task":
+                new_activity_task(db, wf_exec, item_state, join.base_seq + index, item_context)
+            else:
+                ended += 1
+        if ended:
+            await join_repo.increment_completed(join, ended)
+
+    if join.completed < join.total:
+        return False
+    return await join_map_items(db, wf_exec, state, join, items, ctx)
+
+def take_finished_tasks(db: AsyncSession, run_id: str, start_seq: int, end_seq: int) -> List[tuple]:
+    """取出本事务中写入结果的、seq 位于 [start_seq, end_seq) 的活动任务 (run_id, seq, status)"""
+    pending = db.info.get("finished_tasks", [])
+    taken = [f for f in pending if f[0] == run_id and start_seq <= f[1] < end_seq]
+    if taken:
+        db.info["finished_tasks"] = [f for f in pending if f not in taken]
+    return taken
+
+def run_map_item(iterator: CompiledGraph, state_name: str, context: Any) -> tuple:
+    """
+    在内存中执行 Iterator 中的纯数据状态, 直到遇到 Task 或结束.
+    返回 (outcome, state, context), outcome 为 "task" / "end" / "fail";
+    相同输入总是得到相同结果, 汇合时据此重放每个元素的路径.
+    context 会被原地修改, 调用方需传入元素的副本
+    """
+    state = iterator.states[state_name]
+    for _ in range(MAX_INLINE_STEPS):
+        state = iterator.states[state_name]
+        if state.type == "Task":
+            return "task", state, context
+        if state.type == "Fail":
+            return "fail", state, context
+        if state.type == "Succeed":
+            return "end", state, context
+        if state.type == "Choice":
+            state_name = choose_next(state, context)
+            if not state_name:
+                return "fail", state, context
+            continue
+        context = get_value_by_path(apply_pass(state, context), state.output_path)
+        if state.end or not state.next_state:
+            return "end", state, context
+        state_name = state.next_state
+    return "fail", state, context
+
+async def fail_map_item(
+    db: AsyncSession,
+    wf_exec: WorkflowExecution,
+    state: CompiledState,
+    join: StateJoin,
+    index: int,
+    item_state: CompiledState
+) -> None:
+    """元素在 Iterator 中失败 (Fail 状态或 Choice 无匹配) => 整个 Map 失败"""
+    item_def = item_state.definition
+    error = item_def.Error if isinstance(item_def, FailState) and item_def.Error else "States.ItemFailed"
+    cause = item_def.Cause if isinstance(item_def, FailState) else None
+    await fail_map_state(db, wf_exec, join, error, cause or f"Item {index} of state '{state.name}' failed at '{item_state.name}'")
+
+async def fail_map_state(db: AsyncSession, wf_exec: WorkflowExecution, join: StateJoin, error: str, cause: str) -> None:
+    """
+    关闭汇合记录并让执行失败, 同时取消已派发但尚未结束的元素任务 (以及它们的重试定时器),
+    与 Parallel 分支失败时取消其余分支一样, 不再让 worker 执行结果会被丢弃的任务
+    """
+    join.status = "closed"
+    await ActivityTaskRepository(db).cancel_in_seq_range(
+        wf_exec.run_id, join.base_seq, join.base_seq + join.next_index, datetime.now(UTC)
+    )
+    await TimerRepository(db).cancel_for_runs([wf_exec.run_id])
+    fail_workflow(db, wf_exec, error, cause)
+
+async def join_map_items(
+    db: AsyncSession,
+    wf_exec: WorkflowExecution,
+    state: CompiledState,
+    join: StateJoin,
+    items: List[Any],
+    ctx: WorkflowContext
+) -> bool:
+    """所有元素完成: 一次读取全部元素任务, 按元素顺序组装输出并转移状态"""
+    tasks = await ActivityTaskRepository(db).list_by_seq_range(
+        wf_exec.run_id, join.base_seq, join.base_seq + join.total
+    )
+    by_seq = {t.seq: t for t in tasks}
+    outputs = []
+    for index, item in enumerate(items):
+        outcome, item_state, item_context = run_map_item(state.iterator, state.iterator.start_at, copy.deepcopy(item))
+        if outcome == "task":
+            task = by_seq.get(join.base_seq + index)
+            result = codec.loads(task.result) if task and task.result else {}
+            item_context = get_value_by_path(
+                set_value_by_path(item_context, item_state.result_path, result),
+                item_state.output_path
+            )
+            if not item_state.end and item_state.next_state:
+                outcome, item_state, item_context = run_map_item(state.iterator, item_state.next_state, item_context)
+        if outcome == "fail":
+            await fail_map_item(db, wf_exec, state, join, index, item_state)
+            return False
+        outputs.append(item_context)
+
+    join.status = "closed"
+    join.completed = join.total
+    ctx.set(state.result_path, outputs)
+    record_event(db, wf_exec, "MapStateFinished", {
+        "join_id": join.join_id,
+        "items": join.total,
+        "next": state.next_state
+    })
+    return finish_state(db, wf_exec, state, ctx)
+
+def apply_pass(state: CompiledState, context: Any) -> Any:
+    """Pass 状态: 把 Result 按 ResultPath 写入上下文"""
+    state_def: PassState = state.definition
+    if state_def.Result:
+        return set_value_by_path(context, state.result_path, copy.deepcopy(state_def.Result))
+    return context
+
+async def handle_pass_state(db: AsyncSession, wf_exec: WorkflowExecution, state: CompiledState) -> bool:
+    state_def: PassState = state.definition
+    ctx = load_context(wf_exec)
+    if state_def.Result:
+        # Result 属于缓存的模板, 写入上下文前复制一份
+        ctx.set(state.result_path, copy.deepcopy(state_def.Result))
+    return finish_state(db, wf_exec, state, ctx)
+
+async def handle_fail_state(db: AsyncSession, wf_exec: WorkflowExecution, state_def: FailState) -> bool:
+    fail_workflow(db, wf_exec, state_def.Error, state_def.Cause)
+    return False
+
+async def handle_succeed_state(db: AsyncSession, wf_exec: WorkflowExecution) -> bool:
+    wf_exec.status = "completed"
+    wf_exec.close_time = datetime.now(UTC)
+    wf_exec.result = wf_exec.memo
+    record_event(db, wf_exec, "WorkflowExecutionSucceeded")
+    return False
@@ -1,143 +1,327 @@
 # stepflow/domain/engine/path_utils.py
-# 简化的 get_value_by_path / set_value_by_path，用于 InputPath/ResultPath/OutputPath
-import copy
+# JSONPath 子集的编译与求值，用于 InputPath/ResultPath/OutputPath/ItemsPath 以及 Parameters 中的路径引用.
+# 支持: $.a.b、下标 $.a[0] / $.a[-1]、切片 $.a[1:3]、通配 $.a[*] / $.*、引号键 $['a b']
+import os
 import re
 import json
 import logging
-from typing import Any, Dict, Optional, Union
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 logger = logging.getLogger(__name__)
 
-def get_value_by_path(data: dict, path: str) -> Any:
+# 路径与字符串模板的编译缓存上限
+PATH_CACHE_SIZE = int(os.environ.get("STEPFLOW_PATH_CACHE_SIZE", "1024"))
+
+class _Wildcard:
+    """通配符段 [*] / .*"""
+
+    __slots__ = ()
+
+    def __repr__(self) -> str:
+        return "*"
+
+WILDCARD = _Wildcard()
+
+# 路径求值过程中 "不存在" 的标记, 与值为 None 区分
+_MISSING = object()
+
+# 点号后的键名允许的字符, 路径解析与模板中的引用识别共用
+_NAME_CHARS = r"[A-Za-z0-9_\-]"
+
+# 路径的一个段: .name / .* / ['name'] / [0] / [1:3] / [*]
+_SEGMENT_RE = re.compile(
+    r"""\.(?P<name>""" + _NAME_CHARS + r"""+)
+      | \.(?P<dot_star>\*)
+      | \[\s*(?:'(?P<squoted>[^']*)'|"(?P<dquoted>[^"]*)")\s*\]
+      | \[\s*(?P<star>\*)\s*\]
+      | \[\s*(?P<slice>-?\d*\s*:\s*-?\d*)\s*\]
+      | \[\s*(?P<index>-?\d+)\s*\]""",
+    re.VERBOSE,
+)
+
+# 字符串中嵌入的路径引用, 例如 "Hello, $.user.name!" 或 "$.items[0].id"
+_REFERENCE_RE = re.compile(
+    r"\$(?:\." + _NAME_CHARS + r"+|\.\*|\[(?:\*|-?\d+|-?\d*:-?\d*|'[^']*'|\"[^\"]*\")\])+"
+)
+
+class JsonPath(tuple):
+    """
+    编译后的路径: 段的元组 (str 键、int 下标、slice 切片或 WILDCARD).
+    纯键路径与 compile_path 之前返回的键元组相等, 例如 compile_path("$.a.b") == ("a", "b")
+    """
+
+    def __new__(cls, segments=()):
+        path = super().__new__(cls, segments)
+        # 只包含键/下标的路径可以直接逐段取值, 无需投影
+        path.projecting = any(s is WILDCARD or isinstance(s, slice) for s in path)
+        return path
+
+    def get(self, data: Any) -> Any:
+        """求值, 路径不存在时返回 None; 含通配/切片时返回匹配值的列表"""
+        if not self.projecting:
+            current = data
+            for seg in self:
+                current = _step(current, seg)
+                if current is _MISSING:
+                    return None
+            return current
+        value = self._project(data, 0)
+        return None if value is _MISSING else value
+
+    def _project(self, data: Any, i: int) -> Any:
+        if i == len(self):
+            return data
+        seg = self[i]
+        if seg is WILDCARD or isinstance(seg, slice):
+            if seg is WILDCARD and isinstance(data, dict):
+                items = list(data.values())
+            elif isinstance(data, list):
+                items = data if seg is WILDCARD else data[seg]
+            else:
+                return _MISSING
+            values = (self._project(item, i + 1) for item in items)
+            return [v for v in values if v is not _MISSING]
+        nxt = _step(data, seg)
+        if nxt is _MISSING:
+            return _MISSING
+        return self._project(nxt, i + 1)
+
+    def set(self, data: Any, value: Any) -> Any:
+        """按路径写入值 (只支持键与下标), 缺失的中间键会创建为字典"""
+        if not self:
+            return value if isinstance(value, dict) else {"value": value}
+        if self.projecting:
+            raise ValueError(f"Cannot set path {self.expression()}, wildcards and slices are read-only")
+        current = data
+        for i, seg in enumerate(self):
+            last = i == len(self) - 1
+            if isinstance(seg, int):
+                if not isinstance(current, list) or not -len(current) <= seg < len(current):
+                    raise ValueError(f"Cannot set path {self.expression()}, index {seg} is out of range")
+                if last:
+                    current[seg] = value
+                else:
+                    current = current[seg]
+                continue
+            if not isinstance(current, dict):
+                raise ValueError(f"Cannot set path {self.expression()}, intermediate {seg} is not dict")
+            if last:
+                current[seg] = value
+            else:
+                if seg not in current:
+                    current[seg] = {}
+                current = current[seg]
+        return data
+
+    def expression(self) -> str:
+        """还原为路径字符串 (用于日志与错误信息)"""
+        parts = ["$"]
+        for seg in self:
+            if seg is WILDCARD:
+                parts.append("[*]")
+            elif isinstance(seg, slice):
+                start = "" if seg.start is None else seg.start
+                stop = "" if seg.stop is None else seg.stop
+                parts.append(f"[{start}:{stop}]")
+            elif isinstance(seg, int):
+                parts.append(f"[{seg}]")
+            else:
+                parts.append(f".{seg}")
+        return "".join(parts)
+
+def _step(current: Any, seg: Any) -> Any:
+    """取一个键或下标, 不存在时返回 _MISSING"""
+    if isinstance(seg, int):
+        if isinstance(current, list) and -len(current) <= seg < len(current):
+            return current[seg]
+        return _MISSING
+    if isinstance(current, dict) and seg in current:
+        return current[seg]
+    return _MISSING
+
+@lru_cache(maxsize=PATH_CACHE_SIZE)
+def compile_path(path: Optional[str]) -> JsonPath:
+    """
+    预解析路径, 例如 "$.user.name" => ("user", "name"), "$.a[0][1:3]" => ("a", 0, slice(1, 3)),
+    "$" 或 None => ()
+
+    结果会被缓存, 编译后的模板可以直接持有返回的对象, 避免每次调用时重复解析字符串
+    """
+    if not path or path == "$":
+        return JsonPath()
+    rest = path[1:] if path.startswith("$") else "." + path.lstrip(".")
+    segments: List[Any] = []
+    pos = 0
+    while pos < len(rest):
+        if rest[pos] == ".":
+            # 兼容 "$.a..b" / "$.a." 这类多余的点
+            if pos + 1 == len(rest) or rest[pos + 1] in ".[":
+                pos += 1
+                continue
+        match = _SEGMENT_RE.match(rest, pos)
+        if not match:
+            raise ValueError(f"Invalid path '{path}' at position {pos + 1}")
+        if match.group("name") is not None:
+            segments.append(match.group("name"))
+        elif match.group("squoted") is not None or match.group("dquoted") is not None:
+            segments.append(match.group("squoted") if match.group("squoted") is not None else match.group("dquoted"))
+        elif match.group("index") is not None:
+            segments.append(int(match.group("index")))
+        elif match.group("slice") is not None:
+            start, stop = (p.strip() for p in match.group("slice").split(":"))
+            segments.append(slice(int(start) if start else None, int(stop) if stop else None))
+        else:
+            segments.append(WILDCARD)
+        pos = match.end()
+    return JsonPath(segments)
+
+def as_path(path: Union[str, Tuple, None]) -> JsonPath:
+    """把路径字符串或段元组统一转换为 JsonPath"""
+    if isinstance(path, JsonPath):
+        return path
+    if isinstance(path, tuple):
+        return JsonPath(path)
+    return compile_path(path)
+
+def get_value_by_path(data: dict, path: Union[str, Tuple[str, ...]]) -> Any:
     """
     根据路径获取数据中的值
-    
+
     Args:
         data: 要查询的数据字典
-        path: 路径，例如 "$.user.name"
-    
+        path: 路径，例如 "$.user.name"、"$.items[0]"，或 compile_path 的结果
+
     Returns:
         路径对应的值，如果路径不存在则返回 None
     """
-    if path == "$":
-        return data
-    path_keys = path.lstrip("$.").split(".")
-    current = data
-    for k in path_keys:
-        if not k:
-            continue
-        if isinstance(current, dict) and k in current:
-            current = current[k]
-        else:
-            return None
-    return current
+    return as_path(path).get(data)
 
-def set_value_by_path(data: dict, path: str, value: Any) -> dict:
+def set_value_by_path(data: dict, path: Union[str, Tuple[str, ...]], value: Any) -> dict:
     """
     根据路径设置数据中的值
-    
+
     Args:
         data: 要修改的数据字典
-        path: 路径，例如 "$.user.name"
+        path: 路径，例如 "$.user.name"，或 compile_path 的结果
         value: 要设置的值
-    
+
     Returns:
         修改后的数据字典
     """
-    if path == "$":
-        return value if isinstance(value, dict) else {"value": value}
-    path_keys = path.lstrip("$.").split(".")
-    current = data
-    for i, k in enumerate(path_keys):
-        if not k:
-            continue
-        if i == len(path_keys) - 1:
-            current[k] = value
-        else:
-            if k not in current:
-                current[k] = {}
-            current = current[k]
-            if not isinstance(current, dict):
-                raise ValueError(f"Cannot set path {path}, intermediate {k} is not dict")
-    return data
+    return as_path(path).set(data, value)
+
+def _render_value(value: Any) -> str:
+    # 如果值是字典或列表，转换为 JSON 字符串
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    # 如果值是 None，返回空字符串
+    if value is None:
+        return ""
+    # 否则，返回字符串形式的值
+    return str(value)
+
+class CompiledTemplate:
+    """预编译的字符串模板: 字面量与路径引用交替排列"""
+
+    __slots__ = ("parts",)
+
+    def __init__(self, parts: List[Union[str, JsonPath]]):
+        self.parts = parts
+
+    def render(self, data: Any) -> str:
+        return "".join(
+            part if isinstance(part, str) else _render_value(part.get(data))
+            for part in self.parts
+        )
+
+@lru_cache(maxsize=PATH_CACHE_SIZE)
+def compile_template(text: str) -> CompiledTemplate:
+    """把 "Hello, $.user.name!" 编译为 ["Hello, ", ("user", "name"), "!"]"""
+    parts: List[Union[str, JsonPath]] = []
+    pos = 0
+    for match in _REFERENCE_RE.finditer(text):
+        if match.start() > pos:
+            parts.append(text[pos:match.start()])
+        parts.append(compile_path(match.group(0)))
+        pos = match.end()
+    if pos < len(text):
+        parts.append(text[pos:])
+    return CompiledTemplate(parts)
+
+def _has_reference(value: Any) -> bool:
+    return isinstance(value, str) and ("$." in value or "$[" in value)
 
 def resolve_path_references(text: str, data: dict) -> str:
     """
     解析文本中的路径引用，例如 "Hello, $.user.name!"
-    
+
     Args:
         text: 包含路径引用的文本
         data: 数据字典
-    
+
     Returns:
         解析后的文本
     """
-    if not text or not isinstance(text, str) or "$." not in text:
+    if not _has_reference(text):
         return text
-    
+
     try:
-        # 使用正则表达式查找所有路径引用
-        pattern = r'\$\.[a-zA-Z0-9_.]+' 
-        
-        def replace_path(match):
-            path = match.group(0)
-            value = get_value_by_path(data, path)
-            
-            # 如果值是字典或列表，转换为 JSON 字符串
-            if isinstance(value, (dict, list)):
-                return json.dumps(value)
-            
-            # 如果值是 None，返回空字符串
-            if value is None:
-                return ""
-            
-            # 否则，返回字符串形式的值
-            return str(value)
-        
-        # 替换所有路径引用
-        result = re.sub(pattern, replace_path, text)
-        return result
+        return compile_template(text).render(data)
     except Exception as e:
         logger.error(f"解析路径引用时出错: {str(e)}")
         return text
 
+class CompiledParameters:
+    """
+    预编译的 Parameters 模板: 含路径引用的字符串编译为 CompiledTemplate,
+    嵌套的字典/列表递归编译, 其余值原样保留
+    """
+
+    __slots__ = ("template",)
+
+    def __init__(self, template: Any):
+        self.template = self._compile(template)
+
+    @classmethod
+    def _compile(cls, value: Any) -> Any:
+        if _has_reference(value):
+            return compile_template(value)
+        if isinstance(value, dict):
+            return {k: cls._compile(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [cls._compile(v) for v in value]
+        return value
+
+    @classmethod
+    def _render(cls, node: Any, data: Any) -> Any:
+        if isinstance(node, CompiledTemplate):
+            return node.render(data)
+        if isinstance(node, dict):
+            return {k: cls._render(v, data) for k, v in node.items()}
+        if isinstance(node, list):
+            return [cls._render(v, data) for v in node]
+        return node
+
+    def render(self, data: Any) -> Any:
+        return self._render(self.template, data)
+
 def merge_with_path_references(template: Dict[str, Any], data: Dict[str, Any]) -> Dict[str, Any]:
     """
     合并模板和数据，解析模板中的路径引用
-    
+
     Args:
         template: 包含路径引用的模板
         data: 数据字典
-    
+
     Returns:
         合并后的字典
     """
     if not template:
         return {}
-    
+
     try:
-        result = {}
-        
-        for key, value in template.items():
-            if isinstance(value, str) and "$." in value:
-                # 如果值是包含路径引用的字符串，解析它
-                result[key] = resolve_path_references(value, data)
-            elif isinstance(value, dict):
-                # 如果值是字典，递归处理
-                result[key] = merge_with_path_references(value, data)
-            elif isinstance(value, list):
-                # 如果值是列表，处理列表中的每个元素
-                result[key] = [
-                    merge_with_path_references(item, data) if isinstance(item, dict)
-                    else resolve_path_references(item, data) if isinstance(item, str) and "$." in item
-                    else item
-                    for item in value
-                ]
-            else:
-                # 其他情况，直接复制值
-                result[key] = value
-        
-        return result
+        return CompiledParameters(template).render(data)
     except Exception as e:
         logger.error(f"合并路径引用时出错: {str(e)}")
-        return template
\ No newline at end of file
+        return template
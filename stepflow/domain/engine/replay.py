@@ -1,6 +1,5 @@
 # stepflow/domain/engine/replay_async.py
 
-import json
 from typing import Tuple, Dict
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
@@ -9,6 +8,7 @@ from datetime import datetime
 from stepflow.domain.dsl_model import WorkflowDSL
 from stepflow.domain.engine.execution_engine import parse_workflow_dsl  # or local parse function
 from stepflow.infrastructure.models import WorkflowExecution, WorkflowTemplate, WorkflowEvent
+from stepflow.infrastructure import codec
 
 async def replay_workflow(db: AsyncSession, run_id: str) -> Tuple[Dict, str]:
     """
@@ -40,7 +40,7 @@ async def replay_workflow(db: AsyncSession, run_id: str) -> Tuple[Dict, str]:
         context = {}
     else:
         try:
-            context = json.loads(context_str)
+            context = codec.loads(context_str)
         except:
             context = {}
 
@@ -61,7 +61,7 @@ async def replay_workflow(db: AsyncSession, run_id: str) -> Tuple[Dict, str]:
         etype = evt.event_type
         attr_str = evt.attributes or "{}"
         try:
-            attr = json.loads(attr_str)
+            attr = codec.loads(attr_str)
         except:
             attr = {}
 
@@ -0,0 +1,79 @@
+# stepflow/domain/engine/retry.py
+# TaskState.Retry 的重试策略: 活动任务失败后按匹配的重试器计算退避时间,
+# 由 activity_retry 定时器到期后重新调度同一个任务 (attempt + 1), 不推进工作流也不改写上下文.
+# 重试用完 (或不匹配) 后, 由引擎按 TaskState.Catch 中同样的 ErrorEquals 规则选择降级路径
+
+import os
+import random
+from typing import Any, List, Optional
+
+from stepflow.domain.dsl_model import RetryPolicy, CatchDefinition
+from stepflow.infrastructure import codec
+
+# 退避时间的随机抖动比例: 实际等待 = 基础退避 * [1 - JITTER, 1 + JITTER]
+RETRY_JITTER = float(os.environ.get("STEPFLOW_RETRY_JITTER", "0.2"))
+# 单次退避的上限 (秒)
+RETRY_MAX_DELAY_SECONDS = float(os.environ.get("STEPFLOW_RETRY_MAX_DELAY_SECONDS", "3600"))
+
+# 活动任务失败的默认错误名, 工具结果中的 error_type 可以给出更具体的名称
+TASK_FAILED_ERROR = "States.TaskFailed"
+ALL_ERRORS = "States.ALL"
+# 任务超时 (心跳或执行超时), States.TaskFailed 不匹配它
+TIMEOUT_ERROR = "States.Timeout"
+# 运行时错误 (例如模板无法编译), 执行直接失败, 不经过 Retry/Catch
+RUNTIME_ERROR = "States.Runtime"
+
+def compile_retriers(retry: Optional[List[Any]]) -> List[RetryPolicy]:
+    """校验并解析 DSL 中的 Retry 列表"""
+    return [r if isinstance(r, RetryPolicy) else RetryPolicy(**r) for r in retry or []]
+
+def dumps_retriers(retriers: List[RetryPolicy]) -> Optional[str]:
+    """编码后写入 ActivityTask.retry_policy, 没有重试器时为 None"""
+    if not retriers:
+        return None
+    return codec.dumps([r.model_dump() for r in retriers])
+
+def loads_retriers(text: Optional[str]) -> List[RetryPolicy]:
+    if not text:
+        return []
+    return compile_retriers(codec.loads(text))
+
+def max_attempts(retriers: List[RetryPolicy]) -> int:
+    """任务最多执行的次数 (首次执行 + 重试)"""
+    return 1 + max((r.MaxAttempts for r in retriers), default=0)
+
+def error_matches(error_equals: List[str], error_name: Optional[str] = None) -> bool:
+    """ErrorEquals 是否匹配错误名: States.ALL 匹配一切, States.TaskFailed 匹配除内置错误之外的具体错误名"""
+    error_name = error_name or TASK_FAILED_ERROR
+    if ALL_ERRORS in error_equals or error_name in error_equals:
+        return True
+    return TASK_FAILED_ERROR in error_equals and not error_name.startswith("States.")
+
+def match_retrier(retriers: List[RetryPolicy], error_name: Optional[str] = None) -> Optional[RetryPolicy]:
+    """按声明顺序找到第一个匹配错误名的重试器"""
+    return next((r for r in retriers if error_matches(r.ErrorEquals, error_name)), None)
+
+def compile_catchers(catch: Optional[List[Any]]) -> List[CatchDefinition]:
+    """校验并解析 DSL 中的 Catch 列表"""
+    return [c if isinstance(c, CatchDefinition) else CatchDefinition(**c) for c in catch or []]
+
+def retry_delay(retrier: RetryPolicy, attempt: int, jitter: Optional[float] = None) -> float:
+    """
+    第 attempt 次执行失败后的等待时间 (秒):
+    IntervalSeconds * BackoffRate^(attempt - 1), 再乘以随机抖动, 避免大量任务同时重试
+    """
+    jitter = RETRY_JITTER if jitter is None else jitter
+    delay = retrier.IntervalSeconds * retrier.BackoffRate ** (attempt - 1)
+    if jitter > 0:
+        delay *= random.uniform(1 - jitter, 1 + jitter)
+    return max(0.0, min(delay, RETRY_MAX_DELAY_SECONDS))
+
+def next_retry_delay(retry_policy: Optional[str], attempt: int, error_name: Optional[str] = None) -> Optional[float]:
+    """
+    根据任务上记录的重试策略决定是否重试:
+    返回等待的秒数, 返回 None 表示重试次数已用完或没有匹配的重试器
+    """
+    retrier = match_retrier(loads_retriers(retry_policy), error_name)
+    if retrier is None or attempt > retrier.MaxAttempts:
+        return None
+    return retry_delay(retrier, attempt)
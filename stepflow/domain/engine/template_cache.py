@@ -0,0 +1,262 @@
+# stepflow/domain/engine/template_cache.py
+# 进程级的已编译模板缓存: 按 (template_id, version) 缓存校验过的状态图,
+# 避免每次推进工作流都重新 json.loads + pydantic 校验整个 DSL
+
+import os
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from stepflow.domain.dsl_model import WorkflowDSL, TaskState, ChoiceState, ChoiceRule, WaitState, ParallelState, MapState, RetryPolicy, CatchDefinition
+from stepflow.domain.engine.path_utils import compile_path, CompiledParameters
+from stepflow.domain.engine.retry import compile_retriers, dumps_retriers, compile_catchers
+from stepflow.infrastructure.repositories.workflow_template_repository import WorkflowTemplateRepository
+from stepflow.infrastructure import codec
+
+logger = logging.getLogger(__name__)
+
+# 缓存的模板版本数上限
+TEMPLATE_CACHE_SIZE = int(os.environ.get("STEPFLOW_TEMPLATE_CACHE_SIZE", "128"))
+
+# Map Iterator 中允许出现的状态类型: 纯数据变换状态 + Task
+ITERATOR_STATE_TYPES = {"Pass", "Choice", "Succeed", "Fail", "Task"}
+
+class CompiledChoice:
+    """预编译的 Choice 规则"""
+
+    __slots__ = ("rule", "variable", "next_state")
+
+    def __init__(self, rule: ChoiceRule):
+        self.rule = rule
+        self.variable = compile_path(rule.Variable)
+        self.next_state = rule.Next
+
+class CompiledCatcher:
+    """预编译的 Catch 规则"""
+
+    __slots__ = ("catcher", "error_equals", "result_path", "next_state")
+
+    def __init__(self, catcher: CatchDefinition):
+        self.catcher = catcher
+        self.error_equals = catcher.ErrorEquals
+        self.result_path = compile_path(catcher.ResultPath)
+        self.next_state = catcher.Next
+
+class CompiledState:
+    """预编译的状态节点: 状态对象 + 已解析的出边 + 预编译路径"""
+
+    __slots__ = (
+        "name", "definition", "type", "input_path", "output_path",
+        "result_path", "next_state", "end", "choices", "default", "branches",
+        "iterator", "items_path", "max_concurrency", "parameters",
+        "retriers", "retry_policy", "catchers", "seconds_path", "timestamp_path",
+    )
+
+    def __init__(self, name: str, definition: Any):
+        self.name = name
+        self.definition = definition
+        self.type = definition.Type
+        # 路径缺省为 "$"
+        self.input_path = compile_path(definition.InputPath)
+        self.output_path = compile_path(definition.OutputPath)
+        self.result_path = compile_path(definition.ResultPath)
+        self.next_state = definition.Next
+        self.end = bool(definition.End)
+        self.choices: List[CompiledChoice] = []
+        self.default: Optional[str] = None
+        self.branches: List[CompiledGraph] = []
+        self.iterator: Optional[CompiledGraph] = None
+        self.items_path: Tuple[str, ...] = ()
+        self.max_concurrency = 0
+        self.parameters: Optional[CompiledParameters] = None
+        self.retriers: List[RetryPolicy] = []
+        # 编码好的重试策略, 调度任务时直接写入 ActivityTask.retry_policy
+        self.retry_policy: Optional[str] = None
+        self.catchers: List[CompiledCatcher] = []
+        # Wait 的 SecondsPath/TimestampPath (相对于 InputPath 选出的输入)
+        self.seconds_path: Optional[Tuple[str, ...]] = None
+        self.timestamp_path: Optional[Tuple[str, ...]] = None
+        if isinstance(definition, TaskState):
+            if isinstance(definition.Parameters, dict):
+                self.parameters = CompiledParameters(definition.Parameters)
+            self.retriers = compile_retriers(definition.Retry)
+            self.retry_policy = dumps_retriers(self.retriers)
+            self.catchers = [CompiledCatcher(c) for c in compile_catchers(definition.Catch)]
+        elif isinstance(definition, ChoiceState):
+            self.choices = [CompiledChoice(ChoiceRule(**c)) for c in definition.Choices]
+            self.default = definition.Default
+        elif isinstance(definition, WaitState):
+            durations = [definition.Seconds, definition.SecondsPath, definition.Timestamp, definition.TimestampPath]
+            if sum(d is not None for d in durations) > 1:
+                raise ValueError(f"Wait state '{name}' must specify only one of Seconds, SecondsPath, Timestamp, TimestampPath")
+            if definition.SecondsPath:
+                self.seconds_path = compile_path(definition.SecondsPath)
+            if definition.TimestampPath:
+                self.timestamp_path = compile_path(definition.TimestampPath)
+        elif isinstance(definition, ParallelState):
+            self.branches = [CompiledGraph(b.StartAt, b.States) for b in definition.Branches]
+        elif isinstance(definition, MapState):
+            self.iterator = CompiledGraph(definition.Iterator.StartAt, definition.Iterator.States)
+            self.items_path = compile_path(definition.ItemsPath)
+            self.max_concurrency = definition.MaxConcurrency
+
+    def edges(self) -> List[str]:
+        """该状态所有可能的后继状态名"""
+        targets = [c.next_state for c in self.choices]
+        if self.default:
+            targets.append(self.default)
+        if self.next_state:
+            targets.append(self.next_state)
+        targets.extend(c.next_state for c in self.catchers)
+        return targets
+
+class CompiledGraph:
+    """按名称索引的状态图 (顶层工作流或 Parallel 分支)"""
+
+    def __init__(self, start_at: str, states: Dict[str, Any]):
+        self.start_at = start_at
+        self.states: Dict[str, CompiledState] = {
+            name: CompiledState(name, state_def) for name, state_def in states.items()
+        }
+
+    def validate(self) -> None:
+        """校验 StartAt 以及所有 Next/Default 指向的状态都存在 (递归校验分支)"""
+        if self.start_at not in self.states:
+            raise ValueError(f"StartAt state '{self.start_at}' is not defined")
+        for state in self.states.values():
+            for target in state.edges():
+                if target not in self.states:
+                    raise ValueError(f"State '{state.name}' transitions to undefined state '{target}'")
+            for branch in state.branches:
+                branch.validate()
+            if state.iterator is not None:
+                state.iterator.validate()
+                state.iterator.validate_iterator()
+
+    def validate_iterator(self) -> None:
+        """
+        Map Iterator 的额外约束: 每个元素的活动任务以 seq 一一对应,
+        因此 Iterator 只能包含纯数据状态与 Task, 且任意路径上最多经过一个 Task
+        """
+        for state in self.states.values():
+            if state.type not in ITERATOR_STATE_TYPES:
+                raise ValueError(f"State type '{state.type}' is not supported inside a Map Iterator")
+        for state in self.states.values():
+            if state.type != "Task":
+                continue
+            pending = list(state.edges())
+            seen = set()
+            while pending:
+                name = pending.pop()
+                if name in seen:
+                    continue
+                seen.add(name)
+                if self.states[name].type == "Task":
+                    raise ValueError(f"Map Iterator path from '{state.name}' reaches a second Task '{name}'")
+                pending.extend(self.states[name].edges())
+
+class CompiledWorkflow(CompiledGraph):
+    """已编译的工作流"""
+
+    def __init__(self, template_id: str, version: int, dsl: WorkflowDSL, digest: Optional[str] = None):
+        super().__init__(dsl.StartAt, dsl.States)
+        self.template_id = template_id
+        self.version = version
+        self.digest = digest
+        self.dsl = dsl
+        self._branch_graphs: Dict[str, CompiledGraph] = {}
+
+    def graph_for(self, branch_path: Optional[str]) -> CompiledGraph:
+        """
+        根据分支路径获取子图, 例如 "Fetch/0" 或嵌套的 "Fetch/0/Inner/1";
+        空路径返回顶层工作流
+        """
+        if not branch_path:
+            return self
+        graph = self._branch_graphs.get(branch_path)
+        if graph is None:
+            graph = self
+            parts = branch_path.split("/")
+            for state_name, index in zip(parts[0::2], parts[1::2]):
+                graph = graph.states[state_name].branches[int(index)]
+            self._branch_graphs[branch_path] = graph
+        return graph
+
+def compile_workflow(template_id: str, version: int, dsl_text: str, digest: Optional[str] = None) -> CompiledWorkflow:
+    """解析并校验 DSL, 生成 CompiledWorkflow"""
+    dsl = WorkflowDSL(**codec.loads(dsl_text))
+    compiled = CompiledWorkflow(template_id, version, dsl, digest)
+    compiled.validate()
+    return compiled
+
+class TemplateCache:
+    """
+    按 (template_id, version, dsl_digest) 缓存 CompiledWorkflow, LRU 淘汰.
+    invalidate 只作用于当前进程; 键中的 DSL 摘要保证模板被删除后重建 (version 重新从 1 开始) 时,
+    其他进程也会重新编译而不是继续执行旧的 DSL
+    """
+
+    def __init__(self, max_size: int = TEMPLATE_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries: "OrderedDict[Tuple[str, int, Optional[str]], CompiledWorkflow]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, template_id: str, version: int, digest: Optional[str] = None) -> Optional[CompiledWorkflow]:
+        key = (template_id, version, digest)
+        compiled = self._entries.get(key)
+        if compiled is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return compiled
+
+    def put(self, compiled: CompiledWorkflow) -> None:
+        key = (compiled.template_id, compiled.version, compiled.digest)
+        self._entries[key] = compiled
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, template_id: str) -> int:
+        """移除某个模板的所有版本, 返回移除的条目数"""
+        keys = [k for k in self._entries if k[0] == template_id]
+        for k in keys:
+            del self._entries[k]
+        return len(keys)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    async def load(self, db: AsyncSession, template_id: str) -> Optional[CompiledWorkflow]:
+        """
+        获取模板的已编译版本:
+        命中时只查询一次 (version, dsl_digest), 未命中时才读取 dsl_definition 并编译
+        """
+        repo = WorkflowTemplateRepository(db)
+        cache_key = await repo.get_cache_key(template_id)
+        if cache_key is None:
+            return None
+
+        compiled = self.get(template_id, *cache_key)
+        if compiled is not None:
+            return compiled
+
+        tpl = await repo.get_by_id(template_id)
+        if tpl is None:
+            return None
+        compiled = compile_workflow(tpl.template_id, tpl.version, tpl.dsl_definition, tpl.dsl_digest)
+        self.put(compiled)
+        logger.debug(f"已编译模板 {template_id} (version={tpl.version})")
+        return compiled
+
+# 进程级共享实例
+template_cache = TemplateCache()
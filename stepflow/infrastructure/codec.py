@@ -0,0 +1,202 @@
+# stepflow/infrastructure/codec.py
+# 统一的 JSON 编解码层: 所有读写 input/result/memo/attributes 等 JSON 文本列的地方都通过这里,
+# 安装了 orjson/msgspec 时使用更快的后端, 否则回退到标准库 json.
+# 另外提供载荷编码: 超过阈值的载荷压缩后存储 (安装了 zstandard 时用 zstd, 否则 zlib),
+# 编码方式记录在 *_version 列中, 旧的明文行 (version 1) 始终可读
+
+import os
+import json
+import zlib
+import base64
+import logging
+from typing import Any, Callable, Optional, Tuple, Union
+
+from sqlalchemy.ext.hybrid import hybrid_property
+
+logger = logging.getLogger(__name__)
+
+# auto | orjson | msgspec | stdlib
+JSON_BACKEND = os.environ.get("STEPFLOW_JSON_BACKEND", "auto").lower()
+# 载荷 (UTF-8 字节数) 超过该阈值时压缩存储, 0 表示不压缩
+PAYLOAD_COMPRESS_THRESHOLD = int(os.environ.get("STEPFLOW_PAYLOAD_COMPRESS_THRESHOLD", "4096"))
+# auto | zstd | zlib, auto 在安装了 zstandard 时使用 zstd
+PAYLOAD_COMPRESSION = os.environ.get("STEPFLOW_PAYLOAD_COMPRESSION", "auto").lower()
+PAYLOAD_ZLIB_LEVEL = int(os.environ.get("STEPFLOW_PAYLOAD_ZLIB_LEVEL", "6"))
+PAYLOAD_ZSTD_LEVEL = int(os.environ.get("STEPFLOW_PAYLOAD_ZSTD_LEVEL", "3"))
+
+# *_version 列的取值
+PAYLOAD_JSON = 1        # 明文 JSON 文本
+PAYLOAD_ZLIB = 2        # zlib 压缩后 base64 编码的 JSON 文本
+PAYLOAD_ZSTD = 3        # zstd 压缩后 base64 编码的 JSON 文本
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 解码失败时抛出的异常 (所有后端都会转换为该类型)
+JSONDecodeError = json.JSONDecodeError
+
+def _stdlib_dumps(obj: Any) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+def _stdlib_loads(text: Union[str, bytes]) -> Any:
+    return json.loads(text)
+
+def _load_orjson() -> Optional[Tuple[Callable, Callable]]:
+    try:
+        import orjson
+    except ImportError:
+        return None
+
+    option = orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj: Any) -> str:
+        try:
+            return orjson.dumps(obj, option=option).decode("utf-8")
+        except TypeError:
+            # 超出 64 位的整数等 orjson 不支持的值交给标准库处理
+            return _stdlib_dumps(obj)
+
+    # orjson.JSONDecodeError 本身就是 json.JSONDecodeError 的子类
+    return dumps, orjson.loads
+
+def _load_msgspec() -> Optional[Tuple[Callable, Callable]]:
+    try:
+        import msgspec
+    except ImportError:
+        return None
+
+    encoder = msgspec.json.Encoder()
+    decoder = msgspec.json.Decoder()
+
+    def dumps(obj: Any) -> str:
+        try:
+            return encoder.encode(obj).decode("utf-8")
+        except (TypeError, OverflowError):
+            return _stdlib_dumps(obj)
+
+    def loads(text: Union[str, bytes]) -> Any:
+        try:
+            return decoder.decode(text)
+        except msgspec.DecodeError as e:
+            raise JSONDecodeError(str(e), text if isinstance(text, str) else "", 0) from None
+
+    return dumps, loads
+
+def _select_backend(name: str) -> Tuple[str, Callable, Callable]:
+    loaders = {"orjson": _load_orjson, "msgspec": _load_msgspec}
+    if name in loaders:
+        loaded = loaders[name]()
+        if loaded is not None:
+            return (name,) + loaded
+        logger.warning(f"JSON 后端 {name} 未安装, 回退到标准库 json")
+    elif name == "auto":
+        for candidate in ("orjson", "msgspec"):
+            loaded = loaders[candidate]()
+            if loaded is not None:
+                return (candidate,) + loaded
+    elif name != "stdlib":
+        logger.warning(f"未知的 JSON 后端 {name}, 回退到标准库 json")
+    return "stdlib", _stdlib_dumps, _stdlib_loads
+
+backend, _dumps, _loads = _select_backend(JSON_BACKEND)
+
+def dumps(obj: Any) -> str:
+    """序列化为紧凑的 JSON 文本"""
+    return _dumps(obj)
+
+def loads(text: Union[str, bytes]) -> Any:
+    """解析 JSON 文本, 失败时抛出 JSONDecodeError"""
+    return _loads(text)
+
+def _compress_zlib(raw: bytes) -> bytes:
+    return zlib.compress(raw, PAYLOAD_ZLIB_LEVEL)
+
+def _compress_zstd(raw: bytes) -> bytes:
+    return zstandard.ZstdCompressor(level=PAYLOAD_ZSTD_LEVEL).compress(raw)
+
+def _decompress_zlib(packed: bytes) -> bytes:
+    return zlib.decompress(packed)
+
+def _decompress_zstd(packed: bytes) -> bytes:
+    if zstandard is None:
+        raise RuntimeError("Payload is zstd-compressed but the zstandard package is not installed")
+    return zstandard.ZstdDecompressor().decompress(packed)
+
+_COMPRESSORS = {PAYLOAD_ZLIB: _compress_zlib, PAYLOAD_ZSTD: _compress_zstd}
+_DECOMPRESSORS = {PAYLOAD_ZLIB: _decompress_zlib, PAYLOAD_ZSTD: _decompress_zstd}
+
+def _select_compression(name: str) -> int:
+    if name in ("auto", "zstd") and zstandard is not None:
+        return PAYLOAD_ZSTD
+    if name == "zstd":
+        logger.warning("zstandard 未安装, 载荷压缩回退到 zlib")
+    return PAYLOAD_ZLIB
+
+compression = _select_compression(PAYLOAD_COMPRESSION)
+
+def encode_payload(
+    text: Optional[str],
+    threshold: Optional[int] = None,
+    method: Optional[int] = None
+) -> Tuple[Optional[str], int]:
+    """
+    把 JSON 文本编码为列中存储的形式, 返回 (存储值, 版本号).
+    不超过阈值或压缩收益不足时原样存储 (PAYLOAD_JSON).
+    列类型是 TEXT (Postgres 的 TEXT 不能存二进制), 压缩结果以 base64 存储
+    """
+    if threshold is None:
+        threshold = PAYLOAD_COMPRESS_THRESHOLD
+    if text is None or threshold <= 0 or len(text) <= threshold // 4:
+        return text, PAYLOAD_JSON
+    raw = text.encode("utf-8")
+    if len(raw) <= threshold:
+        return text, PAYLOAD_JSON
+    method = method or compression
+    packed = base64.b64encode(_COMPRESSORS[method](raw)).decode("ascii")
+    if len(packed) >= len(raw):
+        # 压缩后反而更大 (随机数据等), 不值得
+        return text, PAYLOAD_JSON
+    return packed, method
+
+def decode_payload(stored: Optional[str], version: Optional[int]) -> Optional[str]:
+    """把列中存储的值还原为 JSON 文本"""
+    if stored is None or not version or version == PAYLOAD_JSON:
+        return stored
+    decompress = _DECOMPRESSORS.get(version)
+    if decompress is None:
+        raise ValueError(f"Unsupported payload version {version}")
+    return decompress(base64.b64decode(stored)).decode("utf-8")
+
+def payload_column(column_attr: str, version_attr: str) -> hybrid_property:
+    """
+    为模型生成透明编解码的载荷属性:
+    实例上读写的始终是 JSON 文本, 实际存储值与编码版本分别保存在 column_attr 与 version_attr 中;
+    在类上访问时返回底层列, 可直接用于查询.
+
+    解压是惰性的: 只在第一次读取该属性时进行, 结果按存储值缓存在实例上,
+    存储值不变时重复读取返回同一个字符串对象
+    """
+    cache_attr = f"{column_attr}_decoded"
+
+    def fget(self) -> Optional[str]:
+        stored = getattr(self, column_attr)
+        cached = self.__dict__.get(cache_attr)
+        if cached is not None and cached[0] is stored:
+            return cached[1]
+        text = decode_payload(stored, getattr(self, version_attr))
+        self.__dict__[cache_attr] = (stored, text)
+        return text
+
+    def fset(self, value: Optional[str]) -> None:
+        stored, version = encode_payload(value)
+        setattr(self, column_attr, stored)
+        setattr(self, version_attr, version)
+        # 刚写入的文本无需再解压
+        self.__dict__[cache_attr] = (stored, value)
+
+    def expr(cls):
+        return getattr(cls, column_attr)
+
+    return hybrid_property(fget, fset, expr=expr)
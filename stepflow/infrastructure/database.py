@@ -1,33 +1,224 @@
 # stepflow/infrastructure/database.py
 
 import os
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from typing import Any, Dict
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, AsyncEngine
 from sqlalchemy.orm import sessionmaker, declarative_base
 
 ENV = os.getenv("STEPFLOW_ENV", "dev")
 
 if ENV == "test":
     # 测试环境用异步SQLite内存库 或 stepflow_test.db
-    DATABASE_URL = "sqlite+aiosqlite:///:memory:"
+    DEFAULT_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
     # 你也可改成文件形式 => "sqlite+aiosqlite:///stepflow_test.db"
 else:
     # 开发或生产环境用 stepflow.db (异步)
-    DATABASE_URL = "sqlite+aiosqlite:///stepflow.db"
+    DEFAULT_DATABASE_URL = "sqlite+aiosqlite:///stepflow.db"
+
+# 异步驱动: 未指定驱动的 URL 自动补上
+ASYNC_DRIVERS = {"sqlite": "aiosqlite", "postgresql": "asyncpg"}
+
+def normalize_database_url(url: str) -> str:
+    """
+    把 DATABASE_URL 规范为异步驱动的形式, 例如
+    postgres://... / postgresql://... => postgresql+asyncpg://..., sqlite:///x.db => sqlite+aiosqlite:///x.db
+    """
+    if url.startswith("postgres://"):
+        url = "postgresql://" + url[len("postgres://"):]
+    scheme, sep, rest = url.partition("://")
+    if sep and "+" not in scheme and scheme in ASYNC_DRIVERS:
+        url = f"{scheme}+{ASYNC_DRIVERS[scheme]}://{rest}"
+    return url
+
+def sync_database_url(url: str) -> str:
+    """对应的同步驱动 URL (Alembic 离线模式等场景使用)"""
+    scheme, sep, rest = url.partition("://")
+    return f"{scheme.split('+')[0]}{sep}{rest}"
+
+# 例如 DATABASE_URL=postgresql://user:pass@db:5432/stepflow
+DATABASE_URL = normalize_database_url(os.environ.get("DATABASE_URL") or DEFAULT_DATABASE_URL)
+
+# -----------------------
+# SQLite 存储配置
+# -----------------------
+# wal: WAL 日志 + synchronous=NORMAL, 读写互不阻塞, 提交时不做完整 fsync (掉电最多丢失最近的提交)
+# durable: WAL 日志 + synchronous=FULL, 每次提交都 fsync
+# off: 不设置任何 PRAGMA, 使用 SQLite 默认值
+SQLITE_PROFILE = os.environ.get("STEPFLOW_SQLITE_PROFILE", "wal").lower()
+
+SQLITE_PROFILES: Dict[str, Dict[str, Any]] = {
+    "wal": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,     # 负数表示 KiB, 即 64MB
+        "busy_timeout": 5000,         # 毫秒, 写锁被占用时等待而不是立即报 database is locked
+        "temp_store": "MEMORY",
+    },
+    "durable": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,
+        "busy_timeout": 5000,
+        "temp_store": "MEMORY",
+    },
+    "off": {},
+}
+
+# 单个 PRAGMA 可以通过环境变量覆盖, 例如 STEPFLOW_SQLITE_SYNCHRONOUS=FULL
+SQLITE_PRAGMA_NAMES = ("journal_mode", "synchronous", "mmap_size", "cache_size", "busy_timeout", "temp_store")
+
+# 写连接池: 每个进程只有一个写连接, 进程内的写会话在连接池上排队 (POOL_TIMEOUT 内等待);
+# 同一调用链不能同时持有两个写会话, 否则会等满 POOL_TIMEOUT.
+# 写事务以 BEGIN IMMEDIATE 开始, 多个进程之间在 busy_timeout 内排队获取写锁,
+# 而不是先读后写时在提交阶段报 SQLITE_BUSY (BUSY_SNAPSHOT)
+SQLITE_WRITE_POOL_SIZE = int(os.environ.get("STEPFLOW_SQLITE_WRITE_POOL_SIZE", "1"))
+SQLITE_WRITE_MAX_OVERFLOW = int(os.environ.get("STEPFLOW_SQLITE_WRITE_MAX_OVERFLOW", "0"))
+# 只读连接池: WAL 模式下读连接不阻塞写连接
+SQLITE_READ_POOL_SIZE = int(os.environ.get("STEPFLOW_SQLITE_READ_POOL_SIZE", "4"))
+SQLITE_READ_MAX_OVERFLOW = int(os.environ.get("STEPFLOW_SQLITE_READ_MAX_OVERFLOW", "4"))
+
+POOL_TIMEOUT = int(os.environ.get("STEPFLOW_DB_POOL_TIMEOUT", "30"))
+
+# -----------------------
+# 客户端/服务端数据库 (PostgreSQL 等) 连接池
+# -----------------------
+# 每个 API/worker 进程的连接数上限为 POOL_SIZE + MAX_OVERFLOW, 水平扩容时注意数据库的 max_connections
+DB_POOL_SIZE = int(os.environ.get("STEPFLOW_DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.environ.get("STEPFLOW_DB_MAX_OVERFLOW", "10"))
+# 定期回收连接, 避免被负载均衡/防火墙静默断开
+DB_POOL_RECYCLE = int(os.environ.get("STEPFLOW_DB_POOL_RECYCLE", "1800"))
+# asyncpg 预编译语句缓存 (每个连接); 经过 pgbouncer 事务池时设为 0
+PG_STATEMENT_CACHE_SIZE = int(os.environ.get("STEPFLOW_PG_STATEMENT_CACHE_SIZE", "256"))
+
+def sqlite_pragmas(profile: str = SQLITE_PROFILE) -> Dict[str, Any]:
+    """按配置名取 PRAGMA 集合, 再叠加环境变量中的单项覆盖"""
+    if profile not in SQLITE_PROFILES:
+        raise ValueError(f"Unknown SQLite profile '{profile}', expected one of {sorted(SQLITE_PROFILES)}")
+    pragmas = dict(SQLITE_PROFILES[profile])
+    for name in SQLITE_PRAGMA_NAMES:
+        override = os.environ.get(f"STEPFLOW_SQLITE_{name.upper()}")
+        if override:
+            pragmas[name] = override
+    return pragmas
+
+def _is_memory_sqlite(url: str) -> bool:
+    return url.startswith("sqlite") and (":memory:" in url or url.rstrip("/").endswith(":"))
+
+def _install_sqlite_pragmas(engine: AsyncEngine, pragmas: Dict[str, Any], read_only: bool = False) -> None:
+    """每个新建的 DBAPI 连接上执行 PRAGMA (mmap_size/cache_size 等是连接级设置)"""
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def _apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+            if read_only:
+                cursor.execute("PRAGMA query_only=ON")
+        finally:
+            cursor.close()
+
+def _begin_immediate(engine: AsyncEngine) -> None:
+    """
+    写引擎的事务一开始就获取写锁 (BEGIN IMMEDIATE):
+    默认的 DEFERRED 事务先读后写, 另一个连接在此期间提交过时升级写锁会直接失败, 不会等待 busy_timeout
+    """
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def _disable_implicit_begin(dbapi_connection, connection_record):
+        # 由下面的 begin 事件显式开始事务
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine.sync_engine, "begin")
+    def _emit_begin(conn):
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+def create_engines(url: str):
+    """
+    按方言创建 (写引擎, 读引擎):
+    - SQLite 文件库: 单写连接 (BEGIN IMMEDIATE) + 只读连接池, 两者都在连接时应用 PRAGMA
+    - SQLite 内存库: 每个连接都是独立的库, 只能共享同一个连接 (StaticPool)
+    - PostgreSQL (asyncpg): 读写各自一个连接池, 只读池可通过 DATABASE_READ_URL 指向只读副本
+    - 其他方言: 读写共用一个连接池
+    """
+    if _is_memory_sqlite(url):
+        engine = create_async_engine(url, echo=False, future=True, poolclass=StaticPool)
+        return engine, engine
+
+    if url.startswith("sqlite"):
+        pragmas = sqlite_pragmas()
+        write_engine = create_async_engine(
+            url,
+            echo=False,
+            future=True,
+            pool_size=SQLITE_WRITE_POOL_SIZE,
+            max_overflow=SQLITE_WRITE_MAX_OVERFLOW,
+            pool_timeout=POOL_TIMEOUT,
+        )
+        _install_sqlite_pragmas(write_engine, pragmas)
+        _begin_immediate(write_engine)
+        read_engine = create_async_engine(
+            url,
+            echo=False,
+            future=True,
+            pool_size=SQLITE_READ_POOL_SIZE,
+            max_overflow=SQLITE_READ_MAX_OVERFLOW,
+            pool_timeout=POOL_TIMEOUT,
+        )
+        _install_sqlite_pragmas(read_engine, pragmas, read_only=True)
+        return write_engine, read_engine
+
+    if url.startswith("postgresql+asyncpg"):
+        return _create_postgres_engine(url), _create_postgres_engine(url, read_only=True)
+
+    engine = create_async_engine(
+        url,
+        echo=False,  # 需要查看SQL可设True
+        future=True,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        # 启用连接池预热
+        pool_pre_ping=True,
+    )
+    return engine, engine
+
+def _create_postgres_engine(url: str, read_only: bool = False) -> AsyncEngine:
+    """
+    asyncpg 引擎: SQLAlchemy 层与 asyncpg 层都缓存预编译语句;
+    只读引擎的会话默认以只读事务执行, 部署了只读副本时可以单独指向副本
+    """
+    if read_only and os.environ.get("DATABASE_READ_URL"):
+        url = normalize_database_url(os.environ["DATABASE_READ_URL"])
+    parsed = make_url(url)
+    if "prepared_statement_cache_size" not in parsed.query:
+        parsed = parsed.update_query_dict({"prepared_statement_cache_size": str(PG_STATEMENT_CACHE_SIZE)})
+    server_settings = {"application_name": os.environ.get("STEPFLOW_DB_APPLICATION_NAME", "stepflow")}
+    if read_only:
+        server_settings["default_transaction_read_only"] = "on"
+    return create_async_engine(
+        parsed,
+        echo=False,
+        future=True,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=True,
+        connect_args={
+            "statement_cache_size": PG_STATEMENT_CACHE_SIZE,
+            "server_settings": server_settings,
+        },
+    )
 
 # 重命名为 async_engine，方便外部导入
-async_engine = create_async_engine(
-    DATABASE_URL,
-    echo=False,  # 需要查看SQL可设True
-    future=True,
-    # 增加连接池大小
-    pool_size=20,
-    max_overflow=40,
-    # 设置连接超时
-    pool_timeout=30,
-    # 启用连接池预热
-    pool_pre_ping=True,
-    # connect_args={"check_same_thread": False}, # aiosqlite时一般不必
-)
+async_engine, async_read_engine = create_engines(DATABASE_URL)
 
 AsyncSessionLocal = sessionmaker(
     bind=async_engine,
@@ -37,6 +228,14 @@ AsyncSessionLocal = sessionmaker(
     autoflush=True
 )
 
+# 只读会话: 用于纯查询的接口, 不能写入 (SQLite 下连接设置了 query_only)
+AsyncReadSessionLocal = sessionmaker(
+    bind=async_read_engine,
+    expire_on_commit=False,
+    class_=AsyncSession,
+    autoflush=False
+)
+
 Base = declarative_base()
 
 async def get_db_session():
@@ -53,5 +252,19 @@ async def get_db_session():
         finally:
             await db.close()
 
-# 确保这个变量被定义
-SQLALCHEMY_DATABASE_URL = "sqlite:///stepflow.db"
\ No newline at end of file
+async def get_read_db_session():
+    """只读接口使用的会话依赖, 用法同 get_db_session"""
+    async with AsyncReadSessionLocal() as db:
+        try:
+            yield db
+        finally:
+            await db.close()
+
+async def dispose_engines() -> None:
+    """关闭连接池 (应用退出时调用)"""
+    await async_engine.dispose()
+    if async_read_engine is not async_engine:
+        await async_read_engine.dispose()
+
+# 同步驱动的 URL (migrations/env.py 使用)
+SQLALCHEMY_DATABASE_URL = sync_database_url(DATABASE_URL)
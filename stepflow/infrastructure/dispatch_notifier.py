@@ -0,0 +1,90 @@
+# stepflow/infrastructure/dispatch_notifier.py
+# 进程内的派发通知通道: 写入 ActivityTask/Timer 并提交后唤醒空闲的 worker,
+# 轮询只作为兜底 (例如其他进程写入的任务)
+
+import os
+import asyncio
+from typing import Dict, Set
+
+ACTIVITY_CHANNEL = "activity"
+TIMER_CHANNEL = "timer"
+
+# 兜底轮询间隔 (秒): 空轮询时从最小值开始逐步翻倍到最大值
+POLL_MIN_INTERVAL = float(os.environ.get("STEPFLOW_POLL_MIN_INTERVAL", "0.2"))
+POLL_MAX_INTERVAL = float(os.environ.get("STEPFLOW_POLL_MAX_INTERVAL", "5"))
+
+class DispatchNotifier:
+    """
+    按通道唤醒等待中的 worker.
+    notify 时如果没有 worker 在等待, 会记下一个待处理标记,
+    下一次 wait 立即返回, 避免 worker 正忙时丢失通知
+    """
+
+    def __init__(self):
+        self._waiters: Dict[str, Set[asyncio.Future]] = {}
+        self._pending: Set[str] = set()
+
+    def notify(self, channel: str) -> None:
+        """唤醒该通道上所有等待中的 worker"""
+        waiters = self._waiters.pop(channel, set())
+        woke = False
+        for fut in waiters:
+            if not fut.done():
+                fut.set_result(True)
+                woke = True
+        if not woke:
+            self._pending.add(channel)
+
+    async def wait(self, channel: str, timeout: float) -> bool:
+        """等待通知, 返回 True 表示被通知唤醒, False 表示超时"""
+        if channel in self._pending:
+            self._pending.discard(channel)
+            return True
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(channel, set()).add(fut)
+        try:
+            return await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            waiters = self._waiters.get(channel)
+            if waiters is not None:
+                waiters.discard(fut)
+
+class AdaptivePoller:
+    """
+    自适应的兜底轮询:
+    - 拿到满批 => 不等待, 立即再取
+    - 拿到部分批 => 间隔重置为最小值
+    - 空轮询 => 间隔翻倍, 直到最大值
+    等待期间收到通知会立即醒来
+    """
+
+    def __init__(
+        self,
+        notifier: DispatchNotifier,
+        channel: str,
+        min_interval: float = POLL_MIN_INTERVAL,
+        max_interval: float = POLL_MAX_INTERVAL
+    ):
+        self.notifier = notifier
+        self.channel = channel
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+
+    async def wait(self, fetched: int, batch_size: int) -> None:
+        """根据本轮取到的数量决定下一轮之前的等待时间"""
+        if batch_size and fetched >= batch_size:
+            self.interval = self.min_interval
+            return
+        if fetched:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+        if await self.notifier.wait(self.channel, self.interval):
+            # 有新的写入, 下一次空轮询从最小间隔重新开始退避
+            self.interval = self.min_interval
+
+# 进程级共享实例
+dispatch_notifier = DispatchNotifier()
@@ -0,0 +1,66 @@
+# stepflow/infrastructure/event_writer.py
+# 工作流事件的写后缓冲: 一次推进 (一个会话事务) 中产生的事件先暂存在 session.info 中,
+# 提交前用一条多行 INSERT 一次写入, 代替逐条 add/flush.
+# event_id 取自 WorkflowExecution.current_event_id 并在同一事务中递增,
+# 执行行本身按 version 比较并交换, 因此同一 run 的 event_id 单调且不会重复
+
+import os
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import event, insert
+from sqlalchemy.orm import Session
+
+from stepflow.infrastructure import codec
+from stepflow.infrastructure.models import WorkflowEvent, WorkflowExecution
+
+# 单条 INSERT 最多携带的事件行数 (受 SQLite 绑定参数数量上限约束)
+EVENT_BATCH_SIZE = int(os.environ.get("STEPFLOW_EVENT_BATCH_SIZE", "500"))
+
+PENDING_EVENTS_KEY = "pending_workflow_events"
+
+def buffer_event(
+    session: Any,
+    wf_exec: WorkflowExecution,
+    event_type: str,
+    attributes: Optional[str] = None
+) -> int:
+    """
+    暂存一条事件, 返回分配的 event_id.
+    session 可以是 AsyncSession 或 Session (两者共享同一个 info 字典)
+    """
+    wf_exec.current_event_id = (wf_exec.current_event_id or 0) + 1
+    stored, version = codec.encode_payload(attributes)
+    session.info.setdefault(PENDING_EVENTS_KEY, []).append({
+        "run_id": wf_exec.run_id,
+        "shard_id": wf_exec.shard_id,
+        "event_id": wf_exec.current_event_id,
+        "event_type": event_type,
+        "attributes": stored,
+        "attr_version": version,
+    })
+    return wf_exec.current_event_id
+
+def pending_events(session: Any) -> List[Dict[str, Any]]:
+    """尚未写入的事件行 (只读)"""
+    return list(session.info.get(PENDING_EVENTS_KEY, ()))
+
+def flush_events(session: Session) -> int:
+    """把暂存的事件按批写入, 返回写入的行数"""
+    rows = session.info.pop(PENDING_EVENTS_KEY, None)
+    if not rows:
+        return 0
+    table = WorkflowEvent.__table__
+    for start in range(0, len(rows), EVENT_BATCH_SIZE):
+        session.execute(insert(table).values(rows[start:start + EVENT_BATCH_SIZE]))
+    return len(rows)
+
+@event.listens_for(Session, "before_commit")
+def _flush_before_commit(session: Session) -> None:
+    # 与同一事务中的其他修改一起提交
+    flush_events(session)
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_on_rollback(session: Session, previous_transaction) -> None:
+    # 回滚 (例如版本冲突后重试) 时丢弃未写入的事件, 重试会重新生成
+    if previous_transaction.parent is None:
+        session.info.pop(PENDING_EVENTS_KEY, None)
@@ -0,0 +1,153 @@
+# stepflow/infrastructure/heartbeat_buffer.py
+# 进程内的心跳缓冲: 同一任务的多次心跳在内存中合并为一条 (最新的时间/租约/进度),
+# 定期用一条按主键批量执行的 UPDATE 写入, 而不是每次心跳各写一次整行;
+# 租约在一个写入间隔内就会到期的任务不等定时写入, 立即写入, 以免回收器把仍在心跳的任务当作失联
+
+import os
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta, UTC
+from typing import Callable, Dict, Optional
+
+from sqlalchemy import Text, bindparam, func, update
+
+from stepflow.infrastructure.models import ActivityTask, UTCDateTime
+from stepflow.infrastructure.repositories.activity_task_repository import as_utc
+
+logger = logging.getLogger(__name__)
+
+# 缓冲写入间隔 (秒)
+HEARTBEAT_FLUSH_INTERVAL = float(os.environ.get("STEPFLOW_HEARTBEAT_FLUSH_INTERVAL", "1"))
+
+@dataclass
+class PendingHeartbeat:
+    # 发出心跳时持有任务的 worker, 写入时只续期仍由它持有的任务
+    worker_id: Optional[str]
+    at: datetime
+    lease_expiry: Optional[datetime]
+    details: Optional[str]
+
+class HeartbeatBuffer:
+    """
+    按 task_token 合并心跳.
+    写入只作用于仍处于 running 且仍由发出心跳的 worker 持有的任务:
+    已完成、已被回收或重新排队 (包括又被其他 worker 认领) 的任务不会被迟到的心跳续租
+    """
+
+    def __init__(self, session_factory: Optional[Callable] = None, flush_interval: float = HEARTBEAT_FLUSH_INTERVAL):
+        self._session_factory = session_factory
+        self.flush_interval = flush_interval
+        self._pending: Dict[str, PendingHeartbeat] = {}
+        # 本缓冲为每个任务写入的最新租约, 即数据库中当前生效的租约
+        self._deadlines: Dict[str, datetime] = {}
+        self._lock = asyncio.Lock()
+        # 有需要立即写入的心跳时由 record 设置, run 启动后才创建 (绑定到运行它的事件循环)
+        self._urgent: Optional[asyncio.Event] = None
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def record(
+        self,
+        task_token: str,
+        worker_id: Optional[str],
+        at: datetime,
+        lease_expiry: Optional[datetime] = None,
+        details: Optional[str] = None,
+        current_expiry: Optional[datetime] = None
+    ) -> bool:
+        """
+        记录一次心跳, 覆盖同一任务尚未写入的心跳 (没有新进度时保留之前的进度).
+        current_expiry 为调用方读到的当前租约, 本缓冲还没为该任务写入过租约时据此判断;
+        当前租约在一个写入间隔内到期时要求 run 立即写入, 返回 True
+        """
+        previous = self._pending.get(task_token)
+        if details is None and previous is not None and previous.worker_id == worker_id:
+            details = previous.details
+        self._pending[task_token] = PendingHeartbeat(worker_id, at, lease_expiry, details)
+
+        deadline = as_utc(self._deadlines.get(task_token, current_expiry))
+        urgent = deadline is not None and deadline - at <= timedelta(seconds=self.flush_interval)
+        if urgent and self._urgent is not None:
+            self._urgent.set()
+        return urgent
+
+    def discard(self, task_token: str) -> None:
+        """任务已结束, 丢弃尚未写入的心跳"""
+        self._pending.pop(task_token, None)
+        self._deadlines.pop(task_token, None)
+
+    async def flush(self) -> int:
+        """把缓冲的心跳一次写入, 返回写入的任务数; 失败时放回缓冲等待下一次写入"""
+        async with self._lock:
+            if not self._pending:
+                return 0
+            pending, self._pending = self._pending, {}
+            rows = [
+                {"b_token": token, "b_worker": beat.worker_id, "b_at": beat.at, "b_lease": beat.lease_expiry, "b_details": beat.details}
+                for token, beat in pending.items()
+            ]
+            table = ActivityTask.__table__
+            stmt = (
+                update(table)
+                .where(
+                    table.c.task_token == bindparam("b_token"),
+                    # 通过接口开始的任务没有 worker_id, 按 NULL 相等比较
+                    table.c.worker_id.is_not_distinct_from(bindparam("b_worker")),
+                    table.c.status == "running"
+                )
+                .values(
+                    heartbeat_at=bindparam("b_at", type_=UTCDateTime()),
+                    # 没有新租约/新进度时保留原值
+                    lease_expiry=func.coalesce(bindparam("b_lease", type_=UTCDateTime()), table.c.lease_expiry),
+                    heartbeat_details=func.coalesce(bindparam("b_details", type_=Text()), table.c.heartbeat_details),
+                )
+            )
+            try:
+                async with self._new_session() as session:
+                    await session.execute(stmt, rows)
+                    await session.commit()
+            except Exception:
+                # 期间又有新心跳的任务以新心跳为准
+                for token, beat in pending.items():
+                    self._pending.setdefault(token, beat)
+                raise
+            now = datetime.now(UTC)
+            for token, beat in pending.items():
+                if beat.lease_expiry is not None:
+                    self._deadlines[token] = beat.lease_expiry
+            # 已经到期的任务不会再靠这里的租约判断, 顺便清理
+            self._deadlines = {token: d for token, d in self._deadlines.items() if as_utc(d) > now}
+            return len(rows)
+
+    def _new_session(self):
+        if self._session_factory is None:
+            from stepflow.infrastructure.database import AsyncSessionLocal
+            return AsyncSessionLocal()
+        return self._session_factory()
+
+    async def run(self, interval: Optional[float] = None) -> None:
+        """后台定期写入 (租约即将到期的心跳立即写入), 取消时把剩余的心跳写完"""
+        if interval is not None:
+            self.flush_interval = interval
+        self._urgent = asyncio.Event()
+        try:
+            while True:
+                try:
+                    async with asyncio.timeout(self.flush_interval):
+                        await self._urgent.wait()
+                except TimeoutError:
+                    pass
+                self._urgent.clear()
+                try:
+                    await self.flush()
+                except Exception as e:
+                    logger.exception(f"写入心跳时出错: {str(e)}")
+        finally:
+            self._urgent = None
+            if self._pending:
+                await self.flush()
+
+# 进程级共享实例
+heartbeat_buffer = HeartbeatBuffer()
@@ -1,13 +1,31 @@
 # stepflow/infrastructure/models.py
 
+import hashlib
 import sqlalchemy
 from sqlalchemy import (
     Column, String, Integer, Text, ForeignKey, DateTime, Boolean,
-    Index, text
+    Index, text, false
 )
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy.orm import relationship, declarative_base
 from .database import Base
-from datetime import datetime
+from .codec import payload_column
+from datetime import datetime, timezone
+
+
+class UTCDateTime(TypeDecorator):
+    """
+    不带时区的 DATETIME/TIMESTAMP 列: 带时区的值写入前统一转换为 UTC 并去掉时区.
+    SQLite 本来就会丢弃时区, asyncpg 则会拒绝把带时区的值写入 timestamp without time zone
+    """
+
+    impl = DateTime
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is not None and value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
 
 # -----------------------
 # workflow_templates
@@ -20,8 +38,20 @@ class WorkflowTemplate(Base):
     description = Column(String)
     dsl_definition = Column(Text, nullable=False)
     version = Column(Integer, nullable=False, server_default=text("1"))
-    created_at = Column(DateTime, nullable=False, server_default=text("CURRENT_TIMESTAMP"))
-    updated_at = Column(DateTime, nullable=False, server_default=text("CURRENT_TIMESTAMP"))
+    # dsl_definition 的摘要: 删除后以同一 template_id 重建时 version 会从 1 重新开始,
+    # 模板缓存按 (template_id, version, dsl_digest) 区分, 其他进程不会沿用旧的编译结果
+    dsl_digest = Column(String(32))
+    created_at = Column(UTCDateTime, nullable=False, server_default=text("CURRENT_TIMESTAMP"))
+    updated_at = Column(UTCDateTime, nullable=False, server_default=text("CURRENT_TIMESTAMP"))
+
+def dsl_digest(dsl_text: str) -> str:
+    return hashlib.blake2b(dsl_text.encode("utf-8"), digest_size=16).hexdigest()
+
+@sqlalchemy.event.listens_for(WorkflowTemplate, "before_insert")
+@sqlalchemy.event.listens_for(WorkflowTemplate, "before_update")
+def _stamp_dsl_digest(mapper, connection, target: WorkflowTemplate) -> None:
+    # 每次写入 (包括只修改 dsl_definition 而没有递增 version 的更新) 都重新计算
+    target.dsl_digest = dsl_digest(target.dsl_definition)
 
 
 # -----------------------
@@ -32,6 +62,8 @@ class WorkflowExecution(Base):
     __table_args__ = (
         # 声明索引 idx_wf_shard_status (shard_id, status)
         Index("idx_wf_shard_status", "shard_id", "status"),
+        # 并行分支按父执行查找
+        Index("idx_wf_parent", "parent_run_id"),
     )
 
     run_id = Column(String(36), primary_key=True)
@@ -41,16 +73,29 @@ class WorkflowExecution(Base):
     current_state_name = Column(String(255), nullable=True)
     status = Column(String(50), nullable=False)
     workflow_type = Column(String(255), nullable=False)
-    input = Column(Text)           # JSON -> TEXT
+    _input = Column("input", Text)      # JSON -> TEXT, 按 input_version 编码
     input_version = Column(Integer, nullable=False, server_default=text("1"))
-    result = Column(Text)          # JSON -> TEXT
+    _result = Column("result", Text)    # JSON -> TEXT, 按 result_version 编码
     result_version = Column(Integer, nullable=False, server_default=text("1"))
-    start_time = Column(DateTime, nullable=False, server_default=text("CURRENT_TIMESTAMP"))
-    close_time = Column(DateTime)
+    start_time = Column(UTCDateTime, nullable=False, server_default=text("CURRENT_TIMESTAMP"))
+    close_time = Column(UTCDateTime)
     current_event_id = Column(Integer, nullable=False, server_default=text("0"))
-    memo = Column(Text)            # JSON -> TEXT
+    _memo = Column("memo", Text)        # JSON -> TEXT, 按 memo_version 编码
+    memo_version = Column(Integer, nullable=False, server_default=text("1"))
     search_attrs = Column(Text)    # JSON -> TEXT
-    version = Column(Integer, nullable=False, server_default=text("1"))
+    version = Column(Integer, nullable=False, server_default=text("1"))  # 乐观锁版本号
+    # Parallel 分支: 父执行 run_id 与分支路径 (例如 "Fetch/0"), 顶层执行为空
+    parent_run_id = Column(String(36), nullable=True)
+    branch_path = Column(String(1024), nullable=True)
+
+    # 读写时透明编解码的 JSON 文本 (大载荷压缩存储)
+    input = payload_column("_input", "input_version")
+    result = payload_column("_result", "result_version")
+    memo = payload_column("_memo", "memo_version")
+
+    # 每次 UPDATE 都带上 WHERE version = :旧版本 并把版本号加一,
+    # 没有匹配到行时抛出 StaleDataError (比较并交换)
+    __mapper_args__ = {"version_id_col": version}
 
     # optional relationship
     # template = relationship("WorkflowTemplate", backref="executions")
@@ -73,10 +118,41 @@ class WorkflowEvent(Base):
     shard_id = Column(Integer, nullable=False)
     event_id = Column(Integer, nullable=False)
     event_type = Column(String(100), nullable=False)
-    attributes = Column(Text)      # JSON -> TEXT
+    _attributes = Column("attributes", Text)  # JSON -> TEXT, 按 attr_version 编码
     attr_version = Column(Integer, nullable=False, server_default=text("1"))
-    timestamp = Column(DateTime, nullable=False, server_default=text("CURRENT_TIMESTAMP"))
-    archived = Column(Boolean, nullable=False, server_default=text("0"))
+    timestamp = Column(UTCDateTime, nullable=False, server_default=text("CURRENT_TIMESTAMP"))
+    archived = Column(Boolean, nullable=False, server_default=false())
+
+    attributes = payload_column("_attributes", "attr_version")
+
+
+# -----------------------
+# state_joins
+# -----------------------
+class StateJoin(Base):
+    """
+    Parallel/Map 等分叉状态的汇合记录: 每进入一次分叉状态创建一行.
+    Parallel 只记录分支执行的 run_id 列表、分支总数与已完成数,
+    各分支输出保存在分支执行自身的 result 中;
+    Map 记录元素总数、已结束的元素数 (随元素任务的结果原子累加)、已派发的元素游标以及元素任务的起始 seq,
+    第 i 个元素的活动任务 seq 为 base_seq + i
+    """
+    __tablename__ = "state_joins"
+    __table_args__ = (
+        Index("idx_state_joins_run", "run_id", "state_name"),
+    )
+
+    join_id = Column(String(36), primary_key=True)
+    run_id = Column(String(36), ForeignKey("workflow_executions.run_id"), nullable=False)
+    shard_id = Column(Integer, nullable=False)
+    state_name = Column(String(255), nullable=False)
+    children = Column(Text)        # JSON -> TEXT, 按分支顺序的 run_id 列表
+    total = Column(Integer, nullable=False)
+    completed = Column(Integer, nullable=False, server_default=text("0"))
+    base_seq = Column(Integer)     # Map: 第一个元素任务的 seq
+    next_index = Column(Integer)   # Map: 下一个待派发的元素下标
+    status = Column(String(50), nullable=False)  # open / closed
+    created_at = Column(UTCDateTime, nullable=False, server_default=text("CURRENT_TIMESTAMP"))
 
 
 # -----------------------
@@ -87,13 +163,20 @@ class Timer(Base):
     __table_args__ = (
         # 索引 idx_timers_run (run_id, fire_at)
         Index("idx_timers_run", "run_id", "fire_at"),
+        # 定时器 worker 按触发时间扫描 scheduled 的定时器
+        Index("idx_timers_status_fire", "status", "fire_at"),
+        # 分片 worker 只扫描自己持有的分片
+        Index("idx_timers_shard_status_fire", "shard_id", "status", "fire_at"),
     )
 
     timer_id = Column(String(36), primary_key=True)
     run_id = Column(String(36), ForeignKey("workflow_executions.run_id"), nullable=False)
     shard_id = Column(Integer, nullable=False)
-    fire_at = Column(DateTime, nullable=False)
+    fire_at = Column(UTCDateTime, nullable=False)
     status = Column(String(50), nullable=False)
+    # workflow: 到期后推进工作流; activity_retry: 到期后重新调度 task_token 对应的活动任务
+    timer_type = Column(String(50), nullable=False, server_default=text("'workflow'"))
+    task_token = Column(String(36), nullable=True)
     version = Column(Integer, nullable=False, server_default=text("1"))
 
 
@@ -105,6 +188,10 @@ class ActivityTask(Base):
     __table_args__ = (
         Index("idx_activity_run_seq", "run_id", "seq"),
         Index("idx_activity_status", "status"),
+        # 回收器按租约到期时间扫描 running 任务
+        Index("idx_activity_status_lease", "status", "lease_expiry"),
+        # 分片 worker 只认领自己持有的分片中的任务
+        Index("idx_activity_shard_status", "shard_id", "status", "scheduled_at"),
     )
 
     task_token = Column(String(36), primary_key=True)
@@ -112,21 +199,31 @@ class ActivityTask(Base):
     shard_id = Column(Integer, nullable=False, default=0)
     seq = Column(Integer, nullable=False, default=0)
     activity_type = Column(String(255), nullable=False)
-    input = Column(Text, nullable=True)
-    result = Column(Text, nullable=True)
+    _input = Column("input", Text, nullable=True)    # 按 input_version 编码
+    input_version = Column(Integer, nullable=False, server_default=text("1"))
+    _result = Column("result", Text, nullable=True)  # 按 result_version 编码
+    result_version = Column(Integer, nullable=False, server_default=text("1"))
     status = Column(String(50), nullable=False, default="scheduled")
     error = Column(String, nullable=True)
+    error_type = Column(String(255), nullable=True)   # 错误名, 用于匹配 Retry/Catch 的 ErrorEquals
     error_details = Column(Text, nullable=True)
     attempt = Column(Integer, nullable=False, server_default=text("1"))
     max_attempts = Column(Integer, nullable=False, server_default=text("3"))
-    heartbeat_at = Column(DateTime)
-    scheduled_at = Column(DateTime, nullable=False, server_default=text("CURRENT_TIMESTAMP"))
-    started_at = Column(DateTime)
-    completed_at = Column(DateTime)
-    timeout_seconds = Column(Integer)
+    heartbeat_at = Column(UTCDateTime)
+    heartbeat_details = Column(Text)  # 最近一次心跳携带的进度信息
+    worker_id = Column(String(255))   # 认领该任务的 worker
+    lease_expiry = Column(UTCDateTime)   # 认领租约到期时间
+    scheduled_at = Column(UTCDateTime, nullable=False, server_default=text("CURRENT_TIMESTAMP"))
+    started_at = Column(UTCDateTime)
+    completed_at = Column(UTCDateTime)
+    timeout_seconds = Column(Integer)     # 开始执行到结束的超时 (TaskState.TimeoutSeconds)
+    heartbeat_seconds = Column(Integer)   # 心跳超时 (TaskState.HeartbeatSeconds)
     retry_policy = Column(Text)    # JSON -> TEXT
     version = Column(Integer, nullable=False, server_default=text("1"))
 
+    input = payload_column("_input", "input_version")
+    result = payload_column("_result", "result_version")
+
 
 # -----------------------
 # workflow_visibility
@@ -140,9 +237,34 @@ class WorkflowVisibility(Base):
     run_id = Column(String(36), primary_key=True)
     workflow_id = Column(String(255))
     workflow_type = Column(String(255))
-    start_time = Column(DateTime)
-    close_time = Column(DateTime)
+    start_time = Column(UTCDateTime)
+    close_time = Column(UTCDateTime)
     status = Column(String(50))
     memo = Column(Text)            # JSON -> TEXT
     search_attrs = Column(Text)    # JSON -> TEXT
-    version = Column(Integer, nullable=False, server_default=text("1"))
\ No newline at end of file
+    version = Column(Integer, nullable=False, server_default=text("1"))
+
+
+# -----------------------
+# shard_leases / shard_members
+# -----------------------
+class ShardLease(Base):
+    """
+    分片归属: 每个分片一行, 由持有租约的 worker 独占认领该分片的活动任务与定时器.
+    owner 为空或租约到期的分片可以被其他 worker 接管
+    """
+    __tablename__ = "shard_leases"
+
+    shard_id = Column(Integer, primary_key=True)
+    owner = Column(String(255))
+    lease_expiry = Column(UTCDateTime)
+    version = Column(Integer, nullable=False, server_default=text("1"))
+
+
+class ShardMember(Base):
+    """存活的 worker 进程, 各 worker 按同一份成员列表计算分片分配"""
+    __tablename__ = "shard_members"
+
+    member_id = Column(String(255), primary_key=True)
+    heartbeat_at = Column(UTCDateTime, nullable=False)
+    lease_expiry = Column(UTCDateTime, nullable=False)
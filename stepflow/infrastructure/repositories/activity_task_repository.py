@@ -1,9 +1,36 @@
 # stepflow/infrastructure/repositories/activity_task_repository.py
 
-from typing import Optional, List
+import asyncio
+from datetime import datetime, timedelta, UTC
+from typing import Any, Optional, List, Dict, Collection
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, update
+from sqlalchemy import select, update, func
 from stepflow.infrastructure.models import ActivityTask
+from stepflow.infrastructure.repositories.base_repository import fetch_streamed, paginate
+
+# 支持 SELECT ... FOR UPDATE SKIP LOCKED 的后端
+SKIP_LOCKED_DIALECTS = {"postgresql", "mysql", "mariadb", "oracle"}
+
+# SQLite 只有一个写者: 同一进程内的认领串行执行, 避免多个 worker 争抢写锁
+_sqlite_claim_lock = asyncio.Lock()
+
+def as_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """数据库读出的时间不带时区 (按 UTC 存储), 与带时区的当前时间比较前补上"""
+    if value is not None and value.tzinfo is None:
+        value = value.replace(tzinfo=UTC)
+    return value
+
+def lease_deadline(task: ActivityTask, now: datetime, lease_seconds: int) -> datetime:
+    """
+    租约到期时间: 取认领租约、心跳超时、开始执行到结束超时中最早的一个,
+    回收器只需按 lease_expiry 扫描就能同时发现失联的 worker 与超时的任务
+    """
+    deadline = now + timedelta(seconds=lease_seconds)
+    if task.heartbeat_seconds:
+        deadline = min(deadline, now + timedelta(seconds=task.heartbeat_seconds))
+    if task.timeout_seconds and task.started_at:
+        deadline = min(deadline, as_utc(task.started_at) + timedelta(seconds=task.timeout_seconds))
+    return deadline
 
 class ActivityTaskRepository:
     def __init__(self, db: AsyncSession):
@@ -36,11 +63,15 @@ class ActivityTaskRepository:
             .where(ActivityTask.task_token == task.task_token)
             .values(
                 status=task.status,
-                result=task.result,
+                # 直接写入已编码的存储值与编码版本
+                result=task._result,
+                result_version=task.result_version,
                 error=task.error,  # 确保这里包含 error 字段
+                error_type=task.error_type,
                 error_details=task.error_details,
                 started_at=task.started_at,
                 completed_at=task.completed_at,
+                lease_expiry=task.lease_expiry,
                 # 其他需要更新的字段...
             )
             .execution_options(synchronize_session="fetch")
@@ -49,8 +80,8 @@ class ActivityTaskRepository:
         await self.db.execute(stmt)
         await self.db.commit()
         
-        # 返回更新后的任务
-        return await self.get_by_token(task.task_token)
+        # UPDATE 写入的就是 task 上的值, 无需再查询一次
+        return task
 
     async def delete(self, task_token: str) -> bool:
         """
@@ -85,10 +116,10 @@ class ActivityTaskRepository:
         result = await self.db.execute(stmt)
         return result.scalar_one_or_none()
 
-    async def list_all(self) -> List[ActivityTask]:
-        """列出所有活动任务"""
-        result = await self.db.execute(select(ActivityTask))
-        return result.scalars().all()
+    async def list_all(self, offset: int = 0, limit: Optional[int] = None) -> List[ActivityTask]:
+        """列出所有活动任务 (经服务端游标分批读取)"""
+        stmt = select(ActivityTask).order_by(ActivityTask.scheduled_at)
+        return await fetch_streamed(self.db, paginate(stmt, offset, limit))
 
     async def get_by_run_id(self, run_id: str) -> List[ActivityTask]:
         """获取工作流执行的所有活动任务"""
@@ -96,6 +127,254 @@ class ActivityTaskRepository:
         result = await self.db.execute(stmt)
         return result.scalars().all()
 
+    async def get_latest_by_run_id(self, run_id: str) -> Optional[ActivityTask]:
+        """获取工作流执行中最近调度的活动任务 (seq 最大)"""
+        stmt = (
+            select(ActivityTask)
+            .where(ActivityTask.run_id == run_id)
+            .order_by(ActivityTask.seq.desc(), ActivityTask.scheduled_at.desc())
+            .limit(1)
+        )
+        result = await self.db.execute(stmt)
+        return result.scalar_one_or_none()
+
+    async def list_by_seq_range(self, run_id: str, start_seq: int, end_seq: int) -> List[ActivityTask]:
+        """按 seq 顺序列出 [start_seq, end_seq) 区间内的活动任务 (走 run_id + seq 索引)"""
+        stmt = (
+            select(ActivityTask)
+            .where(
+                ActivityTask.run_id == run_id,
+                ActivityTask.seq >= start_seq,
+                ActivityTask.seq < end_seq
+            )
+            .order_by(ActivityTask.seq)
+        )
+        result = await self.db.execute(stmt)
+        return result.scalars().all()
+
+    async def claim_scheduled(
+        self,
+        worker_id: str,
+        limit: int,
+        lease_seconds: int,
+        shard_ids: Optional[Collection[int]] = None
+    ) -> List[ActivityTask]:
+        """
+        原子地认领一批 scheduled 任务: 在一条 UPDATE ... RETURNING 中
+        把状态改为 running 并写入 worker_id 与租约到期时间, 返回被认领的任务.
+        支持 SKIP LOCKED 的后端上并发的 worker 会跳过彼此锁住的行;
+        SQLite 上整条语句在数据库写锁下执行, 进程内再用锁串行化认领.
+        shard_ids 不为 None 时只认领这些分片中的任务
+        """
+        now = datetime.now(UTC)
+        if shard_ids is not None and not shard_ids:
+            return []
+        candidates = (
+            select(ActivityTask.task_token)
+            .where(ActivityTask.status == "scheduled")
+            .order_by(ActivityTask.scheduled_at)
+            .limit(limit)
+        )
+        if shard_ids is not None:
+            candidates = candidates.where(ActivityTask.shard_id.in_(sorted(shard_ids)))
+        dialect = self.db.get_bind().dialect.name
+        if dialect in SKIP_LOCKED_DIALECTS:
+            candidates = candidates.with_for_update(skip_locked=True)
+
+        stmt = (
+            update(ActivityTask)
+            .where(
+                ActivityTask.task_token.in_(candidates.scalar_subquery()),
+                # 防止候选行在子查询与更新之间已被其他 worker 认领
+                ActivityTask.status == "scheduled"
+            )
+            .values(
+                status="running",
+                worker_id=worker_id,
+                started_at=now,
+                lease_expiry=now + timedelta(seconds=lease_seconds)
+            )
+            .returning(ActivityTask)
+            # 会话中已加载的同一行也要用 RETURNING 的值覆盖
+            .execution_options(synchronize_session=False, populate_existing=True)
+        )
+
+        if dialect == "sqlite":
+            async with _sqlite_claim_lock:
+                result = await self.db.execute(stmt)
+                tasks = result.scalars().all()
+                self._shorten_leases(tasks, now, lease_seconds)
+                await self.db.commit()
+        else:
+            result = await self.db.execute(stmt)
+            tasks = result.scalars().all()
+            self._shorten_leases(tasks, now, lease_seconds)
+            await self.db.commit()
+        return tasks
+
+    def _shorten_leases(self, tasks: List[ActivityTask], now: datetime, lease_seconds: int) -> None:
+        # 声明了 TimeoutSeconds/HeartbeatSeconds 的任务租约更短, 随认领一起提交
+        for task in tasks:
+            deadline = lease_deadline(task, now, lease_seconds)
+            if deadline < now + timedelta(seconds=lease_seconds):
+                task.lease_expiry = deadline
+
+    async def list_expired(
+        self,
+        now: datetime,
+        limit: int,
+        shard_ids: Optional[Collection[int]] = None
+    ) -> List[ActivityTask]:
+        """租约已到期的 running 任务, 按到期时间排序 (走 status + lease_expiry 索引), 可以只取部分分片"""
+        if shard_ids is not None and not shard_ids:
+            return []
+        stmt = (
+            select(ActivityTask)
+            .where(ActivityTask.status == "running", ActivityTask.lease_expiry <= now)
+            .order_by(ActivityTask.lease_expiry)
+            .limit(limit)
+        )
+        if shard_ids is not None:
+            stmt = stmt.where(ActivityTask.shard_id.in_(sorted(shard_ids)))
+        result = await self.db.execute(stmt)
+        return result.scalars().all()
+
+    async def requeue_expired(self, task_tokens: List[str], now: datetime) -> int:
+        """
+        把租约仍处于到期状态的任务恢复为 scheduled (worker 失联), 返回恢复的数量.
+        重新排队计为一次新的执行 (attempt + 1), 执行次数已达到 max_attempts 的任务保持不变
+        """
+        result = await self.db.execute(
+            update(ActivityTask)
+            .where(
+                ActivityTask.task_token.in_(task_tokens),
+                ActivityTask.status == "running",
+                ActivityTask.lease_expiry <= now,
+                func.coalesce(ActivityTask.attempt, 1) < ActivityTask.max_attempts
+            )
+            .values(
+                status="scheduled",
+                attempt=func.coalesce(ActivityTask.attempt, 1) + 1,
+                worker_id=None,
+                started_at=None,
+                lease_expiry=None,
+                scheduled_at=now
+            )
+            .execution_options(synchronize_session=False)
+        )
+        await self.db.commit()
+        return result.rowcount
+
+    async def reschedule_retrying(self, task_tokens: List[str], now: datetime) -> int:
+        """
+        一条 UPDATE 把等待重试的任务重新放回队列 (attempt + 1, 不提交),
+        不处于 retrying 的任务 (例如已被取消) 保持不变, 返回重新调度的数量
+        """
+        if not task_tokens:
+            return 0
+        result = await self.db.execute(
+            update(ActivityTask)
+            .where(ActivityTask.task_token.in_(task_tokens), ActivityTask.status == "retrying")
+            .values(
+                status="scheduled",
+                attempt=func.coalesce(ActivityTask.attempt, 1) + 1,
+                scheduled_at=now,
+                started_at=None,
+                completed_at=None
+            )
+            .execution_options(synchronize_session=False)
+        )
+        return result.rowcount
+
+    async def cancel_for_runs(self, run_ids: List[str], now: datetime) -> int:
+        """
+        取消这些执行尚未结束的活动任务 (不提交), 返回取消的数量;
+        仍在执行的 worker 上报结果时会因为任务不再处于 running 而被忽略
+        """
+        if not run_ids:
+            return 0
+        result = await self.db.execute(
+            update(ActivityTask)
+            .where(
+                ActivityTask.run_id.in_(run_ids),
+                ActivityTask.status.in_(("scheduled", "running", "retrying"))
+            )
+            .values(status="canceled", completed_at=now, worker_id=None, lease_expiry=None)
+            .execution_options(synchronize_session=False)
+        )
+        return result.rowcount
+
+    async def cancel_in_seq_range(self, run_id: str, start_seq: int, end_seq: int, now: datetime) -> int:
+        """
+        取消 [start_seq, end_seq) 区间内尚未结束的活动任务 (不提交), 返回取消的数量;
+        用于 Map 的某个元素失败后取消其余仍在排队或执行的元素任务
+        """
+        result = await self.db.execute(
+            update(ActivityTask)
+            .where(
+                ActivityTask.run_id == run_id,
+                ActivityTask.seq >= start_seq,
+                ActivityTask.seq < end_seq,
+                ActivityTask.status.in_(("scheduled", "running", "retrying"))
+            )
+            .values(status="canceled", completed_at=now, worker_id=None, lease_expiry=None)
+            .execution_options(synchronize_session=False)
+        )
+        return result.rowcount
+
+    async def take_over_expired(self, task_tokens: List[str], owner: str, now: datetime, lease_seconds: int) -> List[ActivityTask]:
+        """
+        原子地把租约到期的任务转给 owner (回收器), 返回成功接管的任务;
+        其他回收器或按时完成的 worker 已经处理过的任务不会被返回
+        """
+        result = await self.db.execute(
+            update(ActivityTask)
+            .where(
+                ActivityTask.task_token.in_(task_tokens),
+                ActivityTask.status == "running",
+                ActivityTask.lease_expiry <= now
+            )
+            .values(worker_id=owner, lease_expiry=now + timedelta(seconds=lease_seconds))
+            .returning(ActivityTask)
+            .execution_options(synchronize_session=False, populate_existing=True)
+        )
+        tasks = result.scalars().all()
+        await self.db.commit()
+        return tasks
+
+    async def finish_if_owned(self, task_token: str, worker_id: Optional[str], values: Dict[str, Any]) -> Optional[ActivityTask]:
+        """
+        一条条件 UPDATE 写入任务结果 (不提交): 只有仍由 worker_id 持有且处于 running 的任务会被更新,
+        已被回收器接管、因租约到期重新排队或已取消的任务返回 None
+        """
+        result = await self.db.execute(
+            update(ActivityTask)
+            .where(
+                ActivityTask.task_token == task_token,
+                ActivityTask.worker_id == worker_id,
+                ActivityTask.status == "running"
+            )
+            .values(**values)
+            .returning(ActivityTask)
+            .execution_options(synchronize_session=False, populate_existing=True)
+        )
+        return result.scalars().one_or_none()
+
+    async def release_claimed(self, worker_id: str, task_tokens: List[str]) -> int:
+        """把仍由该 worker 持有的 running 任务恢复为 scheduled, 返回恢复的数量"""
+        result = await self.db.execute(
+            update(ActivityTask)
+            .where(
+                ActivityTask.task_token.in_(task_tokens),
+                ActivityTask.worker_id == worker_id,
+                ActivityTask.status == "running"
+            )
+            .values(status="scheduled", worker_id=None, started_at=None, lease_expiry=None)
+            .execution_options(synchronize_session=False)
+        )
+        await self.db.commit()
+        return result.rowcount
+
     async def get_by_status(self, status: str, limit: int = 10) -> List[ActivityTask]:
         """获取指定状态的活动任务"""
         stmt = select(ActivityTask).where(ActivityTask.status == status).limit(limit)
@@ -111,8 +390,16 @@ class ActivityTaskRepository:
         )
         await self.db.execute(stmt)
 
-    async def save(self, task: ActivityTask) -> None:
-        """保存活动任务"""
+    def stage(self, task: ActivityTask) -> ActivityTask:
+        """
+        只把修改登记到会话中, 不提交:
+        由调用方 (例如引擎推进) 在同一事务中与其他修改一起提交一次
+        """
         self.db.add(task)
+        return task
+
+    async def save(self, task: ActivityTask) -> ActivityTask:
+        """保存活动任务 (更新不涉及服务端默认值, 提交后无需 refresh)"""
+        self.stage(task)
         await self.db.commit()
-        await self.db.refresh(task)
\ No newline at end of file
+        return task
@@ -1,36 +1,36 @@
-import asyncio
-from typing import Dict, Any, Type, TypeVar, Optional
+import os
+from typing import Dict, Any, Type, TypeVar, Optional, AsyncIterator, List
 
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, update, delete
+from sqlalchemy import select, update, delete, Select
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 
 T = TypeVar('T')
 
-# 创建一个锁管理器
-class LockManager:
-    """管理资源锁，避免并发访问冲突"""
-    
-    def __init__(self):
-        self.locks: Dict[str, asyncio.Lock] = {}
-    
-    async def acquire(self, resource_id: str) -> asyncio.Lock:
-        """获取资源锁"""
-        if resource_id not in self.locks:
-            self.locks[resource_id] = asyncio.Lock()
-        
-        lock = self.locks[resource_id]
-        await lock.acquire()
-        return lock
-    
-    def release(self, resource_id: str) -> None:
-        """释放资源锁"""
-        if resource_id in self.locks and not self.locks[resource_id].locked():
-            # 如果锁不再被使用，可以从字典中移除
-            del self.locks[resource_id]
+# 列表查询经服务端游标分批读取时每批的行数
+STREAM_BATCH_SIZE = int(os.environ.get("STEPFLOW_DB_STREAM_BATCH_SIZE", "500"))
+
+def paginate(stmt: Select, offset: int = 0, limit: Optional[int] = None) -> Select:
+    """把分页下推到 SQL, 而不是取回全部结果后再切片"""
+    if offset:
+        stmt = stmt.offset(offset)
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    return stmt
 
-# 创建全局锁管理器实例
-lock_manager = LockManager()
+async def stream_scalars(session: AsyncSession, stmt: Select, batch_size: int = STREAM_BATCH_SIZE) -> AsyncIterator[Any]:
+    """
+    通过服务端游标 (PostgreSQL 下为 asyncpg 游标) 分批读取查询结果并逐个产出实体,
+    驱动不会一次性缓冲整个结果集
+    """
+    result = await session.stream_scalars(stmt.execution_options(yield_per=batch_size))
+    async for entity in result:
+        yield entity
+
+async def fetch_streamed(session: AsyncSession, stmt: Select, batch_size: int = STREAM_BATCH_SIZE) -> List[Any]:
+    """同 stream_scalars, 收集为列表 (用于一次性返回的列表接口)"""
+    return [entity async for entity in stream_scalars(session, stmt, batch_size)]
 
 class BaseRepository:
     """基础仓库类，提供通用的CRUD操作"""
@@ -56,33 +56,37 @@ class BaseRepository:
             raise
     
     async def update(self, entity: T) -> T:
-        """更新实体"""
-        # 获取实体ID
-        entity_id = getattr(entity, self.get_id_attribute())
-        
-        # 使用锁确保并发安全
-        async with await lock_manager.acquire(f"{self.model_class.__name__}:{entity_id}"):
-            self.session.add(entity)
+        """
+        更新实体.
+        映射了 version_id_col 的模型 (如 WorkflowExecution) 会按版本号比较并交换,
+        实体已被其他会话修改时回滚并抛出 StaleDataError, 由调用方重新加载后重试.
+        会话不在提交时过期实体, 提交后无需 refresh (创建时才需要读回服务端默认值)
+        """
+        self.session.add(entity)
+        try:
             await self.session.commit()
-            await self.session.refresh(entity)
-            return entity
+        except StaleDataError:
+            await self.session.rollback()
+            raise
+        return entity
     
     async def delete(self, id_value: Any) -> bool:
-        """删除实体"""
-        # 使用锁确保并发安全
-        async with await lock_manager.acquire(f"{self.model_class.__name__}:{id_value}"):
-            entity = await self.get_by_id(id_value)
-            if not entity:
-                return False
-            
-            await self.session.delete(entity)
+        """删除实体 (带版本号的模型同样按版本号校验)"""
+        entity = await self.get_by_id(id_value)
+        if not entity:
+            return False
+        
+        await self.session.delete(entity)
+        try:
             await self.session.commit()
-            return True
+        except StaleDataError:
+            await self.session.rollback()
+            raise
+        return True
     
-    async def list_all(self) -> list[T]:
+    async def list_all(self, offset: int = 0, limit: Optional[int] = None) -> list[T]:
         """列出所有实体"""
-        result = await self.session.execute(select(self.model_class))
-        return result.scalars().all()
+        return await fetch_streamed(self.session, paginate(select(self.model_class), offset, limit))
     
     def get_id_attribute(self) -> str:
         """获取ID属性名称，子类可以覆盖此方法"""
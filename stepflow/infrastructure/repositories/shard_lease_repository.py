@@ -0,0 +1,106 @@
+# stepflow/infrastructure/repositories/shard_lease_repository.py
+
+from datetime import datetime, timedelta
+from typing import List, Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, update, delete, or_, func
+from sqlalchemy.exc import IntegrityError
+from stepflow.infrastructure.models import ShardLease, ShardMember, WorkflowExecution, ActivityTask, Timer
+
+class ShardLeaseRepository:
+    def __init__(self, db: AsyncSession):
+        self.db = db
+
+    async def ensure_shards(self, num_shards: int) -> None:
+        """补齐 0..num_shards-1 的分片行 (初始无人持有)"""
+        result = await self.db.execute(select(ShardLease.shard_id).where(ShardLease.shard_id < num_shards))
+        existing = set(result.scalars().all())
+        missing = [i for i in range(num_shards) if i not in existing]
+        if not missing:
+            return
+        self.db.add_all([ShardLease(shard_id=i) for i in missing])
+        try:
+            await self.db.commit()
+        except IntegrityError:
+            # 其他 worker 同时补齐了同一批分片
+            await self.db.rollback()
+
+    async def register_member(self, member_id: str, now: datetime, lease_seconds: int) -> None:
+        """登记或续期存活的 worker"""
+        lease_expiry = now + timedelta(seconds=lease_seconds)
+        member = await self.db.get(ShardMember, member_id)
+        if member is None:
+            self.db.add(ShardMember(member_id=member_id, heartbeat_at=now, lease_expiry=lease_expiry))
+        else:
+            member.heartbeat_at = now
+            member.lease_expiry = lease_expiry
+        await self.db.commit()
+
+    async def remove_member(self, member_id: str) -> None:
+        """worker 正常退出时注销, 其他 worker 下一次重新分配时即可接手它的分片"""
+        await self.db.execute(delete(ShardMember).where(ShardMember.member_id == member_id))
+        await self.db.commit()
+
+    async def list_live_members(self, now: datetime) -> List[str]:
+        """租约未到期的 worker; 到期的成员行顺便清理掉"""
+        await self.db.execute(delete(ShardMember).where(ShardMember.lease_expiry <= now))
+        result = await self.db.execute(
+            select(ShardMember.member_id).where(ShardMember.lease_expiry > now).order_by(ShardMember.member_id)
+        )
+        members = list(result.scalars().all())
+        await self.db.commit()
+        return members
+
+    async def acquire(self, shard_ids: List[int], owner: str, now: datetime, lease_seconds: int) -> List[int]:
+        """
+        获取或续期分片租约: 只有无人持有、租约到期或已由 owner 持有的分片会被更新,
+        返回 owner 现在持有的分片
+        """
+        if not shard_ids:
+            return []
+        result = await self.db.execute(
+            update(ShardLease)
+            .where(
+                ShardLease.shard_id.in_(shard_ids),
+                or_(ShardLease.owner.is_(None), ShardLease.owner == owner, ShardLease.lease_expiry <= now)
+            )
+            .values(owner=owner, lease_expiry=now + timedelta(seconds=lease_seconds), version=ShardLease.version + 1)
+            .returning(ShardLease.shard_id)
+            .execution_options(synchronize_session=False)
+        )
+        acquired = sorted(result.scalars().all())
+        await self.db.commit()
+        return acquired
+
+    async def release(self, shard_ids: List[int], owner: str) -> int:
+        """交出 owner 持有的分片, 返回交出的数量"""
+        if not shard_ids:
+            return 0
+        result = await self.db.execute(
+            update(ShardLease)
+            .where(ShardLease.shard_id.in_(shard_ids), ShardLease.owner == owner)
+            .values(owner=None, lease_expiry=None, version=ShardLease.version + 1)
+            .execution_options(synchronize_session=False)
+        )
+        await self.db.commit()
+        return result.rowcount
+
+    async def list_owned(self, owner: str, now: datetime) -> List[int]:
+        """owner 当前 (租约未到期) 持有的分片"""
+        result = await self.db.execute(
+            select(ShardLease.shard_id)
+            .where(ShardLease.owner == owner, ShardLease.lease_expiry > now)
+            .order_by(ShardLease.shard_id)
+        )
+        return list(result.scalars().all())
+
+    async def max_pending_shard_id(self) -> Optional[int]:
+        """未结束的执行、任务与定时器中最大的 shard_id (没有时为 None)"""
+        queries = [
+            select(func.max(WorkflowExecution.shard_id)).where(WorkflowExecution.status == "running"),
+            select(func.max(ActivityTask.shard_id)).where(ActivityTask.status.in_(("scheduled", "running"))),
+            select(func.max(Timer.shard_id)).where(Timer.status == "scheduled"),
+        ]
+        found = [(await self.db.execute(query)).scalar() for query in queries]
+        found = [shard_id for shard_id in found if shard_id is not None]
+        return max(found) if found else None
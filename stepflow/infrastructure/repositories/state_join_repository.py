@@ -0,0 +1,62 @@
+# stepflow/infrastructure/repositories/state_join_repository.py
+
+from typing import Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, update
+from stepflow.infrastructure.models import StateJoin
+
+class StateJoinRepository:
+    def __init__(self, db: AsyncSession):
+        self.db = db
+
+    def add(self, join: StateJoin) -> StateJoin:
+        """
+        暂存新的汇合记录, 由调用方统一提交
+        """
+        self.db.add(join)
+        return join
+
+    async def get_by_id(self, join_id: str) -> Optional[StateJoin]:
+        stmt = select(StateJoin).where(StateJoin.join_id == join_id)
+        result = await self.db.execute(stmt)
+        return result.scalar_one_or_none()
+
+    async def get_open(self, run_id: str, state_name: str) -> Optional[StateJoin]:
+        """
+        获取某个执行在指定状态上尚未关闭的汇合记录
+        """
+        stmt = select(StateJoin).where(
+            StateJoin.run_id == run_id,
+            StateJoin.state_name == state_name,
+            StateJoin.status == "open"
+        )
+        result = await self.db.execute(stmt)
+        return result.scalar_one_or_none()
+
+    async def increment_completed(self, join: StateJoin, amount: int = 1) -> int:
+        """
+        原子地把已完成的分支 (Map 元素) 数加上 amount, 返回累加后的值.
+        UPDATE 会持有行锁直到事务提交, 并发完成的分支不会丢失计数
+        """
+        await self.db.execute(
+            update(StateJoin)
+            .where(StateJoin.join_id == join.join_id)
+            .values(completed=StateJoin.completed + amount)
+            .execution_options(synchronize_session=False)
+        )
+        await self.db.refresh(join, ["completed"])
+        return join.completed
+
+    async def advance_cursor(self, join: StateJoin, expected: int, new_index: int) -> bool:
+        """
+        Map 派发游标的比较并交换: 只有游标仍为 expected 时才推进到 new_index.
+        返回 False 表示另一次并发推进已经派发了这一批元素
+        """
+        result = await self.db.execute(
+            update(StateJoin)
+            .where(StateJoin.join_id == join.join_id, StateJoin.next_index == expected)
+            .values(next_index=new_index)
+            .execution_options(synchronize_session=False)
+        )
+        await self.db.refresh(join, ["next_index"])
+        return result.rowcount == 1
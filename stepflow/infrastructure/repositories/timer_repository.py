@@ -1,8 +1,8 @@
 # stepflow/infrastructure/repositories/timer_repository.py
 
-from typing import Optional, List
+from typing import Optional, List, Collection
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, update
 from stepflow.infrastructure.models import Timer
 
 class TimerRepository:
@@ -18,6 +18,11 @@ class TimerRepository:
         await self.db.refresh(timer)
         return timer
 
+    def stage(self, timer: Timer) -> Timer:
+        """只登记到会话中, 由调用方与其他修改一起提交"""
+        self.db.add(timer)
+        return timer
+
     async def get_by_id(self, timer_id: str) -> Optional[Timer]:
         """
         通过 timer_id (主键) 获取对应 Timer 记录
@@ -53,6 +58,28 @@ class TimerRepository:
         result = await self.db.execute(stmt)
         return result.scalars().all()
 
+    async def cancel_for_runs(self, run_ids: List[str]) -> int:
+        """取消这些执行尚未触发的定时器 (不提交), 返回取消的数量"""
+        if not run_ids:
+            return 0
+        result = await self.db.execute(
+            update(Timer)
+            .where(Timer.run_id.in_(run_ids), Timer.status == "scheduled")
+            .values(status="canceled")
+            .execution_options(synchronize_session=False)
+        )
+        return result.rowcount
+
+    async def has_scheduled(self, run_id: str, timer_type: str = "workflow") -> bool:
+        """该工作流是否还有尚未触发的定时器 (Wait 状态据此判断是否继续等待)"""
+        stmt = select(Timer.timer_id).where(
+            Timer.run_id == run_id,
+            Timer.timer_type == timer_type,
+            Timer.status == "scheduled"
+        ).limit(1)
+        result = await self.db.execute(stmt)
+        return result.scalar_one_or_none() is not None
+
     async def list_scheduled_before(self, cutoff_time) -> List[Timer]:
         """
         列出 fire_at <= cutoff_time 且 status='scheduled' 的所有定时器
@@ -63,4 +90,39 @@ class TimerRepository:
             Timer.fire_at <= cutoff_time
         )
         result = await self.db.execute(stmt)
-        return result.scalars().all()
\ No newline at end of file
+        return result.scalars().all()
+
+    async def list_due_window(self, until, limit: int, shard_ids: Optional[Collection[int]] = None) -> List[Timer]:
+        """
+        按 fire_at 顺序取出 until 之前的 scheduled 定时器 (最多 limit 个),
+        由定时器 worker 装入内存中的时间窗口, 走 (status, fire_at) 索引;
+        shard_ids 不为 None 时只取这些分片的定时器
+        """
+        if shard_ids is not None and not shard_ids:
+            return []
+        stmt = (
+            select(Timer)
+            .where(Timer.status == "scheduled", Timer.fire_at <= until)
+            .order_by(Timer.fire_at)
+            .limit(limit)
+        )
+        if shard_ids is not None:
+            stmt = stmt.where(Timer.shard_id.in_(sorted(shard_ids)))
+        result = await self.db.execute(stmt)
+        return result.scalars().all()
+
+    async def mark_fired(self, timer_ids: List[str]) -> List[str]:
+        """
+        一条 UPDATE 把仍处于 scheduled 的定时器标记为 fired (不提交),
+        返回实际标记的 timer_id; 已被取消或被其他 worker 触发的定时器不会返回
+        """
+        if not timer_ids:
+            return []
+        result = await self.db.execute(
+            update(Timer)
+            .where(Timer.timer_id.in_(timer_ids), Timer.status == "scheduled")
+            .values(status="fired")
+            .returning(Timer.timer_id)
+            .execution_options(synchronize_session=False)
+        )
+        return list(result.scalars().all())
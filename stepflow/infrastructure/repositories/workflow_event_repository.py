@@ -4,6 +4,7 @@ from typing import Optional, List
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from stepflow.infrastructure.models import WorkflowEvent
+from stepflow.infrastructure.repositories.base_repository import fetch_streamed
 
 class WorkflowEventRepository:
     def __init__(self, db: AsyncSession):
@@ -36,8 +37,8 @@ class WorkflowEventRepository:
             .where(WorkflowEvent.run_id == run_id)
             .order_by(WorkflowEvent.id.asc())
         )
-        result = await self.db.execute(stmt)
-        return result.scalars().all()
+        # 长历史的执行事件很多, 经服务端游标分批读取
+        return await fetch_streamed(self.db, stmt)
 
     async def list_by_shard_and_run(self, shard_id: int, run_id: str) -> List[WorkflowEvent]:
         """
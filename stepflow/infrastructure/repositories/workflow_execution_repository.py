@@ -23,13 +23,32 @@ class WorkflowExecutionRepository:
         result = await self.db.execute(stmt)
         return result.scalar_one_or_none()
 
+    async def list_by_run_ids(self, run_ids: List[str]) -> List[WorkflowExecution]:
+        """按 run_id 批量获取 (顺序不保证)"""
+        if not run_ids:
+            return []
+        stmt = select(WorkflowExecution).where(WorkflowExecution.run_id.in_(run_ids))
+        result = await self.db.execute(stmt)
+        return result.scalars().all()
+
+    async def list_running_children(self, parent_run_ids: List[str]) -> List[WorkflowExecution]:
+        """这些执行下仍在运行的分支执行 (走 idx_wf_parent 索引)"""
+        if not parent_run_ids:
+            return []
+        stmt = select(WorkflowExecution).where(
+            WorkflowExecution.parent_run_id.in_(parent_run_ids),
+            WorkflowExecution.status == "running"
+        )
+        result = await self.db.execute(stmt)
+        return result.scalars().all()
+
     async def update(self, wf_exec: WorkflowExecution) -> WorkflowExecution:
         """
         当外部已经拿到了 wf_exec, 并修改(如status=...),
-        调用本方法执行 commit & refresh.
+        调用本方法执行 commit.
+        version 由 ORM 在客户端递增, 更新不涉及服务端默认值, 因此不再 refresh
         """
         await self.db.commit()
-        await self.db.refresh(wf_exec)
         return wf_exec
 
     async def delete(self, run_id: str) -> bool:
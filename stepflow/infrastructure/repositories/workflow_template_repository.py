@@ -1,6 +1,6 @@
 # stepflow/infrastructure/repositories/workflow_template_repository.py
 
-from typing import Optional, List
+from typing import Optional, List, Tuple
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from stepflow.infrastructure.models import WorkflowTemplate
@@ -31,6 +31,17 @@ class WorkflowTemplateRepository:
         result = await self.db.execute(stmt)
         return result.scalar_one_or_none()
 
+    async def get_cache_key(self, template_id: str) -> Optional[Tuple[int, Optional[str]]]:
+        """
+        只查询 (version, dsl_digest) (不读取 dsl_definition), 供模板缓存判断是否命中
+        """
+        stmt = select(WorkflowTemplate.version, WorkflowTemplate.dsl_digest).where(
+            WorkflowTemplate.template_id == template_id
+        )
+        result = await self.db.execute(stmt)
+        row = result.one_or_none()
+        return tuple(row) if row is not None else None
+
     async def update(self, template: WorkflowTemplate) -> WorkflowTemplate:
         """
         更新一个已存在的 template 对象 (要求你先在 session 内查询到),
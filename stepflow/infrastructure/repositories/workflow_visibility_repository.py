@@ -4,6 +4,7 @@ from typing import Optional, List
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from stepflow.infrastructure.models import WorkflowVisibility
+from stepflow.infrastructure.repositories.base_repository import fetch_streamed, paginate
 
 class WorkflowVisibilityRepository:
     def __init__(self, db: AsyncSession):
@@ -45,18 +46,27 @@ class WorkflowVisibilityRepository:
         await self.db.commit()
         return True
 
-    async def list_by_status(self, status: str) -> List[WorkflowVisibility]:
+    async def list_by_status(self, status: str, offset: int = 0, limit: Optional[int] = None) -> List[WorkflowVisibility]:
         """
-        按状态查询, 例如 'running', 'completed', ...
+        按状态查询, 例如 'running', 'completed', ... (走 idx_visibility_status)
         """
-        stmt = select(WorkflowVisibility).where(WorkflowVisibility.status == status)
-        result = await self.db.execute(stmt)
-        return result.scalars().all()
+        stmt = select(WorkflowVisibility).where(WorkflowVisibility.status == status).order_by(WorkflowVisibility.run_id)
+        return await fetch_streamed(self.db, paginate(stmt, offset, limit))
 
-    async def list_all(self) -> List[WorkflowVisibility]:
+    async def list_by_workflow_type(self, workflow_type: str, offset: int = 0, limit: Optional[int] = None) -> List[WorkflowVisibility]:
         """
-        简单列出所有记录 (小规模适用, 大规模需分页)
+        按工作流类型查询
         """
-        stmt = select(WorkflowVisibility)
-        result = await self.db.execute(stmt)
-        return result.scalars().all()
\ No newline at end of file
+        stmt = (
+            select(WorkflowVisibility)
+            .where(WorkflowVisibility.workflow_type == workflow_type)
+            .order_by(WorkflowVisibility.run_id)
+        )
+        return await fetch_streamed(self.db, paginate(stmt, offset, limit))
+
+    async def list_all(self, offset: int = 0, limit: Optional[int] = None) -> List[WorkflowVisibility]:
+        """
+        列出所有记录, 分页在 SQL 中完成
+        """
+        stmt = select(WorkflowVisibility).order_by(WorkflowVisibility.run_id)
+        return await fetch_streamed(self.db, paginate(stmt, offset, limit))
\ No newline at end of file
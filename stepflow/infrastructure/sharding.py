@@ -0,0 +1,35 @@
+# stepflow/infrastructure/sharding.py
+# 分片: run_id 按稳定的哈希落到固定的 NUM_SHARDS 个分片之一 (创建时写入 shard_id, 之后不再变化),
+# 分片再按最高随机权重 (rendezvous) 哈希分配给存活的 worker:
+# worker 加入或离开时只有它自己的那部分分片需要换主, 其余分片的归属保持不变
+
+import os
+import hashlib
+from typing import Dict, Iterable, List
+
+# 分片总数, 所有进程必须一致. 已有的执行、任务与定时器保留创建时的 shard_id:
+# 调小后 >= NUM_SHARDS 的分片不再分配给任何 worker, 其中的任务与定时器永远不会被认领或触发,
+# 因此还有这样的数据未结束时拒绝启动 (见 ShardManager.check_shard_ids), 调大则不受影响
+NUM_SHARDS = int(os.environ.get("STEPFLOW_NUM_SHARDS", "16"))
+
+def _hash64(key: str) -> int:
+    # 不能用内置 hash(): 它在每个进程中带随机盐
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+def shard_for(run_id: str, num_shards: int = NUM_SHARDS) -> int:
+    """run_id 所属的分片"""
+    return _hash64(run_id) % num_shards
+
+def shard_owner(shard_id: int, members: Iterable[str]) -> str:
+    """按最高随机权重选出分片的持有者, 成员列表相同的 worker 会得到相同的结果"""
+    return max(members, key=lambda member: _hash64(f"{member}:{shard_id}"))
+
+def assign_shards(members: Iterable[str], num_shards: int = NUM_SHARDS) -> Dict[str, List[int]]:
+    """把全部分片分配给成员, 返回 成员 => 分片列表 (没有成员时为空)"""
+    members = sorted(set(members))
+    assignment: Dict[str, List[int]] = {member: [] for member in members}
+    if not members:
+        return assignment
+    for shard_id in range(num_shards):
+        assignment[shard_owner(shard_id, members)].append(shard_id)
+    return assignment
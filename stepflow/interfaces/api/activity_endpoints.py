@@ -4,7 +4,7 @@ from pydantic import BaseModel, ConfigDict
 from datetime import datetime
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from stepflow.infrastructure.database import get_db_session
+from stepflow.infrastructure.database import get_db_session, get_read_db_session
 from stepflow.infrastructure.models import ActivityTask
 from stepflow.infrastructure.repositories.activity_task_repository import ActivityTaskRepository
 from stepflow.application.activity_task_service import ActivityTaskService
@@ -36,14 +36,14 @@ class ActivityTaskDTO(BaseModel):
     model_config = ConfigDict(from_attributes=True)
 
 @router.get("/", response_model=List[ActivityTaskResponse])
-async def list_all_tasks(db: AsyncSession = Depends(get_db_session)):
+async def list_all_tasks(db: AsyncSession = Depends(get_read_db_session)):
     """列出所有活动任务"""
     repo = ActivityTaskRepository(db)
     tasks = await repo.list_all()
     return tasks
 
 @router.get("/{task_token}", response_model=ActivityTaskDTO)
-async def get_task(task_token: str, db=Depends(get_db_session)):
+async def get_task(task_token: str, db=Depends(get_read_db_session)):
     """
     获取单个 Task 的详情
     """
@@ -85,13 +85,17 @@ async def complete_task(task_token: str, req: CompleteRequest, db=Depends(get_db
     """
     repo = ActivityTaskRepository(db)
     svc = ActivityTaskService(repo)
-    task = await svc.complete_task(task_token, req.result_data)
+    task = await svc.get_task(task_token)
     if not task:
         raise HTTPException(status_code=404, detail="Task not found or cannot complete")
     
-    # 推进工作流执行
+    # 任务结果与工作流推进在同一事务中提交
     from stepflow.domain.engine.execution_engine import advance_workflow
-    await advance_workflow(db, task.run_id)
+    await advance_workflow(
+        db,
+        task.run_id,
+        prepare=lambda: svc.complete_task(task_token, req.result_data, commit=False)
+    )
     
     return {"status": "ok", "message": f"Task {task_token} completed"}
 
@@ -102,25 +106,31 @@ async def fail_task(task_token: str, req: FailRequest, db=Depends(get_db_session
     """
     repo = ActivityTaskRepository(db)
     svc = ActivityTaskService(repo)
-    task = await svc.fail_task(task_token, req.reason, req.details)
+    task = await svc.get_task(task_token)
     if not task:
         raise HTTPException(status_code=404, detail="Task not found or cannot fail")
-    
-    # 更新工作流执行状态为失败
-    from stepflow.infrastructure.repositories.workflow_execution_repository import WorkflowExecutionRepository
-    exec_repo = WorkflowExecutionRepository(db)
-    wf_exec = await exec_repo.get_by_run_id(task.run_id)
-    if wf_exec:
-        wf_exec.status = "failed"
-        wf_exec.result = f"Activity task failed: {req.reason}"
-        await exec_repo.update(wf_exec)
+
+    # 与 worker 上报失败走同一个重试判断: Retry 策略允许时只安排重试, 不推进工作流
+    from stepflow.worker.activity_worker import retry_activity_task
+    # 重试在 retry_activity_task 自己的会话中提交: 先结束本会话的读事务, 交还写连接 (SQLite 下只有一个)
+    await db.commit()
+    if task.status == "running" and await retry_activity_task(task, req.reason, req.details, req.error_type):
+        return {"status": "ok", "message": f"Task {task_token} failed, retry scheduled"}
+
+    # 任务失败与工作流推进在同一事务中提交: 匹配 Catch 时转移到降级路径, 否则工作流失败
+    from stepflow.domain.engine.execution_engine import advance_workflow
+    await advance_workflow(
+        db,
+        task.run_id,
+        prepare=lambda: svc.fail_task(task_token, req.reason, req.details, commit=False, error_type=req.error_type)
+    )
     
     return {"status": "ok", "message": f"Task {task_token} failed"}
 
 @router.post("/{task_token}/heartbeat")
-async def heartbeat_task(task_token: str, req: HeartbeatRequest, db=Depends(get_db_session)):
+async def heartbeat_task(task_token: str, req: HeartbeatRequest, db=Depends(get_read_db_session)):
     """
-    发送活动任务心跳
+    发送活动任务心跳 (只读取任务, 心跳经缓冲合并后批量写入)
     """
     repo = ActivityTaskRepository(db)
     svc = ActivityTaskService(repo)
@@ -1,7 +1,7 @@
 from pydantic import BaseModel, ConfigDict
 from typing import Optional, List, Dict, Any, Union
 from datetime import datetime
-import json
+from stepflow.infrastructure import codec
 
 # 工作流模板相关模式
 class WorkflowTemplateBase(BaseModel):
@@ -38,12 +38,12 @@ class WorkflowExecutionCreate(BaseModel):
         if isinstance(self.input, str):
             # 验证是否为有效的JSON
             try:
-                json.loads(self.input)
+                codec.loads(self.input)
                 return self.input
-            except json.JSONDecodeError:
-                return json.dumps({"data": self.input})
+            except codec.JSONDecodeError:
+                return codec.dumps({"data": self.input})
         else:
-            return json.dumps(self.input)
+            return codec.dumps(self.input)
 
     def get_search_attrs_json(self) -> Optional[str]:
         """获取搜索属性的JSON字符串表示"""
@@ -52,12 +52,12 @@ class WorkflowExecutionCreate(BaseModel):
         if isinstance(self.search_attrs, str):
             # 验证是否为有效的JSON
             try:
-                json.loads(self.search_attrs)
+                codec.loads(self.search_attrs)
                 return self.search_attrs
-            except json.JSONDecodeError:
-                return json.dumps({"data": self.search_attrs})
+            except codec.JSONDecodeError:
+                return codec.dumps({"data": self.search_attrs})
         else:
-            return json.dumps(self.search_attrs)
+            return codec.dumps(self.search_attrs)
 
 class WorkflowExecutionResponse(BaseModel):
     run_id: str
@@ -106,6 +106,7 @@ class CompleteRequest(BaseModel):
 class FailRequest(BaseModel):
     reason: str
     details: Optional[str] = None
+    error_type: Optional[str] = None  # 错误名, 用于匹配 Catch 的 ErrorEquals
 
 class HeartbeatRequest(BaseModel):
     details: Optional[str] = None
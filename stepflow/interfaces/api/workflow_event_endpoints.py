@@ -3,7 +3,7 @@ from typing import Optional, List
 from datetime import datetime
 from pydantic import BaseModel, ConfigDict
 
-from stepflow.infrastructure.database import get_db_session
+from stepflow.infrastructure.database import get_db_session, get_read_db_session
 from stepflow.infrastructure.models import WorkflowEvent
 from stepflow.infrastructure.repositories.workflow_event_repository import WorkflowEventRepository
 from stepflow.application.workflow_event_service import WorkflowEventService
@@ -44,7 +44,7 @@ async def list_all_events(db=Depends(get_db_session)):
     return events
 
 @router.get("/run/{run_id}", response_model=List[WorkflowEventDTO])
-async def list_events_for_run(run_id: str, db=Depends(get_db_session)):
+async def list_events_for_run(run_id: str, db=Depends(get_read_db_session)):
     """
     列出指定 run_id 的全部事件
     """
@@ -54,7 +54,7 @@ async def list_events_for_run(run_id: str, db=Depends(get_db_session)):
     return evts
 
 @router.get("/{db_id}", response_model=WorkflowEventDTO)
-async def get_event(db_id: int, db=Depends(get_db_session)):
+async def get_event(db_id: int, db=Depends(get_read_db_session)):
     """
     根据DB主键id获取事件
     """
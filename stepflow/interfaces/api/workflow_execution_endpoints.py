@@ -8,7 +8,7 @@ from sqlalchemy import select
 
 from stepflow.infrastructure.repositories.workflow_execution_repository import WorkflowExecutionRepository
 from stepflow.infrastructure.repositories.activity_task_repository import ActivityTaskRepository
-from stepflow.infrastructure.database import get_db_session
+from stepflow.infrastructure.database import get_db_session, get_read_db_session
 from stepflow.infrastructure.models import WorkflowExecution, ActivityTask
 from stepflow.application.workflow_execution_service import WorkflowExecutionService
 from stepflow.application.workflow_template_service import WorkflowTemplateService
@@ -57,7 +57,7 @@ async def start_workflow(req: StartExecutionRequest, db: Session = Depends(get_d
     }
 
 @router.get("/{run_id}")
-async def get_execution(run_id: str, db: Session = Depends(get_db_session)):
+async def get_execution(run_id: str, db: Session = Depends(get_read_db_session)):
     repo = WorkflowExecutionRepository(db)
     service = WorkflowExecutionService(repo)
     wf = await service.get_execution(run_id)
@@ -76,7 +76,7 @@ async def get_execution(run_id: str, db: Session = Depends(get_db_session)):
     }
 
 @router.get("/{run_id}/tasks", response_model=List[Dict[str, Any]])
-async def get_workflow_execution_tasks(run_id: str, db: AsyncSession = Depends(get_db_session)):
+async def get_workflow_execution_tasks(run_id: str, db: AsyncSession = Depends(get_read_db_session)):
     """获取工作流执行的所有活动任务"""
     # 查询活动任务
     stmt = select(ActivityTask).where(ActivityTask.run_id == run_id)
@@ -116,8 +116,10 @@ async def update_template(
         existing.name = template_update.name
     if template_update.description is not None:
         existing.description = template_update.description
-    if template_update.dsl_definition is not None:
+    if template_update.dsl_definition is not None and template_update.dsl_definition != existing.dsl_definition:
         existing.dsl_definition = template_update.dsl_definition
+        # DSL 变化 => 版本号递增, 使已编译模板缓存失效
+        existing.version = existing.version + 1
     
     existing.updated_at = datetime.now()
     
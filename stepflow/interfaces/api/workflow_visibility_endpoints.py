@@ -2,7 +2,7 @@ from fastapi import APIRouter, Depends, HTTPException
 from typing import List, Optional
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from stepflow.infrastructure.database import get_db_session
+from stepflow.infrastructure.database import get_db_session, get_read_db_session
 from stepflow.infrastructure.repositories.workflow_visibility_repository import WorkflowVisibilityRepository
 from stepflow.application.workflow_visibility_service import WorkflowVisibilityService
 from stepflow.interfaces.api.schemas import WorkflowVisibilityResponse
@@ -57,7 +57,7 @@ async def list_workflow_visibility(
     workflow_type: Optional[str] = None,
     skip: int = 0,
     limit: int = 100,
-    db: AsyncSession = Depends(get_db_session)
+    db: AsyncSession = Depends(get_read_db_session)
 ):
     """
     列出工作流可见性信息
@@ -65,11 +65,12 @@ async def list_workflow_visibility(
     repo = WorkflowVisibilityRepository(db)
     service = WorkflowVisibilityService(repo)
     
+    # 分页下推到 SQL, 结果经服务端游标分批读取
     if status:
-        visibilities = await service.list_by_status(status)
+        visibilities = await service.list_by_status(status, skip, limit)
     elif workflow_type:
-        visibilities = await service.list_by_workflow_type(workflow_type)
+        visibilities = await service.list_by_workflow_type(workflow_type, skip, limit)
     else:
-        visibilities = await service.list_all()
+        visibilities = await service.list_all(skip, limit)
     
-    return visibilities[skip : skip + limit]
\ No newline at end of file
+    return visibilities
\ No newline at end of file
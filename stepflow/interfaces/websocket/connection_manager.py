@@ -1,7 +1,7 @@
-import json
 import logging
 from typing import Dict, List, Any, Optional
 from fastapi import WebSocket
+from stepflow.infrastructure import codec
 
 logger = logging.getLogger(__name__)
 
@@ -57,7 +57,7 @@ class ConnectionManager:
             
         # 将消息转换为 JSON 字符串
         if not isinstance(message, str):
-            message = json.dumps(message)
+            message = codec.dumps(message)
             
         # 发送消息，忽略断开的连接
         disconnected = []
@@ -80,7 +80,7 @@ class ConnectionManager:
             
         # 将消息转换为 JSON 字符串
         if not isinstance(message, str):
-            message = json.dumps(message)
+            message = codec.dumps(message)
             
         # 发送消息，忽略断开的连接
         disconnected = []
@@ -8,7 +8,7 @@ import logging
 from concurrent.futures import ThreadPoolExecutor
 
 # 导入数据库
-from stepflow.infrastructure.database import Base, async_engine
+from stepflow.infrastructure.database import Base, async_engine, dispose_engines
 
 # 导入各个路由
 from stepflow.interfaces.api.workflow_visibility_endpoints import router as vis_router
@@ -24,6 +24,10 @@ from stepflow.interfaces.websocket.routes import router as websocket_router
 # 导入 Worker 协程函数
 from stepflow.worker.activity_worker import run_activity_worker
 from stepflow.worker.timer_worker import run_timer_worker
+from stepflow.worker.task_reaper import run_task_reaper
+from stepflow.worker.shard_manager import shard_manager
+from stepflow.worker.tools.tool_registry import close_tools
+from stepflow.infrastructure.heartbeat_buffer import heartbeat_buffer
 
 # 设置 logger
 logger = logging.getLogger(__name__)
@@ -36,6 +40,9 @@ async def lifespan(app: FastAPI):
     async with async_engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
     
+    # 分片数被调小而旧分片上仍有未结束的工作时拒绝启动
+    await shard_manager.check_shard_ids()
+
     # 启动活动工作器
     workers = await start_activity_workers()
     app.state.workers = workers
@@ -52,6 +59,10 @@ async def lifespan(app: FastAPI):
         await asyncio.gather(*app.state.workers, return_exceptions=True)
         logger.info("所有活动工作器已关闭")
 
+    # 工作器停止后再关闭工具持有的连接池
+    await close_tools()
+    await dispose_engines()
+
 # Create app with lifespan
 app = FastAPI(title="StepFlow API", description="工作流执行引擎 API", lifespan=lifespan)
 
@@ -79,10 +90,17 @@ NUM_WORKERS = int(os.environ.get("NUM_ACTIVITY_WORKERS", "2"))
 # 创建工作器启动函数
 async def start_activity_workers():
     """启动多个活动工作器"""
-    workers = []
+    # 本进程持有的分片, 多个进程之间按分片分摊任务与定时器
+    workers = [asyncio.create_task(shard_manager.run())]
     for i in range(NUM_WORKERS):
         worker = asyncio.create_task(run_activity_worker())
         workers.append(worker)
+    # 工作器与心跳接口记录的心跳由它批量写入
+    workers.append(asyncio.create_task(heartbeat_buffer.run()))
+    # 到期的 Wait 与重试定时器由它触发
+    workers.append(asyncio.create_task(run_timer_worker()))
+    # 本进程 worker 认领后失联 (租约或心跳超时) 的任务由它回收
+    workers.append(asyncio.create_task(run_task_reaper()))
     
     return workers
 
@@ -1,20 +1,27 @@
 # stepflow/worker/activity_worker.py
 
 import asyncio
-import json
 import logging
-from datetime import datetime, UTC
-from typing import Optional, Dict, Any, List
+from datetime import datetime, timedelta, UTC
+from typing import Optional, Dict, Any, List, Awaitable
 import traceback
 import os
+import socket
+import uuid
 
-from sqlalchemy import select
 from stepflow.infrastructure.database import AsyncSessionLocal
 from stepflow.infrastructure.models import ActivityTask
 from stepflow.application.activity_task_service import ActivityTaskService
-from stepflow.infrastructure.repositories.activity_task_repository import ActivityTaskRepository
+from stepflow.application.timer_service import TimerService
+from stepflow.infrastructure.repositories.activity_task_repository import ActivityTaskRepository, lease_deadline
+from stepflow.infrastructure.repositories.timer_repository import TimerRepository
 from stepflow.domain.engine.execution_engine import advance_workflow
+from stepflow.domain.engine.retry import next_retry_delay
+from stepflow.infrastructure.dispatch_notifier import dispatch_notifier, AdaptivePoller, ACTIVITY_CHANNEL, TIMER_CHANNEL
+from stepflow.infrastructure.heartbeat_buffer import heartbeat_buffer
+from stepflow.infrastructure import codec
 from .tools.tool_registry import tool_registry
+from .shard_manager import shard_manager
 
 # 配置日志
 logger = logging.getLogger(__name__)
@@ -30,86 +37,115 @@ logger.addHandler(console_handler)
 # 配置并行处理的任务数量
 MAX_CONCURRENT_TASKS = int(os.environ.get("MAX_CONCURRENT_TASKS", "10"))
 
-async def run_activity_worker():
+# 认领任务的租约时长 (秒), 超过后任务可被判定为失联
+TASK_LEASE_SECONDS = int(os.environ.get("TASK_LEASE_SECONDS", "300"))
+
+# 槽位之外额外预取到内部队列的任务数
+TASK_PREFETCH = int(os.environ.get("TASK_PREFETCH", "2"))
+
+def new_worker_id() -> str:
+    """生成 worker 标识: 主机名-进程号-随机后缀"""
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+async def run_activity_worker(worker_id: Optional[str] = None):
     """
-    周期性扫描 DB 中 status='scheduled' 的 ActivityTask, 并行执行任务
+    认领 DB 中 status='scheduled' 的 ActivityTask, 并行执行任务.
+    认领是原子的, 多个 worker 可以同时运行而不会重复执行同一个任务;
+    引擎调度新任务后会立即唤醒空闲的 worker, 轮询只作为自适应的兜底.
+
+    执行是流水线式的: MAX_CONCURRENT_TASKS 个常驻槽位从内部队列取任务,
+    任意一个槽位空出来就补充认领, 队列中最多额外预取 TASK_PREFETCH 个任务,
+    慢任务不会让其余槽位空等整批结束
     """
-    logger.info(f"活动工作器启动，最大并行任务数: {MAX_CONCURRENT_TASKS}")
-    
-    while True:
-        try:
-            # 1) 取 "scheduled" tasks
-            tasks = await get_scheduled_tasks()
-            
-            if tasks:
-                logger.info(f"找到 {len(tasks)} 个待处理的活动任务")
+    worker_id = worker_id or new_worker_id()
+    logger.info(f"活动工作器 {worker_id} 启动，最大并行任务数: {MAX_CONCURRENT_TASKS}, 预取: {TASK_PREFETCH}")
+    poller = AdaptivePoller(dispatch_notifier, ACTIVITY_CHANNEL)
+    queue: asyncio.Queue = asyncio.Queue()
+    slot_freed = asyncio.Event()
+    busy = [0]
+
+    async def slot_loop(slot: int):
+        while True:
+            task = await queue.get()
+            busy[0] += 1
+            try:
+                await process_activity_task(task)
+            except Exception as e:
+                logger.exception(f"槽位 {slot} 处理任务 {task.task_token} 时出错: {str(e)}")
+            finally:
+                busy[0] -= 1
+                queue.task_done()
+                slot_freed.set()
+
+    slots = [asyncio.create_task(slot_loop(i)) for i in range(MAX_CONCURRENT_TASKS)]
+    try:
+        while True:
+            # 空闲槽位 + 预取深度 - 已在队列中的任务 = 本次可以认领的数量
+            capacity = MAX_CONCURRENT_TASKS - busy[0] + TASK_PREFETCH - queue.qsize()
+            if capacity <= 0:
+                slot_freed.clear()
+                await slot_freed.wait()
+                continue
+
+            tasks = []
+            try:
+                tasks = await claim_tasks(worker_id, capacity)
+                if tasks:
+                    logger.info(f"认领到 {len(tasks)} 个待处理的活动任务")
                 for task in tasks:
                     logger.info(f"待处理任务: token={task.task_token}, 类型={task.activity_type}")
-                
-                # 2) 标记为running
-                await mark_tasks_as_running(tasks)
-                
-                # 3) 并行执行任务
-                await process_tasks_concurrently(tasks)
-            
-        except Exception as e:
-            logger.exception(f"活动工作器循环中发生错误: {str(e)}")
-        
-        # 4) 间隔轮询
-        await asyncio.sleep(5)
+                    queue.put_nowait(task)
+            except Exception as e:
+                logger.exception(f"活动工作器循环中发生错误: {str(e)}")
+
+            # 认满则立即继续, 否则等待通知或退避后的轮询间隔
+            await poller.wait(len(tasks), capacity)
+    finally:
+        for slot in slots:
+            slot.cancel()
+        await asyncio.gather(*slots, return_exceptions=True)
+        # 已预取但尚未开始的任务交还给其他 worker
+        pending = []
+        while not queue.empty():
+            pending.append(queue.get_nowait().task_token)
+        if pending:
+            await release_tasks(worker_id, pending)
 
-async def get_scheduled_tasks(limit: int = MAX_CONCURRENT_TASKS) -> List[ActivityTask]:
-    """获取待处理的任务，限制数量以控制并行度"""
-    logger.info(f"查询待处理任务，限制数量: {limit}")
+async def claim_tasks(worker_id: str, limit: int = MAX_CONCURRENT_TASKS) -> List[ActivityTask]:
+    """原子地认领待处理的任务，限制数量以控制并行度; 启用分片时只认领本进程持有的分片"""
+    shard_ids = shard_manager.owned_shards()
+    if shard_ids is not None and not shard_ids:
+        return []
     async with AsyncSessionLocal() as session:
-        result = await session.execute(
-            select(ActivityTask)
-            .where(ActivityTask.status == 'scheduled')
-            .limit(limit)
-        )
-        tasks = result.scalars().all()
-        logger.info(f"查询到 {len(tasks)} 个待处理任务")
+        service = ActivityTaskService(ActivityTaskRepository(session))
+        tasks = await service.claim_tasks(worker_id, limit, TASK_LEASE_SECONDS, shard_ids)
+        logger.debug(f"worker {worker_id} 认领到 {len(tasks)} 个任务")
         return tasks
 
-async def mark_tasks_as_running(tasks: List[ActivityTask]) -> None:
-    """将任务标记为运行中"""
-    logger.info(f"标记 {len(tasks)} 个任务为运行中")
-    async with AsyncSessionLocal() as session:
-        for task in tasks:
-            # 重新获取任务以避免会话问题
-            db_task = await session.get(ActivityTask, task.task_token)
-            if db_task and db_task.status == 'scheduled':
-                db_task.status = 'running'
-                db_task.started_at = datetime.now(UTC)
-                logger.info(f"任务 {db_task.task_token} 已标记为运行中")
-        await session.commit()
-        logger.info("所有任务状态更新已提交")
-
-async def process_tasks_concurrently(tasks: List[ActivityTask]) -> None:
-    """并行处理多个任务"""
-    logger.info(f"开始并行处理 {len(tasks)} 个任务")
-    # 创建任务协程列表
-    coroutines = [process_activity_task(task) for task in tasks]
-    
-    # 使用 gather 并行执行所有任务
-    await asyncio.gather(*coroutines, return_exceptions=True)
-    logger.info("所有任务处理完成")
+async def release_tasks(worker_id: str, task_tokens: List[str]) -> None:
+    """把已认领但尚未执行的任务恢复为 scheduled"""
+    try:
+        async with AsyncSessionLocal() as session:
+            service = ActivityTaskService(ActivityTaskRepository(session))
+            released = await service.release_tasks(worker_id, task_tokens)
+            logger.info(f"worker {worker_id} 交还了 {released} 个预取任务")
+    except Exception as e:
+        logger.exception(f"交还预取任务时出错: {str(e)}")
 
 async def process_activity_task(task: ActivityTask):
-    """处理单个活动任务"""
+    """
+    处理单个活动任务.
+    认领时已经写入了 running 状态与 started_at, 这里不再单独提交一次"开始执行";
+    任务结果与由它触发的工作流推进在同一个事务中提交
+    """
     logger.info(f"开始处理任务: {task.task_token}, 类型: {task.activity_type}")
-    service = ActivityTaskService(ActivityTaskRepository(AsyncSessionLocal()))
     
     try:
-        # 1) 标记为开始执行
-        await service.start_task(task.task_token)
-        logger.info(f"任务 {task.task_token} 已标记为开始执行")
-        
-        # 2) 解析输入参数
-        input_data = json.loads(task.input) if task.input else {}
+        # 1) 解析输入参数
+        input_data = codec.loads(task.input) if task.input else {}
         logger.info(f"任务输入参数: {input_data}")
         
-        # 3) 获取活动类型并执行
+        # 2) 获取活动类型并执行
         activity_type = task.activity_type
         
         # 从工具注册表中获取对应的工具
@@ -120,7 +156,7 @@ async def process_activity_task(task: ActivityTask):
         
         # 执行工具
         logger.info(f"开始执行活动任务: {task.task_token}, 类型: {activity_type}, 工具类: {type(tool).__name__}")
-        result = await tool.execute(input_data)
+        result = await run_with_heartbeats(task, tool.execute(input_data))
         logger.info(f"活动任务执行完成: {task.task_token}")
         
         # 检查结果是否包含错误
@@ -129,52 +165,128 @@ async def process_activity_task(task: ActivityTask):
             error_msg = result.get("error", "Unknown error")
             error_details = result.get("error_details", "")
             logger.error(f"工具执行失败: {error_msg}")
-            
-            await service.fail_task(
-                task.task_token,
-                reason=error_msg,
-                details=error_details
-            )
-            logger.info(f"任务 {task.task_token} 已标记为失败")
-            
-            # 通知引擎工作流失败
-            logger.info(f"推进工作流 (失败): {task.run_id}")
-            await call_advance_workflow(task.run_id)
+            await finish_activity_task(task, error=error_msg, details=error_details, error_type=result.get("error_type"))
             return
         
-        # 4) 标记为完成
+        # 3) 标记为完成
         result_data = result if isinstance(result, dict) else {"result": result}
         logger.info(f"任务结果: {result_data}")
-        await service.complete_task(
-            task.task_token,
-            result_data=json.dumps(result_data)
-        )
-        logger.info(f"任务 {task.task_token} 已标记为完成")
-        
-        # 通知引擎 => 让 workflow 往下走
-        logger.info(f"推进工作流: {task.run_id}")
-        await call_advance_workflow(task.run_id)
+        await finish_activity_task(task, result_data=codec.dumps(result_data))
 
     except Exception as e:
         logger.exception(f"处理活动任务 {task.task_token} 时出错: {str(e)}")
         # 标记任务为失败
-        await service.fail_task(
-            task.task_token,
-            reason=f"Exception during task execution: {str(e)}",
+        await finish_activity_task(
+            task,
+            error=f"Exception during task execution: {str(e)}",
             details=traceback.format_exc()
         )
-        logger.info(f"任务 {task.task_token} 已标记为失败")
-        
-        # 通知引擎工作流失败
-        logger.info(f"推进工作流 (失败): {task.run_id}")
-        await call_advance_workflow(task.run_id)
 
-async def call_advance_workflow(run_id: str):
-    """让引擎推进下一个节点"""
-    logger.info(f"调用引擎推进工作流: {run_id}")
+def heartbeat_interval(task: ActivityTask) -> float:
+    """执行期间自动心跳的间隔: 心跳超时 (或认领租约) 的三分之一"""
+    window = min(task.heartbeat_seconds or TASK_LEASE_SECONDS, TASK_LEASE_SECONDS)
+    return max(window / 3, 0.1)
+
+async def run_with_heartbeats(task: ActivityTask, execution: Awaitable[Any]) -> Any:
+    """
+    执行工具的同时定期记录心跳并续租, 长时间运行的 ShellTool/HttpTool 不会被回收器误判为失联;
+    心跳经 heartbeat_buffer 合并后批量写入
+    """
+    interval = heartbeat_interval(task)
+
+    async def pulse():
+        while True:
+            await asyncio.sleep(interval)
+            now = datetime.now(UTC)
+            heartbeat_buffer.record(
+                task.task_token, task.worker_id, now, lease_deadline(task, now, TASK_LEASE_SECONDS),
+                current_expiry=task.lease_expiry
+            )
+
+    pulser = asyncio.create_task(pulse())
+    try:
+        return await execution
+    finally:
+        pulser.cancel()
+        # 结果马上就会写入, 尚未写入的心跳不再需要
+        heartbeat_buffer.discard(task.task_token)
+
+class TaskNoLongerOwned(Exception):
+    """任务已被回收器接管、因租约到期重新排队或已取消, 本次执行的结果不再写入"""
+
+async def finish_activity_task(
+    task: ActivityTask,
+    result_data: Optional[str] = None,
+    error: Optional[str] = None,
+    details: Optional[str] = None,
+    error_type: Optional[str] = None
+) -> None:
+    """
+    写入任务结果 (error 不为空时标记失败) 并推进工作流:
+    任务结果用一条条件 UPDATE (task_token + worker_id + status='running') 登记到会话中,
+    由 advance_workflow 与推进结果一起提交一次; 任务已不归本次执行持有时放弃整个事务.
+    失败且 Retry 策略允许重试时只安排重试, 不推进工作流
+    """
+    if error is not None and await retry_activity_task(task, error, details, error_type):
+        return
+    outcome = "失败" if error is not None else "完成"
+    logger.info(f"任务 {task.task_token} 标记为{outcome}, 推进工作流: {task.run_id}")
     try:
         async with AsyncSessionLocal() as session:
-            await advance_workflow(session, run_id)
-            logger.info(f"工作流 {run_id} 推进成功")
+            service = ActivityTaskService(ActivityTaskRepository(session))
+
+            async def stage_outcome():
+                # 版本冲突重试时回滚后重新写入, 每次都重新确认任务仍由本次执行持有
+                if error is not None:
+                    staged = await service.fail_task(
+                        task.task_token, reason=error, details=details, commit=False, error_type=error_type, owner=task
+                    )
+                else:
+                    staged = await service.complete_task(task.task_token, result_data=result_data, commit=False, owner=task)
+                if staged is None:
+                    raise TaskNoLongerOwned(task.task_token)
+
+            await advance_workflow(session, task.run_id, prepare=stage_outcome)
+            # 工作流已结束时推进不会提交, 任务结果仍要写入
+            await session.commit()
+            logger.info(f"工作流 {task.run_id} 推进成功")
+    except TaskNoLongerOwned:
+        logger.warning(f"任务 {task.task_token} 已被回收器接管或重新排队, 丢弃本次结果")
+    except Exception as e:
+        logger.exception(f"记录任务 {task.task_token} 结果并推进工作流 {task.run_id} 时出错: {str(e)}")
+
+async def retry_activity_task(
+    task: ActivityTask,
+    error: str,
+    details: Optional[str] = None,
+    error_type: Optional[str] = None
+) -> bool:
+    """
+    按任务的重试策略安排重试: 任务改为 retrying, 同时创建一个 activity_retry 定时器,
+    两者一起提交. 返回 False 表示不重试 (没有匹配的重试器或次数已用完)
+    """
+    delay = next_retry_delay(task.retry_policy, task.attempt or 1, error_type)
+    if delay is None:
+        return False
+    try:
+        async with AsyncSessionLocal() as session:
+            tasks = ActivityTaskService(ActivityTaskRepository(session))
+            timers = TimerService(TimerRepository(session))
+            if await tasks.retry_task(task.task_token, error, details, commit=False, error_type=error_type, owner=task) is None:
+                logger.warning(f"任务 {task.task_token} 已被回收器接管或重新排队, 不再安排重试")
+                return True
+            await timers.schedule_timer(
+                task.run_id,
+                task.shard_id,
+                datetime.now(UTC) + timedelta(seconds=delay),
+                timer_type="activity_retry",
+                task_token=task.task_token,
+                commit=False
+            )
+            await session.commit()
     except Exception as e:
-        logger.exception(f"推进工作流 {run_id} 时出错: {str(e)}")
\ No newline at end of file
+        logger.exception(f"安排任务 {task.task_token} 重试时出错, 按失败处理: {str(e)}")
+        return False
+    dispatch_notifier.notify(TIMER_CHANNEL)
+    logger.info(f"任务 {task.task_token} 第 {task.attempt} 次执行失败, {delay:.1f} 秒后重试: {error}")
+    return True
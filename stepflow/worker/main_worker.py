@@ -2,13 +2,25 @@
 
 import asyncio
 from .activity_worker import run_activity_worker
-# 如果有 TimerWorker, from .timer_worker import run_timer_worker
+from .timer_worker import run_timer_worker
+from .task_reaper import run_task_reaper
+from .shard_manager import shard_manager
+from stepflow.infrastructure.heartbeat_buffer import heartbeat_buffer
 
 async def main_worker():
+    # 分片数被调小而旧分片上仍有未结束的工作时拒绝启动
+    await shard_manager.check_shard_ids()
     # 如果你有多个 worker, 可以 gather
     workers = [
+        # 持有分片的租约, 下面的 worker 只处理本进程持有的分片
+        asyncio.create_task(shard_manager.run()),
         asyncio.create_task(run_activity_worker()),
-        # asyncio.create_task(run_timer_worker()),
+        # 活动任务的重试由定时器驱动
+        asyncio.create_task(run_timer_worker()),
+        # 回收租约到期 (worker 失联或超时) 的任务
+        asyncio.create_task(run_task_reaper()),
+        # 合并后批量写入心跳
+        asyncio.create_task(heartbeat_buffer.run()),
     ]
     await asyncio.gather(*workers)
 
@@ -0,0 +1,133 @@
+# stepflow/worker/shard_manager.py
+
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta, UTC
+from typing import Callable, FrozenSet, Optional
+
+from stepflow.infrastructure.repositories.shard_lease_repository import ShardLeaseRepository
+from stepflow.infrastructure.sharding import NUM_SHARDS, assign_shards
+from stepflow.infrastructure.dispatch_notifier import dispatch_notifier, ACTIVITY_CHANNEL, TIMER_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+# 分片租约与成员登记的有效期 (秒), worker 崩溃后最多这么久分片就会被其他 worker 接管
+SHARD_LEASE_SECONDS = int(os.environ.get("STEPFLOW_SHARD_LEASE_SECONDS", "30"))
+# 续租并重新计算分配的间隔 (秒), 必须明显小于租约有效期
+SHARD_RENEW_INTERVAL = float(os.environ.get("STEPFLOW_SHARD_RENEW_INTERVAL", "10"))
+
+class ShardManager:
+    """
+    进程内的分片归属: 登记本进程为存活成员, 按成员列表计算应持有的分片,
+    交出不再属于自己的分片并获取 (续期) 属于自己的分片.
+    同一进程中的活动 worker、定时器 worker 与回收器只处理 owned_shards() 中的分片.
+
+    未启动时 owned_shards() 返回 None, 表示不按分片过滤 (单进程部署与测试保持原来的行为).
+    分片归属只用于分摊负载: 任务认领、定时器触发本身仍是原子的,
+    租约交接的短暂重叠不会导致重复执行
+    """
+
+    def __init__(
+        self,
+        member_id: Optional[str] = None,
+        num_shards: int = NUM_SHARDS,
+        lease_seconds: int = SHARD_LEASE_SECONDS,
+        session_factory: Optional[Callable] = None
+    ):
+        self.member_id = member_id
+        self.num_shards = num_shards
+        self.lease_seconds = lease_seconds
+        self._session_factory = session_factory
+        self._owned: Optional[FrozenSet[int]] = None
+        self._valid_until: Optional[datetime] = None
+
+    def owned_shards(self, now: Optional[datetime] = None) -> Optional[FrozenSet[int]]:
+        """本进程持有的分片; 租约没能按时续期时视为不再持有任何分片"""
+        if self._owned is None:
+            return None
+        now = now or datetime.now(UTC)
+        if self._valid_until is None or now >= self._valid_until:
+            return frozenset()
+        return self._owned
+
+    async def check_shard_ids(self) -> None:
+        """
+        启动前检查: 未结束的执行、任务或定时器仍在 >= num_shards 的分片上 (分片数被调小) 时拒绝启动,
+        否则这些分片不会分配给任何成员, 其中的任务与定时器会一直无人处理
+        """
+        async with self._new_session() as session:
+            max_shard_id = await ShardLeaseRepository(session).max_pending_shard_id()
+        if max_shard_id is not None and max_shard_id >= self.num_shards:
+            raise RuntimeError(
+                f"STEPFLOW_NUM_SHARDS={self.num_shards} but unfinished work exists on shard {max_shard_id}; "
+                f"keep STEPFLOW_NUM_SHARDS at least {max_shard_id + 1} until it drains"
+            )
+
+    async def rebalance(self, now: Optional[datetime] = None) -> FrozenSet[int]:
+        """续期成员登记, 按当前存活的成员重新分配分片, 返回本进程现在持有的分片"""
+        now = now or datetime.now(UTC)
+        if self.member_id is None:
+            self.member_id = f"shard-{uuid.uuid4().hex[:8]}"
+        async with self._new_session() as session:
+            repo = ShardLeaseRepository(session)
+            await repo.ensure_shards(self.num_shards)
+            await repo.register_member(self.member_id, now, self.lease_seconds)
+            members = await repo.list_live_members(now)
+            desired = assign_shards(members, self.num_shards).get(self.member_id, [])
+            # 先交出分配给其他成员的分片, 新加入的成员在它的下一次续期时即可获取
+            held = await repo.list_owned(self.member_id, now)
+            await repo.release([s for s in held if s not in desired], self.member_id)
+            # 仍由其他 (存活的) 成员持有的分片要等对方交出或租约到期
+            acquired = await repo.acquire(desired, self.member_id, now, self.lease_seconds)
+
+        owned = frozenset(acquired)
+        changed = owned != self._owned
+        self._owned = owned
+        self._valid_until = now + timedelta(seconds=self.lease_seconds)
+        if changed:
+            logger.info(f"成员 {self.member_id} 持有分片 {sorted(owned)} (共 {len(members)} 个成员)")
+            # 新获得的分片中可能已有待处理的任务与定时器
+            dispatch_notifier.notify(ACTIVITY_CHANNEL)
+            dispatch_notifier.notify(TIMER_CHANNEL)
+        return owned
+
+    async def leave(self) -> None:
+        """正常退出: 交出全部分片并注销成员, 其他成员下一次续期时接手"""
+        owned, self._owned = self._owned, frozenset()
+        if self.member_id is None:
+            return
+        async with self._new_session() as session:
+            repo = ShardLeaseRepository(session)
+            if owned:
+                await repo.release(sorted(owned), self.member_id)
+            await repo.remove_member(self.member_id)
+
+    def _new_session(self):
+        if self._session_factory is None:
+            from stepflow.infrastructure.database import AsyncSessionLocal
+            return AsyncSessionLocal()
+        return self._session_factory()
+
+    async def run(self, member_id: Optional[str] = None, interval: float = SHARD_RENEW_INTERVAL) -> None:
+        """后台定期续租与重新分配, 取消时交出分片"""
+        if member_id is not None:
+            self.member_id = member_id
+        # 获得租约之前不认领任何分片
+        self._owned = frozenset()
+        try:
+            while True:
+                try:
+                    await self.rebalance()
+                except Exception as e:
+                    logger.exception(f"分片重新分配时出错: {str(e)}")
+                await asyncio.sleep(interval)
+        finally:
+            try:
+                await self.leave()
+            except Exception as e:
+                logger.exception(f"交出分片时出错: {str(e)}")
+
+# 进程级共享实例
+shard_manager = ShardManager()
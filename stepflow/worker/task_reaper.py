@@ -0,0 +1,99 @@
+# stepflow/worker/task_reaper.py
+
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta, UTC
+from typing import Dict, Optional, Tuple
+
+from stepflow.infrastructure.database import AsyncSessionLocal
+from stepflow.infrastructure.models import ActivityTask
+from stepflow.application.activity_task_service import ActivityTaskService
+from stepflow.infrastructure.repositories.activity_task_repository import ActivityTaskRepository, as_utc
+from stepflow.infrastructure.dispatch_notifier import dispatch_notifier, ACTIVITY_CHANNEL
+from stepflow.domain.engine.retry import TIMEOUT_ERROR, TASK_FAILED_ERROR
+from .activity_worker import finish_activity_task, new_worker_id, TASK_LEASE_SECONDS
+from .shard_manager import shard_manager
+
+logger = logging.getLogger(__name__)
+
+# 扫描到期租约的间隔 (秒), 一批处理满时立即继续
+REAPER_INTERVAL = float(os.environ.get("STEPFLOW_REAPER_INTERVAL", "5"))
+# 每批处理的到期任务数
+REAPER_BATCH_SIZE = int(os.environ.get("STEPFLOW_REAPER_BATCH_SIZE", "100"))
+
+def timeout_reason(task: ActivityTask, now: datetime) -> Optional[str]:
+    """
+    租约到期的原因: 超过 TimeoutSeconds 或 HeartbeatSeconds 时返回说明 (按 States.Timeout 失败),
+    都没有超过时返回 None, 表示只是认领的 worker 失联
+    """
+    started_at = as_utc(task.started_at)
+    if task.timeout_seconds and started_at and started_at + timedelta(seconds=task.timeout_seconds) <= now:
+        return f"Task timed out after {task.timeout_seconds} seconds"
+    last_beat = as_utc(task.heartbeat_at) or started_at
+    if task.heartbeat_seconds and last_beat and last_beat + timedelta(seconds=task.heartbeat_seconds) <= now:
+        return f"No heartbeat received for {task.heartbeat_seconds} seconds"
+    return None
+
+def lost_lease_exhausted(task: ActivityTask) -> bool:
+    """worker 失联时这已是任务允许的最后一次执行 (重新排队也计入 attempt, 上限为 Retry 的总次数)"""
+    return (task.attempt or 1) >= (task.max_attempts or 1)
+
+async def reap_expired_tasks(reaper_id: str, now: Optional[datetime] = None, limit: int = REAPER_BATCH_SIZE) -> int:
+    """
+    处理一批租约到期的 running 任务, 返回扫描到的数量:
+    - worker 失联 (没有超时): 重新排队 (attempt + 1), 由其他 worker 再次执行;
+      执行次数已达到上限时按失败处理, 反复让 worker 崩溃的任务不会无限重新排队
+    - 超时: 接管后按 States.Timeout 失败
+    接管的任务与 worker 上报的失败一样经过 Retry/Catch 并推进工作流
+    """
+    now = now or datetime.now(UTC)
+    # 启用分片时只回收本进程持有的分片中的任务
+    shard_ids = shard_manager.owned_shards(now)
+    async with AsyncSessionLocal() as session:
+        service = ActivityTaskService(ActivityTaskRepository(session))
+        expired = await service.list_expired_tasks(now, limit, shard_ids)
+        if not expired:
+            return 0
+        # task_token => (失败原因, 错误名); 不在其中的任务重新排队
+        failures: Dict[str, Tuple[str, str]] = {}
+        lost = []
+        for task in expired:
+            reason = timeout_reason(task, now)
+            if reason is not None:
+                failures[task.task_token] = (reason, TIMEOUT_ERROR)
+            elif lost_lease_exhausted(task):
+                failures[task.task_token] = (
+                    f"Worker lost the task lease on attempt {task.attempt or 1} of {task.max_attempts or 1}",
+                    TASK_FAILED_ERROR
+                )
+            else:
+                lost.append(task.task_token)
+
+        requeued = await service.requeue_expired_tasks(lost, now) if lost else 0
+        taken = await service.take_over_expired_tasks(list(failures), reaper_id, now, TASK_LEASE_SECONDS) if failures else []
+
+    if requeued:
+        logger.warning(f"回收器 {reaper_id} 重新排队了 {requeued} 个 worker 失联的任务")
+        dispatch_notifier.notify(ACTIVITY_CHANNEL)
+    for task in taken:
+        reason, error_type = failures[task.task_token]
+        logger.warning(f"任务 {task.task_token} 按失败处理: {reason}")
+        await finish_activity_task(task, error=reason, error_type=error_type)
+    return len(expired)
+
+async def run_task_reaper(reaper_id: Optional[str] = None):
+    """
+    后台协程: 按 (status, lease_expiry) 索引分批查找租约到期的任务,
+    重新排队或按超时失败, 避免 worker 崩溃后任务与工作流永远停在 running
+    """
+    reaper_id = reaper_id or f"reaper-{new_worker_id()}"
+    logger.info(f"任务回收器 {reaper_id} 启动, 间隔 {REAPER_INTERVAL} 秒, 每批 {REAPER_BATCH_SIZE} 个")
+    while True:
+        scanned = 0
+        try:
+            scanned = await reap_expired_tasks(reaper_id)
+        except Exception as e:
+            logger.exception(f"回收到期任务时出错: {str(e)}")
+        if scanned < REAPER_BATCH_SIZE:
+            await asyncio.sleep(REAPER_INTERVAL)
@@ -1,50 +1,181 @@
 # stepflow/worker/timer_worker.py
 
 import asyncio
-from datetime import datetime, timezone
+import heapq
+import logging
+import os
+from datetime import datetime, timedelta, UTC
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
 from stepflow.infrastructure.database import AsyncSessionLocal
+from stepflow.infrastructure.models import Timer
 from stepflow.application.timer_service import TimerService
 from stepflow.infrastructure.repositories.timer_repository import TimerRepository
+from stepflow.application.activity_task_service import ActivityTaskService
+from stepflow.infrastructure.repositories.activity_task_repository import ActivityTaskRepository
 from stepflow.domain.engine.execution_engine import advance_workflow
+from stepflow.infrastructure.dispatch_notifier import dispatch_notifier, TIMER_CHANNEL, ACTIVITY_CHANNEL
+from .shard_manager import shard_manager
 
-CHECK_INTERVAL = 5  # 每5秒轮询一次(示例)
+logger = logging.getLogger(__name__)
 
-async def run_timer_worker():
+# 空闲时重新加载窗口的最大间隔 (秒), 用于发现其他进程写入的定时器
+CHECK_INTERVAL = float(os.environ.get("STEPFLOW_TIMER_CHECK_INTERVAL", "5"))
+# 内存窗口覆盖的时间范围 (秒) 与最多装入的定时器数
+TIMER_WINDOW_SECONDS = float(os.environ.get("STEPFLOW_TIMER_WINDOW_SECONDS", "60"))
+TIMER_WINDOW_LIMIT = int(os.environ.get("STEPFLOW_TIMER_WINDOW_LIMIT", "1000"))
+# 一次 UPDATE 触发的定时器数
+TIMER_FIRE_BATCH_SIZE = int(os.environ.get("STEPFLOW_TIMER_FIRE_BATCH_SIZE", "100"))
+
+class TimerWindow:
     """
-    后台协程, 轮询 "timers" 表, 查找 fire_at <= now() 且 status='scheduled'
-    然后标记fired, 并可调用Engine/Workflow推进
+    内存中的定时器窗口: 按 fire_at 排序的最小堆, 装入 [now, horizon] 内到期的 scheduled 定时器.
+    worker 只在窗口过期 (超过 horizon 或 CHECK_INTERVAL)、或收到新定时器的通知时查询数据库,
+    其余时间精确睡到下一个到期时间, 而不是每隔几秒扫描一次表
     """
-    while True:
 
-        # 2) 获取当前UTC时间(也可用 localtime,视你DB存储)
-        now_utc = datetime.now(timezone.utc)
+    def __init__(self, window_seconds: float = TIMER_WINDOW_SECONDS, limit: int = TIMER_WINDOW_LIMIT):
+        self.window_seconds = window_seconds
+        self.limit = limit
+        self._heap: List[Tuple[datetime, str]] = []
+        self._timers: Dict[str, Timer] = {}
+        self.horizon: Optional[datetime] = None
+        self.loaded_at: Optional[datetime] = None
+        # 加载时本进程持有的分片 (None 表示不按分片过滤)
+        self.shard_ids: Optional[FrozenSet[int]] = None
+
+    def __len__(self) -> int:
+        return len(self._timers)
+
+    def load(self, timers: List[Timer], now: datetime) -> None:
+        """
+        用一次查询的结果替换窗口内容.
+        装满 limit 时窗口只覆盖到最后一个定时器的 fire_at, 之后的定时器在下一次加载时补上
+        """
+        self._timers = {t.timer_id: t for t in timers}
+        self._heap = [(self._fire_at(t), t.timer_id) for t in timers]
+        heapq.heapify(self._heap)
+        if len(timers) >= self.limit:
+            self.horizon = max(fire_at for fire_at, _ in self._heap)
+        else:
+            self.horizon = now + timedelta(seconds=self.window_seconds)
+        self.loaded_at = now
+
+    def invalidate(self) -> None:
+        """有新的定时器写入, 下一轮重新加载"""
+        self.loaded_at = None
+
+    def stale(self, now: datetime) -> bool:
+        if self.loaded_at is None or self.horizon is None:
+            return True
+        return now >= self.horizon or now >= self.loaded_at + timedelta(seconds=CHECK_INTERVAL)
+
+    def next_deadline(self) -> Optional[datetime]:
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: datetime, limit: int = TIMER_FIRE_BATCH_SIZE) -> List[Timer]:
+        """取出已到期的定时器 (最多 limit 个), 按 fire_at 顺序"""
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < limit:
+            _, timer_id = heapq.heappop(self._heap)
+            timer = self._timers.pop(timer_id, None)
+            if timer is not None:
+                due.append(timer)
+        return due
+
+    def sleep_seconds(self, now: datetime) -> float:
+        """睡到下一个到期时间, 但不超过窗口的 horizon 与重新加载的间隔"""
+        wake = self.loaded_at + timedelta(seconds=CHECK_INTERVAL)
+        for t in (self.next_deadline(), self.horizon):
+            if t is not None:
+                wake = min(wake, t)
+        return max(0.0, (wake - now).total_seconds())
+
+    @staticmethod
+    def _fire_at(timer: Timer) -> datetime:
+        # 数据库读出的时间不带时区 (按 UTC 存储)
+        fire_at = timer.fire_at
+        return fire_at.replace(tzinfo=UTC) if fire_at.tzinfo is None else fire_at
+
+    async def refill(self, now: datetime, shard_ids: Optional[FrozenSet[int]] = None) -> None:
+        """重新加载窗口, shard_ids 不为 None 时只加载这些分片的定时器"""
+        async with AsyncSessionLocal() as db:
+            until = now + timedelta(seconds=self.window_seconds)
+            timers = await TimerRepository(db).list_due_window(until, self.limit, shard_ids)
+        self.load(timers, now)
+        self.shard_ids = shard_ids
 
-        # 3) 打开异步Session:
+async def fire_due_timers(timers: List[Timer]) -> List[Timer]:
+    """
+    一批到期定时器的处理, 返回本 worker 实际触发的定时器 (已被取消或被其他 worker 触发的会被跳过):
+    - activity_retry: 一条 UPDATE 标记为 fired, 对应的任务用一条 UPDATE 重新调度, 同一事务提交后唤醒活动 worker
+    - workflow (Wait 状态): 按 run_id 分组, 标记 fired 与工作流推进在同一事务中提交,
+      不会出现定时器已触发而工作流仍停在 Wait 的情况
+    """
+    retry_timers = [t for t in timers if t.timer_type == "activity_retry"]
+    fired_ids = set()
+    if retry_timers:
         async with AsyncSessionLocal() as db:
-            repo = TimerRepository(db)
-            svc = TimerService(repo)
-
-            # 4) 查找 scheduled & fire_at <= now()
-            due_list = await svc.find_due_timers(now_utc)
-            if due_list:
-                print(f"[TimerWorker] found {len(due_list)} timers due.")
-            
-            # 5) 对于每个到期的Timer:
-            for t in due_list:
-                # a) fire它 => status='fired'
-                fired_ok = await svc.fire_timer(t.timer_id)
-                if fired_ok:
-                    print(f"[TimerWorker] Timer {t.timer_id} -> fired. run_id={t.run_id}")
-
-                    # b) 通知引擎:
-                    #    (如果你的引擎用 DSL WaitState => you'd do something like:
-                    #     advance_workflow(db, t.run_id, event="TimerFired")
-                    #     or a simpler approach: just run full advance_workflow)
-                    #    下面是示例:
-                    await advance_workflow(db, t.run_id)
-
-                # c) 如果需要send websocket / event bus，也可在这里做
-                # e.g. broadcast_workflow_event( {"event":"TimerFired", "timer_id":..., ...} )
-
-        # 6) 休眠
-        await asyncio.sleep(CHECK_INTERVAL)
\ No newline at end of file
+            fired_ids.update(await TimerService(TimerRepository(db)).fire_timers([t.timer_id for t in retry_timers], commit=False))
+            retry_tokens = [t.task_token for t in retry_timers if t.timer_id in fired_ids]
+            rescheduled = await ActivityTaskService(ActivityTaskRepository(db)).reschedule_tasks(retry_tokens, commit=False)
+            await db.commit()
+        if rescheduled:
+            logger.info(f"[TimerWorker] {rescheduled} 个活动任务重新调度")
+            dispatch_notifier.notify(ACTIVITY_CHANNEL)
+
+    by_run: Dict[str, List[str]] = {}
+    for t in timers:
+        if t.timer_type != "activity_retry":
+            by_run.setdefault(t.run_id, []).append(t.timer_id)
+    for run_id, timer_ids in by_run.items():
+        try:
+            fired_ids.update(await fire_workflow_timers(run_id, timer_ids))
+        except Exception as e:
+            logger.exception(f"[TimerWorker] 推进工作流 {run_id} 时出错: {str(e)}")
+    return [t for t in timers if t.timer_id in fired_ids]
+
+async def fire_workflow_timers(run_id: str, timer_ids: List[str]) -> List[str]:
+    """标记同一工作流的定时器并推进该工作流, 返回实际标记的 timer_id"""
+    fired: List[str] = []
+    async with AsyncSessionLocal() as db:
+        svc = TimerService(TimerRepository(db))
+
+        async def mark_fired():
+            # 版本冲突重试时回滚后重新标记
+            fired[:] = await svc.fire_timers(timer_ids, commit=False)
+
+        await advance_workflow(db, run_id, prepare=mark_fired)
+        # 工作流已结束时推进不会提交, 定时器仍要标记为 fired
+        await db.commit()
+    return fired
+
+async def run_timer_worker():
+    """
+    后台协程: 把即将到期的定时器装入内存窗口 (走 (status, fire_at) 索引),
+    精确睡到下一个到期时间, 到期的定时器按批触发; 启用分片时只处理本进程持有的分片.
+    新建定时器时会通过通知通道唤醒本协程并重新加载窗口
+    """
+    window = TimerWindow()
+    logger.info(f"定时器 worker 启动, 窗口 {TIMER_WINDOW_SECONDS} 秒 / {TIMER_WINDOW_LIMIT} 个")
+    while True:
+        now = datetime.now(UTC)
+        try:
+            # 持有的分片变化 (重新分配或租约失效) 时也要重新加载
+            shard_ids = shard_manager.owned_shards(now)
+            if window.stale(now) or shard_ids != window.shard_ids:
+                await window.refill(now, shard_ids)
+            due = window.pop_due(now)
+            if due:
+                fired = await fire_due_timers(due)
+                logger.info(f"[TimerWorker] 触发了 {len(fired)}/{len(due)} 个定时器")
+                continue
+        except Exception as e:
+            # 未能处理的定时器仍是 scheduled, 下一次加载窗口时重新取出
+            logger.exception(f"[TimerWorker] 处理定时器时出错: {str(e)}")
+            window.invalidate()
+            await asyncio.sleep(CHECK_INTERVAL)
+            continue
+
+        if await dispatch_notifier.wait(TIMER_CHANNEL, window.sleep_seconds(now)):
+            window.invalidate()
@@ -15,4 +15,11 @@ class ITool(ABC):
         传入 input_data (JSON dict),
         返回 result_data (JSON dict).
         """
-        pass
\ No newline at end of file
+        pass
+
+    async def close(self) -> None:
+        """
+        释放工具持有的长生命周期资源 (连接池等), 默认无操作.
+        由应用关闭时统一调用
+        """
+        return None
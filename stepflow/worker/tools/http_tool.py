@@ -1,18 +1,182 @@
 # stepflow/worker/tools/http_tool.py
 
 import aiohttp
-import json
+import asyncio
 import logging
+import os
+import tempfile
 import time
 import traceback
-from typing import Dict, Any, Optional, Union, List
+import uuid
+from typing import Dict, Any, Optional, Union, List, Tuple
+from stepflow.domain.engine.path_utils import get_value_by_path
+from stepflow.infrastructure import codec
 from .base_tool import ITool
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)  # 设置日志级别为 INFO
 
+# 连接池配置
+HTTP_POOL_LIMIT = int(os.environ.get("HTTP_POOL_LIMIT", "100"))                    # 每个会话的总连接数
+HTTP_POOL_LIMIT_PER_HOST = int(os.environ.get("HTTP_POOL_LIMIT_PER_HOST", "20"))   # 每个主机的连接数
+HTTP_DNS_CACHE_TTL = int(os.environ.get("HTTP_DNS_CACHE_TTL", "300"))              # DNS 缓存秒数
+HTTP_KEEPALIVE_TIMEOUT = float(os.environ.get("HTTP_KEEPALIVE_TIMEOUT", "30"))     # 空闲连接保留秒数
+HTTP_SESSION_IDLE_SECONDS = float(os.environ.get("HTTP_SESSION_IDLE_SECONDS", "300"))  # 空闲会话回收秒数
+
+# 响应体大小限制
+HTTP_MAX_RESPONSE_BYTES = int(os.environ.get("HTTP_MAX_RESPONSE_BYTES", str(1024 * 1024)))  # 超过则按 on_oversize 处理
+HTTP_SPILL_DIR = os.environ.get("HTTP_SPILL_DIR", os.path.join(tempfile.gettempdir(), "stepflow-http"))
+HTTP_SPILL_RETENTION_SECONDS = float(os.environ.get("HTTP_SPILL_RETENTION_SECONDS", "86400"))  # 落盘的响应体保留秒数
+HTTP_SPILL_SWEEP_INTERVAL = float(os.environ.get("HTTP_SPILL_SWEEP_INTERVAL", "600"))          # 两次清理之间的最短间隔
+HTTP_READ_CHUNK_SIZE = 64 * 1024
+OVERSIZE_MODES = ("spill", "truncate", "error")
+
+def sweep_spill_dir(max_age: float = HTTP_SPILL_RETENTION_SECONDS, now: Optional[float] = None) -> int:
+    """删除 HTTP_SPILL_DIR 中超过保留时间的响应体文件, 返回删除的数量"""
+    now = time.time() if now is None else now
+    removed = 0
+    try:
+        entries = list(os.scandir(HTTP_SPILL_DIR))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        if not entry.name.endswith(".body"):
+            continue
+        try:
+            if now - entry.stat().st_mtime > max_age:
+                os.remove(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            # 其他 worker 已经删除
+            continue
+    return removed
+
+# 会话键: (verify_ssl, proxy, cookie_session)
+SessionKey = Tuple[bool, Optional[str], Optional[str]]
+
+class _PooledSession:
+    """缓存的会话及其所属事件循环、最近使用时间"""
+
+    __slots__ = ("session", "loop", "last_used")
+
+    def __init__(self, session: aiohttp.ClientSession, loop: asyncio.AbstractEventLoop):
+        self.session = session
+        self.loop = loop
+        self.last_used = time.monotonic()
+
 class HttpTool(ITool):
-    """增强版 HTTP 工具，支持完整的 REST API 功能"""
+    """
+    增强版 HTTP 工具，支持完整的 REST API 功能.
+
+    会话按 (verify_ssl, proxy, cookie_session) 复用, 连接保持 keep-alive,
+    每个主机的连接数受限并缓存 DNS. 默认不保留响应 cookie, 不同任务之间互不影响;
+    需要共享 cookie 的任务可以传入相同的 cookie_session 名称
+    """
+
+    def __init__(self):
+        self._sessions: Dict[SessionKey, _PooledSession] = {}
+        self._last_sweep = 0.0
+
+    def _get_session(self, verify_ssl: bool, proxy: Optional[str], cookie_session: Optional[str]) -> aiohttp.ClientSession:
+        """获取 (或创建) 对应选项的共享会话, 顺带回收空闲过久的会话"""
+        loop = asyncio.get_running_loop()
+        now = time.monotonic()
+        key = (bool(verify_ssl), proxy, cookie_session)
+
+        for other_key, entry in list(self._sessions.items()):
+            if other_key != key and now - entry.last_used > HTTP_SESSION_IDLE_SECONDS:
+                del self._sessions[other_key]
+                if entry.loop is loop:
+                    loop.create_task(entry.session.close())
+
+        entry = self._sessions.get(key)
+        if entry is not None and (entry.session.closed or entry.loop is not loop):
+            # 会话已关闭或属于另一个事件循环 (例如测试), 重新创建
+            entry = None
+        if entry is None:
+            connector = aiohttp.TCPConnector(
+                limit=HTTP_POOL_LIMIT,
+                limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+                ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+                keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+                ssl=None if verify_ssl else False,
+            )
+            cookie_jar = aiohttp.CookieJar() if cookie_session else aiohttp.DummyCookieJar()
+            session = aiohttp.ClientSession(connector=connector, cookie_jar=cookie_jar, json_serialize=codec.dumps)
+            entry = _PooledSession(session, loop)
+            self._sessions[key] = entry
+            logger.info(f"创建 HTTP 会话: verify_ssl={verify_ssl}, proxy={proxy}, cookie_session={cookie_session}")
+        entry.last_used = now
+        return entry.session
+
+    async def _read_body(
+        self,
+        response: aiohttp.ClientResponse,
+        max_bytes: int,
+        on_oversize: str
+    ) -> Tuple[Optional[bytes], Optional[Dict[str, Any]], bool]:
+        """
+        按块读取响应体, 返回 (内容, 落盘引用, 是否被截断):
+        - 未超过 max_bytes => (内容, None, False)
+        - spill => 超出部分连同已读内容写入 HTTP_SPILL_DIR 下的文件 => (None, 引用, False),
+          文件保留 HTTP_SPILL_RETENTION_SECONDS 秒, 之后在下一次落盘或关闭时删除
+        - truncate => 只保留前 max_bytes 字节 => (内容, None, True)
+        - error => (None, None, False)
+        """
+        buffer = bytearray()
+        spill_file = None
+        spill_path = None
+        size = 0
+        try:
+            async for chunk in response.content.iter_chunked(HTTP_READ_CHUNK_SIZE):
+                size += len(chunk)
+                if spill_file is not None:
+                    await asyncio.to_thread(spill_file.write, chunk)
+                    continue
+                buffer.extend(chunk)
+                if len(buffer) <= max_bytes:
+                    continue
+                if on_oversize == "truncate":
+                    return bytes(buffer[:max_bytes]), None, True
+                if on_oversize == "error":
+                    return None, None, False
+                os.makedirs(HTTP_SPILL_DIR, exist_ok=True)
+                await self._sweep_spilled()
+                spill_path = os.path.join(HTTP_SPILL_DIR, f"{uuid.uuid4()}.body")
+                spill_file = open(spill_path, "wb")
+                await asyncio.to_thread(spill_file.write, bytes(buffer))
+                buffer = bytearray()
+        finally:
+            if spill_file is not None:
+                spill_file.close()
+
+        if spill_path is not None:
+            return None, {
+                "path": spill_path,
+                "size": size,
+                "content_type": response.headers.get("Content-Type")
+            }, False
+        return bytes(buffer), None, False
+
+    async def _sweep_spilled(self, force: bool = False) -> None:
+        """按 HTTP_SPILL_SWEEP_INTERVAL 节流地清理过期的落盘响应体"""
+        now = time.monotonic()
+        if not force and now - self._last_sweep < HTTP_SPILL_SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        removed = await asyncio.to_thread(sweep_spill_dir)
+        if removed:
+            logger.info(f"清理了 {removed} 个过期的落盘响应体")
+
+    async def close(self) -> None:
+        """关闭所有共享会话, 并清理过期的落盘响应体"""
+        sessions, self._sessions = self._sessions, {}
+        loop = asyncio.get_running_loop()
+        for entry in sessions.values():
+            if entry.loop is loop and not entry.session.closed:
+                await entry.session.close()
+        logger.info(f"已关闭 {len(sessions)} 个 HTTP 会话")
+        await self._sweep_spilled(force=True)
     
     async def execute(self, parameters: Dict[str, Any]) -> Dict[str, Any]:
         """执行 HTTP 请求"""
@@ -38,6 +202,13 @@ class HttpTool(ITool):
         auth = parameters.get("auth", None)
         cookies = parameters.get("cookies", {})
         parse_json = parameters.get("parse_json", True)
+        cookie_session = parameters.get("cookie_session", None)
+        max_bytes = int(parameters.get("max_response_bytes", HTTP_MAX_RESPONSE_BYTES))
+        on_oversize = parameters.get("on_oversize", "spill")
+        result_selector = parameters.get("result_selector", None)
+        include_text = parameters.get("include_text", False)
+        # 为 True 时 4xx/5xx 响应视为任务失败, 可按 error_type 被 Retry 重试
+        raise_for_status = parameters.get("raise_for_status", False)
         
         # 记录请求详情
         logger.info(f"HTTP 请求详情: 方法={method}, URL={url}")
@@ -54,6 +225,8 @@ class HttpTool(ITool):
         if method not in valid_methods:
             logger.error(f"无效的 HTTP 方法: {method}")
             return {"error": f"Invalid method: {method}", "ok": False}
+        if on_oversize not in OVERSIZE_MODES:
+            return {"error": f"Invalid on_oversize: {on_oversize}", "ok": False}
         
         # 记录开始时间
         start_time = time.time()
@@ -69,78 +242,99 @@ class HttpTool(ITool):
             # 设置超时
             timeout_obj = aiohttp.ClientTimeout(total=timeout)
             
-            # 创建会话并发送请求
-            async with aiohttp.ClientSession(cookies=cookies, timeout=timeout_obj) as session:
-                # 准备请求参数
-                request_kwargs = {
-                    "url": url,
-                    "params": params,
-                    "ssl": verify_ssl,
-                    "allow_redirects": allow_redirects,
-                    "headers": headers
-                }
-                
-                # 添加认证信息
-                if auth:
-                    request_kwargs["auth"] = aiohttp.BasicAuth(auth[0], auth[1])
+            # 复用共享会话发送请求
+            session = self._get_session(verify_ssl, proxy, cookie_session)
+            # 准备请求参数
+            request_kwargs = {
+                "url": url,
+                "params": params,
+                "ssl": None if verify_ssl else False,
+                "allow_redirects": allow_redirects,
+                "headers": headers,
+                "cookies": cookies,
+                "timeout": timeout_obj
+            }
+            
+            # 添加认证信息
+            if auth:
+                request_kwargs["auth"] = aiohttp.BasicAuth(auth[0], auth[1])
+            
+            # 添加代理
+            if proxy:
+                request_kwargs["proxy"] = proxy
+            
+            # 添加请求体
+            if method in ["POST", "PUT", "PATCH"]:
+                if json_data is not None:
+                    request_kwargs["json"] = json_data
+                elif data is not None:
+                    request_kwargs["data"] = data
+            
+            # 发送请求
+            async with getattr(session, method.lower())(**request_kwargs) as response:
+                # 计算请求耗时
+                elapsed = int((time.time() - start_time) * 1000)
                 
-                # 添加代理
-                if proxy:
-                    request_kwargs["proxy"] = proxy
+                # 流式读取响应内容, 超过上限时落盘/截断/报错
+                raw, body_ref, truncated = await self._read_body(response, max_bytes, on_oversize)
                 
-                # 添加请求体
-                if method in ["POST", "PUT", "PATCH"]:
-                    if json_data is not None:
-                        request_kwargs["json"] = json_data
-                    elif data is not None:
-                        request_kwargs["data"] = data
+                # 构建结果
+                result = {
+                    "status": response.status,
+                    "headers": dict(response.headers),
+                    "cookies": dict(response.cookies),
+                    "elapsed": elapsed,
+                    "url": str(response.url),
+                    "ok": response.status < 400
+                }
                 
-                # 发送请求
-                async with getattr(session, method.lower())(**request_kwargs) as response:
-                    # 计算请求耗时
-                    elapsed = int((time.time() - start_time) * 1000)
-                    
-                    # 获取响应内容
-                    text = await response.text()
+                if body_ref is not None:
+                    # 大响应只保留引用, 不写入任务结果与工作流上下文
+                    result["body_ref"] = body_ref
+                    logger.info(f"响应体超过 {max_bytes} 字节, 已写入 {body_ref['path']}")
+                elif raw is None:
+                    result["ok"] = False
+                    result["error"] = f"Response body exceeds {max_bytes} bytes"
+                else:
+                    text = raw.decode(response.charset or "utf-8", errors="replace")
+                    if include_text:
+                        result["text"] = text
+                    if truncated:
+                        result["truncated"] = True
                     
-                    # 尝试解析 JSON
-                    body = None
-                    if parse_json and text:
+                    # 尝试解析 JSON (截断的响应不解析)
+                    body = text
+                    if parse_json and text and not truncated:
                         try:
-                            body = json.loads(text)
+                            body = codec.loads(text)
                             logger.info(f"成功解析 JSON 响应")
-                        except json.JSONDecodeError:
+                        except codec.JSONDecodeError:
                             logger.info(f"响应不是有效的 JSON 格式")
-                            body = text
-                    else:
-                        body = text
                     
-                    # 构建结果
-                    result = {
-                        "status": response.status,
-                        "headers": dict(response.headers),
-                        "text": text,
-                        "cookies": dict(response.cookies),
-                        "elapsed": elapsed,
-                        "url": str(response.url),
-                        "ok": response.status < 400
-                    }
+                    # 只保留 result_selector 选中的部分, 例如 "$.data.items"
+                    if result_selector and not isinstance(body, str):
+                        body = get_value_by_path(body, result_selector)
                     
                     # 添加解析后的 JSON 或原始响应体
-                    if parse_json and isinstance(body, dict):
+                    if not isinstance(body, str):
                         result["json"] = body
                     else:
                         result["body"] = body
-                    
-                    logger.info(f"HTTP 请求完成: 状态码={response.status}, 耗时={elapsed}ms")
-                    return result
-                    
+                
+                if raise_for_status and response.status >= 400 and "error" not in result:
+                    result["error"] = f"HTTP {response.status}"
+                    result["error_type"] = "Http.ServerError" if response.status >= 500 else "Http.ClientError"
+                
+                logger.info(f"HTTP 请求完成: 状态码={response.status}, 耗时={elapsed}ms")
+                return result
+                
         except aiohttp.ClientError as e:
             elapsed = int((time.time() - start_time) * 1000) if start_time else None
             error_msg = f"Request failed: {str(e)}"
             logger.error(f"HTTP 请求失败: {method} {url}, 错误: {str(e)}")
             return {
                 "error": error_msg,
+                "error_type": "Http.ConnectionError",
                 "elapsed": elapsed,
                 "ok": False
             }
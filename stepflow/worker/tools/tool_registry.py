@@ -13,4 +13,9 @@ tool_registry = {
     "HttpTool": HttpTool(),
     "ShellTool": ShellTool(),
     # 其他工具...
-}
\ No newline at end of file
+}
+
+async def close_tools() -> None:
+    """关闭所有工具持有的资源, 在应用 lifespan 结束时调用"""
+    for tool in tool_registry.values():
+        await tool.close()
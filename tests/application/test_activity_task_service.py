@@ -112,4 +112,34 @@ async def test_fail_task(db_session):
     assert failed_task.status == "failed"
     assert failed_task.completed_at is not None
     assert failed_task.error == "Test failure"
-    assert failed_task.error_details == "Detailed error information"
\ No newline at end of file
+    assert failed_task.error_details == "Detailed error information"
+@pytest.mark.asyncio
+async def test_heartbeat_buffered_until_flush(db_session):
+    from stepflow.infrastructure.heartbeat_buffer import heartbeat_buffer
+
+    repo = ActivityTaskRepository(db_session)
+    svc = ActivityTaskService(repo)
+    task = await repo.create(ActivityTask(
+        task_token=str(uuid.uuid4()),
+        run_id="run-beat",
+        shard_id=1,
+        seq=1,
+        activity_type="long_running",
+        input="{}",
+        status="running",
+        heartbeat_seconds=30,
+        started_at=datetime.now(UTC)
+    ))
+
+    assert await svc.heartbeat_task(task.task_token, "10%")
+    assert await svc.heartbeat_task(task.task_token)
+    assert (await repo.get_by_token(task.task_token)).heartbeat_at is None
+    # SQLite 只有一个写连接: 结束本会话的读事务后缓冲才能写入
+    await db_session.commit()
+
+    assert await heartbeat_buffer.flush() == 1
+    async with AsyncSessionLocal() as other:
+        stored = await ActivityTaskRepository(other).get_by_token(task.task_token)
+    assert stored.heartbeat_at is not None
+    assert stored.heartbeat_details == "10%"
+    assert stored.lease_expiry is not None
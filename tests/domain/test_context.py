@@ -0,0 +1,53 @@
+import json
+
+from stepflow.domain.engine.context import WorkflowContext, ContextCache
+from stepflow.infrastructure import codec
+
+MEMO = codec.dumps({"order": {"id": 1, "lines": [1, 2]}, "big": {"blob": "x" * 100}})
+
+def test_dumps_reencodes_only_dirty_keys(monkeypatch):
+    ctx = WorkflowContext.loads(MEMO)
+    assert ctx.dumps() is ctx.memo
+
+    ctx.set("$.order.status", "paid")
+    assert ctx.dirty_keys == {"order"}
+
+    encoded = []
+    real_dumps = codec.dumps
+    monkeypatch.setattr("stepflow.infrastructure.codec.dumps", lambda v: encoded.append(v) or real_dumps(v))
+    text = ctx.dumps()
+    # "big" 复用第一次编码时的片段; 这里只编码 order 子树与键名
+    assert {"blob": "x" * 100} not in encoded
+    assert json.loads(text)["order"]["status"] == "paid"
+    assert text == real_dumps(ctx.data)
+    assert ctx.dirty_keys == set()
+
+def test_fork_is_copy_on_write():
+    base = WorkflowContext.loads(MEMO)
+    child = base.fork()
+    child.set("$.order.lines[0]", 9)
+    assert base.get("$.order.lines") == [1, 2]
+    assert child.get("$.order.lines") == [9, 2]
+    # 未修改的子树仍然共享
+    assert child.data["big"] is base.data["big"]
+
+def test_replace_root():
+    ctx = WorkflowContext.loads(MEMO)
+    ctx.set("$", [1, 2])
+    assert ctx.data == {"value": [1, 2]}
+
+def test_cache_reuses_matching_memo_only():
+    cache = ContextCache(max_size=1)
+    ctx = WorkflowContext.loads(MEMO)
+    ctx.set("$.order.id", 2)
+    cache.put("run-1", ctx)
+
+    hit = cache.load("run-1", ctx.memo)
+    assert hit is not ctx and hit.data["big"] is ctx.data["big"]
+    # 修改复用的上下文不影响缓存和原上下文
+    hit.set("$.order.id", 3)
+    assert ctx.get("$.order.id") == 2
+    assert cache.load("run-1", ctx.memo).get("$.order.id") == 2
+
+    miss = cache.load("run-1", MEMO)
+    assert miss.get("$.order.id") == 1
@@ -4,7 +4,7 @@ import json
 from datetime import datetime, UTC
 from uuid import uuid4
 
-from sqlalchemy import select
+from sqlalchemy import select, event
 
 from stepflow.infrastructure.database import Base, async_engine, AsyncSessionLocal
 from stepflow.infrastructure.models import (
@@ -13,7 +13,10 @@ from stepflow.infrastructure.models import (
     WorkflowEvent,
     ActivityTask
 )
+from stepflow.domain.engine import execution_engine
 from stepflow.domain.engine.execution_engine import advance_workflow
+from stepflow.application.activity_task_service import ActivityTaskService
+from stepflow.infrastructure.repositories.activity_task_repository import ActivityTaskRepository
 
 @pytest_asyncio.fixture(scope="module", autouse=True)
 async def setup_database():
@@ -137,4 +140,657 @@ async def test_pass_state_end(db_session):
     测试 PassState 的执行
     ...
     """
-    pass
\ No newline at end of file
+    pass
+@pytest.mark.asyncio
+async def test_inline_run_to_block(db_session):
+    """
+    Pass -> Choice -> Pass -> Task 应在一次 advance_workflow 中执行到 Task 并调度活动任务,
+    Task 完成后再一次 advance 即可走完 Succeed
+    """
+    tpl_id = "tpl-inline"
+    dsl_definition = json.dumps({
+        "Version": "1.0",
+        "Name": "InlineFlow",
+        "StartAt": "Init",
+        "States": {
+            "Init": {"Type": "Pass", "Result": {"kind": "vip"}, "ResultPath": "$.order", "Next": "Route"},
+            "Route": {
+                "Type": "Choice",
+                "Choices": [{"Variable": "$.order.kind", "StringEquals": "vip", "Next": "Mark"}],
+                "Default": "Reject"
+            },
+            "Mark": {"Type": "Pass", "Result": True, "ResultPath": "$.vip", "Next": "Call"},
+            "Call": {"Type": "Task", "ActivityType": "myActivity", "ResultPath": "$.call", "Next": "Done"},
+            "Reject": {"Type": "Fail", "Error": "NotVip"},
+            "Done": {"Type": "Succeed"}
+        }
+    })
+    db_session.add(WorkflowTemplate(template_id=tpl_id, name="Inline", dsl_definition=dsl_definition))
+    run_id = "run-inline"
+    db_session.add(WorkflowExecution(
+        run_id=run_id,
+        workflow_id="wf-inline",
+        shard_id=1,
+        template_id=tpl_id,
+        status="running",
+        workflow_type="TestFlow",
+        input=json.dumps({"user": "alice"}),
+        start_time=datetime.now(UTC)
+    ))
+    await db_session.commit()
+
+    await advance_workflow(db_session, run_id)
+
+    wf = (await db_session.execute(
+        select(WorkflowExecution).where(WorkflowExecution.run_id == run_id)
+    )).scalars().one()
+    assert wf.current_state_name == "Call"
+    assert json.loads(wf.memo) == {"user": "alice", "order": {"kind": "vip"}, "vip": True}
+
+    tasks = (await db_session.execute(
+        select(ActivityTask).where(ActivityTask.run_id == run_id)
+    )).scalars().all()
+    assert len(tasks) == 1
+
+    # 任务仍在执行时再次推进不会重复调度
+    await advance_workflow(db_session, run_id)
+    tasks = (await db_session.execute(
+        select(ActivityTask).where(ActivityTask.run_id == run_id)
+    )).scalars().all()
+    assert len(tasks) == 1
+
+    tasks[0].status = "completed"
+    tasks[0].result = json.dumps({"ok": True})
+    await db_session.commit()
+    await advance_workflow(db_session, run_id)
+
+    await db_session.refresh(wf)
+    assert wf.status == "completed"
+    assert json.loads(wf.memo)["call"] == {"ok": True}
+
+@pytest.mark.asyncio
+async def test_parallel_fan_out_and_join(db_session):
+    """
+    Parallel 的两个分支在同一次推进中各自调度第一个活动任务,
+    最后一个分支完成时按分支顺序合并输出并继续推进父执行
+    """
+    tpl_id = "tpl-parallel"
+    branch = lambda activity: {
+        "StartAt": "Call",
+        "States": {"Call": {"Type": "Task", "ActivityType": activity, "End": True}}
+    }
+    dsl_definition = json.dumps({
+        "Version": "1.0",
+        "Name": "ParallelFlow",
+        "StartAt": "FanOut",
+        "States": {
+            "FanOut": {
+                "Type": "Parallel",
+                "Branches": [branch("fetchA"), branch("fetchB")],
+                "ResultPath": "$.fetched",
+                "Next": "Done"
+            },
+            "Done": {"Type": "Succeed"}
+        }
+    })
+    db_session.add(WorkflowTemplate(template_id=tpl_id, name="Parallel", dsl_definition=dsl_definition))
+    run_id = "run-parallel"
+    db_session.add(WorkflowExecution(
+        run_id=run_id,
+        workflow_id="wf-parallel",
+        shard_id=1,
+        template_id=tpl_id,
+        status="running",
+        workflow_type="TestFlow",
+        input=json.dumps({"id": 7}),
+        start_time=datetime.now(UTC)
+    ))
+    await db_session.commit()
+
+    await advance_workflow(db_session, run_id)
+
+    children = (await db_session.execute(
+        select(WorkflowExecution).where(WorkflowExecution.parent_run_id == run_id)
+    )).scalars().all()
+    assert len(children) == 2
+    tasks = {}
+    for child in children:
+        child_tasks = (await db_session.execute(
+            select(ActivityTask).where(ActivityTask.run_id == child.run_id)
+        )).scalars().all()
+        assert len(child_tasks) == 1
+        tasks[child_tasks[0].activity_type] = child_tasks[0]
+
+    # 后一个分支先完成 => 父执行仍在等待
+    tasks["fetchB"].status = "completed"
+    tasks["fetchB"].result = json.dumps({"b": 2})
+    await db_session.commit()
+    await advance_workflow(db_session, tasks["fetchB"].run_id)
+
+    parent = (await db_session.execute(
+        select(WorkflowExecution).where(WorkflowExecution.run_id == run_id)
+    )).scalars().one()
+    assert parent.status == "running"
+    assert parent.current_state_name == "FanOut"
+
+    tasks["fetchA"].status = "completed"
+    tasks["fetchA"].result = json.dumps({"a": 1})
+    await db_session.commit()
+    await advance_workflow(db_session, tasks["fetchA"].run_id)
+
+    await db_session.refresh(parent)
+    assert parent.status == "completed"
+    assert json.loads(parent.memo)["fetched"] == [{"a": 1}, {"b": 2}]
+
+@pytest.mark.asyncio
+async def test_map_sliding_window(db_session):
+    """
+    Map 按 MaxConcurrency 分批调度元素任务, 每完成一个补派一个,
+    全部完成后按元素顺序把结果写入 ResultPath
+    """
+    tpl_id = "tpl-map"
+    dsl_definition = json.dumps({
+        "Version": "1.0",
+        "Name": "MapFlow",
+        "StartAt": "ForEach",
+        "States": {
+            "ForEach": {
+                "Type": "Map",
+                "ItemsPath": "$.orders",
+                "MaxConcurrency": 2,
+                "Iterator": {
+                    "StartAt": "Tag",
+                    "States": {
+                        "Tag": {"Type": "Pass", "Result": "seen", "ResultPath": "$.tag", "Next": "Charge"},
+                        "Charge": {
+                            "Type": "Task",
+                            "ActivityType": "charge",
+                            "InputPath": "$",
+                            "ResultPath": "$.charged",
+                            "End": True
+                        }
+                    }
+                },
+                "ResultPath": "$.results",
+                "Next": "Done"
+            },
+            "Done": {"Type": "Succeed"}
+        }
+    })
+    db_session.add(WorkflowTemplate(template_id=tpl_id, name="Map", dsl_definition=dsl_definition))
+    run_id = "run-map"
+    db_session.add(WorkflowExecution(
+        run_id=run_id,
+        workflow_id="wf-map",
+        shard_id=1,
+        template_id=tpl_id,
+        status="running",
+        workflow_type="TestFlow",
+        input=json.dumps({"orders": [{"id": 1}, {"id": 2}, {"id": 3}]}),
+        start_time=datetime.now(UTC)
+    ))
+    await db_session.commit()
+
+    async def list_tasks():
+        return (await db_session.execute(
+            select(ActivityTask).where(ActivityTask.run_id == run_id).order_by(ActivityTask.seq)
+        )).scalars().all()
+
+    await advance_workflow(db_session, run_id)
+    tasks = await list_tasks()
+    assert [t.seq for t in tasks] == [1, 2]
+    assert json.loads(tasks[0].input) == {"id": 1, "tag": "seen"}
+
+    svc = ActivityTaskService(ActivityTaskRepository(db_session))
+
+    async def complete(task):
+        # 与 worker 一样, 任务结果与推进在同一事务中提交
+        await advance_workflow(
+            db_session,
+            run_id,
+            prepare=lambda: svc.complete_task(task.task_token, json.dumps({"ok": task.seq}), commit=False)
+        )
+
+    # 第二个元素先完成 => 补派第三个元素
+    await complete(tasks[1])
+    tasks = await list_tasks()
+    assert [t.seq for t in tasks] == [1, 2, 3]
+
+    for task in (tasks[0], tasks[2]):
+        await complete(task)
+
+    wf = (await db_session.execute(
+        select(WorkflowExecution).where(WorkflowExecution.run_id == run_id)
+    )).scalars().one()
+    await db_session.refresh(wf)
+    assert wf.status == "completed"
+    memo = json.loads(wf.memo)
+    assert memo["results"] == [
+        {"id": i, "tag": "seen", "charged": {"ok": i}} for i in (1, 2, 3)
+    ]
+    # 父上下文中的原始元素不受 Iterator 修改影响
+    assert memo["orders"] == [{"id": 1}, {"id": 2}, {"id": 3}]
+
+@pytest.mark.asyncio
+async def test_concurrent_advance_retries_on_version_conflict(db_session):
+    """
+    两个会话同时推进同一个执行: 持有旧版本的一方提交时版本不匹配,
+    重新加载后重试, 不会覆盖另一方已经写入的状态
+    """
+    tpl_id = "tpl-cas"
+    dsl_definition = json.dumps({
+        "Version": "1.0",
+        "Name": "CasFlow",
+        "StartAt": "Step1",
+        "States": {
+            "Step1": {"Type": "Task", "ActivityType": "a", "Next": "Step2"},
+            "Step2": {"Type": "Task", "ActivityType": "b", "End": True}
+        }
+    })
+    db_session.add(WorkflowTemplate(template_id=tpl_id, name="Cas", dsl_definition=dsl_definition))
+    run_id = "run-cas"
+    db_session.add(WorkflowExecution(
+        run_id=run_id,
+        workflow_id="wf-cas",
+        shard_id=1,
+        template_id=tpl_id,
+        status="running",
+        workflow_type="TestFlow",
+        input="{}",
+        start_time=datetime.now(UTC)
+    ))
+    await db_session.commit()
+    await advance_workflow(db_session, run_id)
+
+    task = (await db_session.execute(
+        select(ActivityTask).where(ActivityTask.run_id == run_id)
+    )).scalars().one()
+    task.status = "completed"
+    task.result = json.dumps({"a": 1})
+    await db_session.commit()
+
+    # 另一个会话先加载到旧版本 (仍停在 Step1)
+    async with AsyncSessionLocal() as stale:
+        stale_exec = (await stale.execute(
+            select(WorkflowExecution).where(WorkflowExecution.run_id == run_id)
+        )).scalars().one()
+        assert stale_exec.current_state_name == "Step1"
+        # 只保留内存中的旧版本, 结束读事务 (SQLite 下写事务是串行的)
+        await stale.commit()
+
+        # 本会话推进到 Step2, 并完成 Step2 的任务
+        await advance_workflow(db_session, run_id)
+        step2 = (await db_session.execute(
+            select(ActivityTask).where(ActivityTask.run_id == run_id, ActivityTask.activity_type == "b")
+        )).scalars().one()
+        step2.status = "completed"
+        step2.result = json.dumps({"b": 2})
+        await db_session.commit()
+
+        # 旧版本的会话推进: 提交时版本冲突, 重新加载后从 Step2 继续
+        await advance_workflow(stale, run_id)
+        assert stale_exec.status == "completed"
+        assert json.loads(stale_exec.result) == {"b": 2}
+
+    tasks = (await db_session.execute(
+        select(ActivityTask).where(ActivityTask.run_id == run_id)
+    )).scalars().all()
+    # Step2 只被调度一次
+    assert sorted(t.activity_type for t in tasks) == ["a", "b"]
+
+@pytest.mark.asyncio
+async def test_events_batched_with_sequential_ids(db_session):
+    """一次推进产生的多条事件用一条 INSERT 写入, event_id 按 current_event_id 递增"""
+    tpl_id = "tpl-events"
+    dsl_definition = json.dumps({
+        "Version": "1.0",
+        "Name": "EventFlow",
+        "StartAt": "Route",
+        "States": {
+            "Route": {
+                "Type": "Choice",
+                "Choices": [{"Variable": "$.go", "BooleanEquals": True, "Next": "Work"}],
+                "Default": "Work"
+            },
+            "Work": {"Type": "Task", "ActivityType": "a", "End": True}
+        }
+    })
+    db_session.add(WorkflowTemplate(template_id=tpl_id, name="Events", dsl_definition=dsl_definition))
+    run_id = "run-events"
+    db_session.add(WorkflowExecution(
+        run_id=run_id,
+        workflow_id="wf-events",
+        shard_id=1,
+        template_id=tpl_id,
+        status="running",
+        workflow_type="TestFlow",
+        input=json.dumps({"go": True}),
+        start_time=datetime.now(UTC)
+    ))
+    await db_session.commit()
+
+    inserts = []
+    def count_inserts(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("INSERT INTO workflow_events"):
+            inserts.append(statement)
+    event.listen(async_engine.sync_engine, "before_cursor_execute", count_inserts)
+    try:
+        await advance_workflow(db_session, run_id)
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", count_inserts)
+
+    assert len(inserts) == 1
+    events = (await db_session.execute(
+        select(WorkflowEvent).where(WorkflowEvent.run_id == run_id).order_by(WorkflowEvent.id)
+    )).scalars().all()
+    assert [e.event_type for e in events] == ["ChoiceMatched", "ActivityTaskScheduled"]
+    assert [e.event_id for e in events] == [1, 2]
+    wf_exec = (await db_session.execute(
+        select(WorkflowExecution).where(WorkflowExecution.run_id == run_id)
+    )).scalars().one()
+    assert wf_exec.current_event_id == 2
+
+@pytest.mark.asyncio
+async def test_task_result_and_advance_commit_once(db_session):
+    """活动任务结果通过 prepare 登记, 与推进结果在同一事务中只提交一次"""
+    from stepflow.application.activity_task_service import ActivityTaskService
+    from stepflow.infrastructure.repositories.activity_task_repository import ActivityTaskRepository
+
+    tpl_id = "tpl-uow"
+    dsl_definition = json.dumps({
+        "Version": "1.0",
+        "Name": "UnitOfWork",
+        "StartAt": "Work",
+        "States": {"Work": {"Type": "Task", "ActivityType": "a", "End": True}}
+    })
+    db_session.add(WorkflowTemplate(template_id=tpl_id, name="UnitOfWork", dsl_definition=dsl_definition))
+    run_id = "run-uow"
+    db_session.add(WorkflowExecution(
+        run_id=run_id,
+        workflow_id="wf-uow",
+        shard_id=1,
+        template_id=tpl_id,
+        status="running",
+        workflow_type="TestFlow",
+        input=json.dumps({}),
+        start_time=datetime.now(UTC)
+    ))
+    await db_session.commit()
+    await advance_workflow(db_session, run_id)
+    task = (await db_session.execute(
+        select(ActivityTask).where(ActivityTask.run_id == run_id)
+    )).scalars().one()
+
+    commits = []
+    def count_commits(session):
+        commits.append(session)
+    sync_session = db_session.sync_session
+    event.listen(sync_session, "after_commit", count_commits)
+    try:
+        svc = ActivityTaskService(ActivityTaskRepository(db_session))
+        await advance_workflow(
+            db_session,
+            run_id,
+            prepare=lambda: svc.complete_task(task.task_token, '{"ok":true}', commit=False)
+        )
+    finally:
+        event.remove(sync_session, "after_commit", count_commits)
+
+    assert len(commits) == 1
+    async with AsyncSessionLocal() as other:
+        stored = (await other.execute(
+            select(ActivityTask).where(ActivityTask.task_token == task.task_token)
+        )).scalars().one()
+        wf_exec = (await other.execute(
+            select(WorkflowExecution).where(WorkflowExecution.run_id == run_id)
+        )).scalars().one()
+    assert stored.status == "completed"
+    assert stored.result == '{"ok":true}'
+    assert wf_exec.status == "completed"
+
+async def run_failing_task(db_session, run_id: str, catch, error_type=None):
+    """调度 Work 任务并以 error_type 失败, 在同一事务中推进"""
+    from stepflow.application.activity_task_service import ActivityTaskService
+    from stepflow.infrastructure.repositories.activity_task_repository import ActivityTaskRepository
+
+    dsl_definition = json.dumps({
+        "Version": "1.0",
+        "Name": "CatchFlow",
+        "StartAt": "Work",
+        "States": {
+            "Work": {"Type": "Task", "ActivityType": "a", "Catch": catch, "Next": "Done"},
+            "Fallback": {"Type": "Pass", "Result": "degraded", "ResultPath": "$.mode", "End": True},
+            "Done": {"Type": "Succeed"}
+        }
+    })
+    db_session.add(WorkflowTemplate(template_id=f"tpl-{run_id}", name="Catch", dsl_definition=dsl_definition))
+    db_session.add(WorkflowExecution(
+        run_id=run_id,
+        workflow_id=f"wf-{run_id}",
+        shard_id=1,
+        template_id=f"tpl-{run_id}",
+        status="running",
+        workflow_type="TestFlow",
+        input=json.dumps({"order": 7}),
+        start_time=datetime.now(UTC)
+    ))
+    await db_session.commit()
+    await advance_workflow(db_session, run_id)
+    task = (await db_session.execute(
+        select(ActivityTask).where(ActivityTask.run_id == run_id)
+    )).scalars().one()
+
+    svc = ActivityTaskService(ActivityTaskRepository(db_session))
+    await advance_workflow(
+        db_session,
+        run_id,
+        prepare=lambda: svc.fail_task(task.task_token, "HTTP 503", commit=False, error_type=error_type)
+    )
+    return (await db_session.execute(
+        select(WorkflowExecution).where(WorkflowExecution.run_id == run_id)
+    )).scalars().one()
+
+@pytest.mark.asyncio
+async def test_catch_routes_failure_to_fallback(db_session):
+    """匹配的 Catch 把错误写入 ResultPath 并转移到 Next, 而不是让工作流失败"""
+    wf_exec = await run_failing_task(db_session, "run-catch", [
+        {"ErrorEquals": ["States.Timeout"], "Next": "Done"},
+        {"ErrorEquals": ["Http.ServerError"], "Next": "Fallback", "ResultPath": "$.error"},
+    ], error_type="Http.ServerError")
+
+    assert wf_exec.status == "completed"
+    assert json.loads(wf_exec.result) == {
+        "order": 7,
+        "error": {"Error": "Http.ServerError", "Cause": "HTTP 503"},
+        "mode": "degraded"
+    }
+    events = (await db_session.execute(
+        select(WorkflowEvent.event_type).where(WorkflowEvent.run_id == "run-catch").order_by(WorkflowEvent.event_id)
+    )).scalars().all()
+    assert "TaskStateCaught" in events
+
+@pytest.mark.asyncio
+async def test_task_failed_catcher_ignores_timeout(db_session):
+    """States.TaskFailed 不匹配 States.Timeout, 没有其他 Catch 时工作流失败"""
+    wf_exec = await run_failing_task(db_session, "run-catch-timeout", [
+        {"ErrorEquals": ["States.TaskFailed"], "Next": "Fallback"},
+    ], error_type="States.Timeout")
+    assert wf_exec.status == "failed"
+
+@pytest.mark.asyncio
+async def test_invalid_template_fails_run(db_session):
+    """模板无法编译 (Next 指向不存在的状态) 时执行按 States.Runtime 失败, 而不是一直停在 running"""
+    dsl_definition = json.dumps({
+        "Version": "1.0",
+        "Name": "BrokenFlow",
+        "StartAt": "Init",
+        "States": {"Init": {"Type": "Pass", "Next": "Missing"}}
+    })
+    db_session.add(WorkflowTemplate(template_id="tpl-broken", name="Broken", dsl_definition=dsl_definition))
+    db_session.add(WorkflowExecution(
+        run_id="run-broken",
+        workflow_id="wf-broken",
+        shard_id=1,
+        template_id="tpl-broken",
+        status="running",
+        workflow_type="TestFlow",
+        input="{}",
+        start_time=datetime.now(UTC)
+    ))
+    await db_session.commit()
+
+    await advance_workflow(db_session, "run-broken")
+
+    wf = (await db_session.execute(
+        select(WorkflowExecution).where(WorkflowExecution.run_id == "run-broken")
+    )).scalars().one()
+    assert wf.status == "failed"
+    assert json.loads(wf.result)["error"] == "States.Runtime"
+    assert "Missing" in json.loads(wf.result)["cause"]
+
+@pytest.mark.asyncio
+async def test_inline_steps_beyond_limit_run_to_completion(db_session, monkeypatch):
+    """同步状态超过 MAX_INLINE_STEPS 时分批提交并继续推进, 不会停在中间的状态"""
+    monkeypatch.setattr(execution_engine, "MAX_INLINE_STEPS", 3)
+    states = {
+        f"P{i}": {"Type": "Pass", "Result": i, "ResultPath": f"$.p{i}", "Next": f"P{i + 1}"}
+        for i in range(1, 5)
+    }
+    states["P5"] = {"Type": "Pass", "Result": 5, "ResultPath": "$.p5", "End": True}
+    dsl_definition = json.dumps({"Version": "1.0", "Name": "LongFlow", "StartAt": "P1", "States": states})
+    db_session.add(WorkflowTemplate(template_id="tpl-long", name="Long", dsl_definition=dsl_definition))
+    db_session.add(WorkflowExecution(
+        run_id="run-long",
+        workflow_id="wf-long",
+        shard_id=1,
+        template_id="tpl-long",
+        status="running",
+        workflow_type="TestFlow",
+        input="{}",
+        start_time=datetime.now(UTC)
+    ))
+    await db_session.commit()
+
+    await advance_workflow(db_session, "run-long")
+
+    wf = (await db_session.execute(
+        select(WorkflowExecution).where(WorkflowExecution.run_id == "run-long")
+    )).scalars().one()
+    assert wf.status == "completed"
+    assert json.loads(wf.result) == {f"p{i}": i for i in range(1, 6)}
+
+@pytest.mark.asyncio
+async def test_failed_branch_cancels_nested_siblings_and_their_tasks(db_session):
+    """一个分支失败 => 其余分支、嵌套的子分支以及它们尚未结束的任务全部取消"""
+    branch = lambda activity: {"StartAt": "Call", "States": {"Call": {"Type": "Task", "ActivityType": activity, "End": True}}}
+    dsl_definition = json.dumps({
+        "Version": "1.0",
+        "Name": "CancelFlow",
+        "StartAt": "FanOut",
+        "States": {
+            "FanOut": {
+                "Type": "Parallel",
+                "Branches": [
+                    branch("doomed"),
+                    {"StartAt": "Inner", "States": {
+                        "Inner": {"Type": "Parallel", "Branches": [branch("innerA"), branch("innerB")], "End": True}
+                    }}
+                ],
+                "End": True
+            }
+        }
+    })
+    db_session.add(WorkflowTemplate(template_id="tpl-cancel", name="Cancel", dsl_definition=dsl_definition))
+    db_session.add(WorkflowExecution(
+        run_id="run-cancel",
+        workflow_id="wf-cancel",
+        shard_id=1,
+        template_id="tpl-cancel",
+        status="running",
+        workflow_type="TestFlow",
+        input="{}",
+        start_time=datetime.now(UTC)
+    ))
+    await db_session.commit()
+    await advance_workflow(db_session, "run-cancel")
+
+    tasks = (await db_session.execute(select(ActivityTask))).scalars().all()
+    by_type = {t.activity_type: t for t in tasks if t.activity_type in ("doomed", "innerA", "innerB")}
+    assert set(by_type) == {"doomed", "innerA", "innerB"}
+
+    by_type["doomed"].status = "failed"
+    by_type["doomed"].error = "boom"
+    await db_session.commit()
+    await advance_workflow(db_session, by_type["doomed"].run_id)
+
+    async with AsyncSessionLocal() as fresh:
+        parent = (await fresh.execute(
+            select(WorkflowExecution).where(WorkflowExecution.run_id == "run-cancel")
+        )).scalars().one()
+        assert parent.status == "failed"
+        for activity in ("innerA", "innerB"):
+            task = (await fresh.execute(
+                select(ActivityTask).where(ActivityTask.task_token == by_type[activity].task_token)
+            )).scalars().one()
+            assert task.status == "canceled"
+            grandchild = (await fresh.execute(
+                select(WorkflowExecution).where(WorkflowExecution.run_id == task.run_id)
+            )).scalars().one()
+            assert grandchild.status == "canceled"
+
+@pytest.mark.asyncio
+async def test_failed_map_item_cancels_in_flight_siblings(db_session):
+    """Map 的一个元素任务失败 => 已派发但尚未结束的其余元素任务被取消, 未派发的元素不再派发"""
+    dsl_definition = json.dumps({
+        "Version": "1.0",
+        "Name": "MapFailFlow",
+        "StartAt": "ForEach",
+        "States": {
+            "ForEach": {
+                "Type": "Map",
+                "ItemsPath": "$.items",
+                "MaxConcurrency": 3,
+                "Iterator": {"StartAt": "Work", "States": {"Work": {"Type": "Task", "ActivityType": "work", "End": True}}},
+                "End": True
+            }
+        }
+    })
+    db_session.add(WorkflowTemplate(template_id="tpl-map-fail", name="MapFail", dsl_definition=dsl_definition))
+    db_session.add(WorkflowExecution(
+        run_id="run-map-fail",
+        workflow_id="wf-map-fail",
+        shard_id=1,
+        template_id="tpl-map-fail",
+        status="running",
+        workflow_type="TestFlow",
+        input=json.dumps({"items": [1, 2, 3, 4, 5]}),
+        start_time=datetime.now(UTC)
+    ))
+    await db_session.commit()
+    await advance_workflow(db_session, "run-map-fail")
+
+    svc = ActivityTaskService(ActivityTaskRepository(db_session))
+    tasks = await svc.get_tasks_by_run_id("run-map-fail")
+    assert len(tasks) == 3
+    by_seq = {t.seq: t for t in tasks}
+    await advance_workflow(
+        db_session,
+        "run-map-fail",
+        prepare=lambda: svc.complete_task(by_seq[1].task_token, "{}", commit=False)
+    )
+    await advance_workflow(
+        db_session,
+        "run-map-fail",
+        prepare=lambda: svc.fail_task(by_seq[2].task_token, "boom", commit=False)
+    )
+
+    async with AsyncSessionLocal() as fresh:
+        wf = (await fresh.execute(
+            select(WorkflowExecution).where(WorkflowExecution.run_id == "run-map-fail")
+        )).scalars().one()
+        assert wf.status == "failed"
+        tasks = (await fresh.execute(
+            select(ActivityTask).where(ActivityTask.run_id == "run-map-fail").order_by(ActivityTask.seq)
+        )).scalars().all()
+    # 第一个元素完成后补派了第四个元素; 第二个失败后第三、四个被取消
+    assert [(t.seq, t.status) for t in tasks] == [(1, "completed"), (2, "failed"), (3, "canceled"), (4, "canceled")]
@@ -0,0 +1,52 @@
+import pytest
+
+from stepflow.domain.engine.path_utils import (
+    compile_path, get_value_by_path, set_value_by_path,
+    resolve_path_references, merge_with_path_references, compile_template, WILDCARD
+)
+
+DATA = {
+    "user": {"name": "ada", "tags": ["a", "b", "c"]},
+    "orders": [{"id": 1, "total": 5}, {"id": 2, "total": 7}, {"id": 3}],
+    "odd key": 1
+}
+
+def test_compile_path_segments():
+    assert compile_path("$.user.name") == ("user", "name")
+    assert compile_path("$.orders[0].id") == ("orders", 0, "id")
+    assert compile_path("$.orders[1:]") == ("orders", slice(1, None))
+    assert compile_path("$.orders[*].id") == ("orders", WILDCARD, "id")
+    assert compile_path("$['odd key']") == ("odd key",)
+    assert compile_path("$") == ()
+    assert compile_path("$.user.name") is compile_path("$.user.name")
+    with pytest.raises(ValueError):
+        compile_path("$.orders[x]")
+
+def test_get_indices_slices_and_wildcards():
+    assert get_value_by_path(DATA, "$.orders[-1].id") == 3
+    assert get_value_by_path(DATA, "$.user.tags[0:2]") == ["a", "b"]
+    # 投影时跳过不存在的字段
+    assert get_value_by_path(DATA, "$.orders[*].total") == [5, 7]
+    assert get_value_by_path(DATA, "$.user.*") == ["ada", ["a", "b", "c"]]
+    assert get_value_by_path(DATA, "$.orders[9].id") is None
+    assert get_value_by_path(DATA, "$.missing.path") is None
+
+def test_set_value_by_path():
+    data = {"orders": [{"id": 1}]}
+    set_value_by_path(data, "$.orders[0].status", "paid")
+    set_value_by_path(data, "$.meta.count", 1)
+    assert data == {"orders": [{"id": 1, "status": "paid"}], "meta": {"count": 1}}
+    with pytest.raises(ValueError):
+        set_value_by_path(data, "$.orders[*].id", 0)
+
+def test_templates_are_compiled_once():
+    assert resolve_path_references("Hi $.user.name, first order $.orders[0].id.", DATA) == "Hi ada, first order 1."
+    assert compile_template("x $.user.name") is compile_template("x $.user.name")
+    assert merge_with_path_references(
+        {"ids": "$.orders[*].id", "nested": [{"who": "$.user.name"}], "n": 3}, DATA
+    ) == {"ids": "[1, 2, 3]", "nested": [{"who": "ada"}], "n": 3}
+
+def test_hyphenated_keys_in_paths_and_templates():
+    data = {"order-id": 42}
+    assert get_value_by_path(data, "$.order-id") == 42
+    assert resolve_path_references("id=$.order-id", data) == "id=42"
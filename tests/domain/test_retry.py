@@ -0,0 +1,39 @@
+import pytest
+
+from stepflow.domain.dsl_model import RetryPolicy
+from stepflow.domain.engine import retry
+
+def test_backoff_grows_exponentially_without_jitter():
+    retrier = RetryPolicy(ErrorEquals=["States.ALL"], IntervalSeconds=2, BackoffRate=3.0, MaxAttempts=3)
+    assert [retry.retry_delay(retrier, n, jitter=0) for n in (1, 2, 3)] == [2, 6, 18]
+
+def test_jitter_stays_within_bounds():
+    retrier = RetryPolicy(ErrorEquals=["States.ALL"], IntervalSeconds=10, BackoffRate=1.0)
+    for _ in range(50):
+        assert 8 <= retry.retry_delay(retrier, 1, jitter=0.2) <= 12
+
+def test_first_matching_retrier_wins():
+    retriers = retry.compile_retriers([
+        {"ErrorEquals": ["Http.ServerError"], "IntervalSeconds": 1, "MaxAttempts": 5},
+        {"ErrorEquals": ["States.ALL"], "IntervalSeconds": 30, "MaxAttempts": 1},
+    ])
+    assert retry.match_retrier(retriers, "Http.ServerError").MaxAttempts == 5
+    assert retry.match_retrier(retriers, None).MaxAttempts == 1
+    assert retry.max_attempts(retriers) == 6
+
+def test_task_failed_matches_named_errors_only():
+    retriers = retry.compile_retriers([{"ErrorEquals": ["States.TaskFailed"]}])
+    assert retry.match_retrier(retriers, "Http.ConnectionError") is not None
+    assert retry.match_retrier(retriers, "States.Timeout") is None
+
+def test_next_retry_delay_stops_after_max_attempts(monkeypatch):
+    monkeypatch.setattr(retry, "RETRY_JITTER", 0)
+    policy = retry.dumps_retriers(retry.compile_retriers([{"ErrorEquals": ["States.ALL"], "MaxAttempts": 2}]))
+    assert retry.next_retry_delay(policy, 1) == 1
+    assert retry.next_retry_delay(policy, 2) == 2
+    assert retry.next_retry_delay(policy, 3) is None
+    assert retry.next_retry_delay(None, 1) is None
+
+def test_invalid_retry_definition_rejected():
+    with pytest.raises(ValueError):
+        retry.compile_retriers([{"IntervalSeconds": 1}])
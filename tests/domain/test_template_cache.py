@@ -0,0 +1,137 @@
+import pytest
+import pytest_asyncio
+import json
+
+from stepflow.infrastructure.database import Base, async_engine, AsyncSessionLocal
+from stepflow.infrastructure.models import WorkflowTemplate
+from stepflow.domain.engine.template_cache import TemplateCache, compile_workflow
+
+DSL = {
+    "Version": "1.0",
+    "Name": "CacheFlow",
+    "StartAt": "Check",
+    "States": {
+        "Check": {
+            "Type": "Choice",
+            "InputPath": "$.order",
+            "Choices": [{"Variable": "$.kind", "StringEquals": "vip", "Next": "Done"}],
+            "Default": "Done"
+        },
+        "Done": {"Type": "Succeed"}
+    }
+}
+
+@pytest_asyncio.fixture(scope="module", autouse=True)
+async def setup_database():
+    async with async_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    yield
+    async with async_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+
+@pytest_asyncio.fixture
+async def db_session(setup_database):
+    async with AsyncSessionLocal() as session:
+        yield session
+        await session.close()
+
+def test_compile_resolves_edges_and_paths():
+    compiled = compile_workflow("tpl-c", 1, json.dumps(DSL))
+    check = compiled.states["Check"]
+    assert check.input_path == ("order",)
+    assert check.choices[0].variable == ("kind",)
+    assert check.edges() == ["Done", "Done"]
+    assert compiled.states["Done"].type == "Succeed"
+
+def test_compile_rejects_undefined_target():
+    bad = dict(DSL, States={"Check": {"Type": "Pass", "Next": "Missing"}})
+    with pytest.raises(ValueError):
+        compile_workflow("tpl-c", 1, json.dumps(bad))
+
+def test_lru_eviction():
+    cache = TemplateCache(max_size=2)
+    for i in range(3):
+        cache.put(compile_workflow(f"tpl-{i}", 1, json.dumps(DSL)))
+    assert len(cache) == 2
+    assert cache.get("tpl-0", 1) is None
+    assert cache.get("tpl-2", 1) is not None
+
+@pytest.mark.asyncio
+async def test_load_is_keyed_by_version(db_session):
+    cache = TemplateCache()
+    tpl = WorkflowTemplate(template_id="tpl-cache", name="Cache", dsl_definition=json.dumps(DSL))
+    db_session.add(tpl)
+    await db_session.commit()
+
+    first = await cache.load(db_session, "tpl-cache")
+    second = await cache.load(db_session, "tpl-cache")
+    assert first is second
+    assert cache.hits == 1
+
+    # 版本递增 => 重新编译
+    tpl.dsl_definition = json.dumps(dict(DSL, StartAt="Done"))
+    tpl.version = tpl.version + 1
+    await db_session.commit()
+    third = await cache.load(db_session, "tpl-cache")
+    assert third is not first
+    assert third.start_at == "Done"
+
+    assert await cache.load(db_session, "does-not-exist") is None
+
+def test_compile_rejects_multi_task_iterator():
+    task = {"Type": "Task", "ActivityType": "a"}
+    bad = dict(DSL, StartAt="Each", States={
+        "Each": {
+            "Type": "Map",
+            "Iterator": {
+                "StartAt": "First",
+                "States": {"First": dict(task, Next="Second"), "Second": dict(task, End=True)}
+            },
+            "End": True
+        }
+    })
+    with pytest.raises(ValueError):
+        compile_workflow("tpl-c", 1, json.dumps(bad))
+
+def test_compile_checks_catch_targets():
+    dsl = {
+        "Version": "1.0",
+        "Name": "CatchFlow",
+        "StartAt": "Work",
+        "States": {
+            "Work": {
+                "Type": "Task",
+                "ActivityType": "a",
+                "Catch": [{"ErrorEquals": ["States.ALL"], "Next": "Missing"}],
+                "End": True
+            }
+        }
+    }
+    with pytest.raises(ValueError, match="Missing"):
+        compile_workflow("tpl-catch", 1, json.dumps(dsl))
+
+def test_wait_accepts_one_duration():
+    bad = dict(DSL, States={"Check": {"Type": "Wait", "Seconds": 5, "TimestampPath": "$.at", "End": True}})
+    with pytest.raises(ValueError, match="only one"):
+        compile_workflow("tpl-wait", 1, json.dumps(bad))
+
+@pytest.mark.asyncio
+async def test_recreated_template_is_recompiled(db_session):
+    """删除后以同一 template_id 重建 (version 重新从 1 开始): 没有收到 invalidate 的进程也会重新编译"""
+    cache = TemplateCache()
+    tpl = WorkflowTemplate(template_id="tpl-recreate", name="Recreate", dsl_definition=json.dumps(DSL))
+    db_session.add(tpl)
+    await db_session.commit()
+    first = await cache.load(db_session, "tpl-recreate")
+
+    await db_session.delete(tpl)
+    await db_session.commit()
+    db_session.add(WorkflowTemplate(
+        template_id="tpl-recreate", name="Recreate", dsl_definition=json.dumps(dict(DSL, StartAt="Done"))
+    ))
+    await db_session.commit()
+
+    second = await cache.load(db_session, "tpl-recreate")
+    assert second is not first
+    assert second.version == first.version == 1
+    assert second.start_at == "Done"
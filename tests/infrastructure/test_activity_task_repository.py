@@ -1,3 +1,4 @@
+import asyncio
 import pytest
 import pytest_asyncio
 from stepflow.infrastructure.database import Base, async_engine, AsyncSessionLocal
@@ -45,4 +46,52 @@ async def test_delete_task(db_session):
     assert deleted is True
 
     again = await repo.get_by_task_token("token-1")
-    assert again is None
\ No newline at end of file
+    assert again is None
+@pytest.mark.asyncio
+async def test_claim_scheduled_is_exclusive(setup_database):
+    async with AsyncSessionLocal() as db:
+        for i in range(5):
+            db.add(ActivityTask(
+                task_token=f"claim-{i}",
+                run_id="run-claim",
+                shard_id=0,
+                seq=i + 1,
+                activity_type="test_activity",
+                status="scheduled"
+            ))
+        await db.commit()
+
+    async def claim(worker_id):
+        async with AsyncSessionLocal() as db:
+            return await ActivityTaskRepository(db).claim_scheduled(worker_id, 3, 60)
+
+    first, second = await asyncio.gather(claim("w1"), claim("w2"))
+    tokens = [t.task_token for t in first] + [t.task_token for t in second]
+    # 每个任务恰好被认领一次
+    assert sorted(tokens) == [f"claim-{i}" for i in range(5)]
+    assert all(t.status == "running" and t.worker_id == "w1" and t.lease_expiry for t in first)
+
+    async with AsyncSessionLocal() as db:
+        assert await ActivityTaskRepository(db).claim_scheduled("w3", 3, 60) == []
+
+@pytest.mark.asyncio
+async def test_release_claimed_returns_tasks_to_queue(setup_database):
+    async with AsyncSessionLocal() as db:
+        db.add(ActivityTask(
+            task_token="release-1",
+            run_id="run-release",
+            shard_id=0,
+            seq=1,
+            activity_type="test_activity",
+            status="scheduled"
+        ))
+        await db.commit()
+        repo = ActivityTaskRepository(db)
+        claimed = await repo.claim_scheduled("w1", 1, 60)
+        assert [t.task_token for t in claimed] == ["release-1"]
+
+        # 其他 worker 不能交还不属于自己的任务
+        assert await repo.release_claimed("w2", ["release-1"]) == 0
+        assert await repo.release_claimed("w1", ["release-1"]) == 1
+        again = await repo.claim_scheduled("w2", 1, 60)
+        assert [t.worker_id for t in again] == ["w2"]
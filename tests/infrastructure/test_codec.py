@@ -0,0 +1,71 @@
+import pytest
+import pytest_asyncio
+from sqlalchemy import select
+
+from stepflow.infrastructure import codec
+from stepflow.infrastructure.database import Base, async_engine, AsyncSessionLocal
+from stepflow.infrastructure.models import WorkflowEvent, ActivityTask
+
+@pytest_asyncio.fixture(scope="module", autouse=True)
+async def setup_database():
+    async with async_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    yield
+    async with async_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+
+def test_backends_agree():
+    value = {"name": "测试", "items": [1, 2.5, None, True], "big": 2 ** 70}
+    for name in ("stdlib", "orjson", "msgspec"):
+        _, dumps, loads = codec._select_backend(name)
+        assert loads(dumps(value)) == value
+        with pytest.raises(codec.JSONDecodeError):
+            loads("{not json")
+
+def test_unknown_backend_falls_back_to_stdlib():
+    assert codec._select_backend("simdjson")[0] == "stdlib"
+
+def test_payload_compressed_only_above_threshold():
+    small = codec.dumps({"a": 1})
+    assert codec.encode_payload(small, threshold=1024) == (small, codec.PAYLOAD_JSON)
+
+    large = codec.dumps({"rows": [{"id": i, "status": "ok"} for i in range(200)]})
+    stored, version = codec.encode_payload(large, threshold=1024, method=codec.PAYLOAD_ZLIB)
+    assert version == codec.PAYLOAD_ZLIB
+    assert len(stored) < len(large)
+    assert codec.decode_payload(stored, version) == large
+    # 旧的明文行仍按原样读取
+    assert codec.decode_payload(large, codec.PAYLOAD_JSON) is large
+
+def test_payload_decoded_lazily_once(monkeypatch):
+    monkeypatch.setattr(codec, "PAYLOAD_COMPRESS_THRESHOLD", 256)
+    text = codec.dumps({"body": "y" * 4096})
+    stored, version = codec.encode_payload(text)
+
+    calls = []
+    real_decode = codec.decode_payload
+    monkeypatch.setattr(codec, "decode_payload", lambda *a: calls.append(a) or real_decode(*a))
+
+    task = ActivityTask(_input=stored, input_version=version)
+    assert calls == []
+    first = task.input
+    assert first == text
+    assert task.input is first
+    assert len(calls) == 1
+
+@pytest.mark.asyncio
+async def test_model_payload_roundtrip(monkeypatch):
+    monkeypatch.setattr(codec, "PAYLOAD_COMPRESS_THRESHOLD", 256)
+    attributes = codec.dumps({"body": "x" * 4096})
+
+    async with AsyncSessionLocal() as db:
+        evt = WorkflowEvent(run_id="codec-run", shard_id=0, event_id=1, event_type="Big", attributes=attributes)
+        db.add(evt)
+        await db.commit()
+
+    async with AsyncSessionLocal() as db:
+        loaded = (await db.execute(select(WorkflowEvent).where(WorkflowEvent.run_id == "codec-run"))).scalar_one()
+        assert loaded.attr_version == codec.compression
+        assert len(loaded._attributes) < 1024
+        assert loaded.attributes == attributes
+        assert loaded.attributes is loaded.attributes
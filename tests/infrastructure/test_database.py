@@ -0,0 +1,94 @@
+import sqlite3
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from stepflow.infrastructure import database
+from stepflow.infrastructure.database import (
+    async_engine, async_read_engine, sqlite_pragmas, normalize_database_url, sync_database_url
+)
+
+def test_profile_with_env_override(monkeypatch):
+    assert sqlite_pragmas("wal")["synchronous"] == "NORMAL"
+    assert sqlite_pragmas("off") == {}
+    monkeypatch.setenv("STEPFLOW_SQLITE_SYNCHRONOUS", "FULL")
+    assert sqlite_pragmas("wal")["synchronous"] == "FULL"
+    with pytest.raises(ValueError):
+        sqlite_pragmas("turbo")
+
+def test_memory_database_shares_one_connection():
+    write_engine, read_engine = database.create_engines("sqlite+aiosqlite:///:memory:")
+    assert write_engine is read_engine
+    assert write_engine.pool.__class__.__name__ == "StaticPool"
+
+@pytest.mark.asyncio
+async def test_pragmas_applied_on_connect():
+    async with async_engine.connect() as conn:
+        assert (await conn.execute(text("PRAGMA journal_mode"))).scalar() == "wal"
+        # NORMAL = 1
+        assert (await conn.execute(text("PRAGMA synchronous"))).scalar() == 1
+        assert (await conn.execute(text("PRAGMA busy_timeout"))).scalar() == 5000
+    assert async_engine.pool.size() == database.SQLITE_WRITE_POOL_SIZE
+
+@pytest.mark.asyncio
+async def test_write_transactions_take_the_write_lock_up_front(tmp_path):
+    """写引擎只有一个连接, 事务以 BEGIN IMMEDIATE 开始: 只读过的事务也已持有写锁, 其他连接必须排队"""
+    url = f"sqlite+aiosqlite:///{tmp_path / 'lock.db'}"
+    write_engine, read_engine = database.create_engines(url)
+    try:
+        assert write_engine.pool.size() == 1 and write_engine.pool._max_overflow == 0
+        async with write_engine.begin() as conn:
+            await conn.execute(text("CREATE TABLE probe (id INTEGER)"))
+        async with write_engine.connect() as conn:
+            await conn.execute(text("SELECT count(*) FROM probe"))
+            other = sqlite3.connect(tmp_path / "lock.db", timeout=0)
+            try:
+                with pytest.raises(sqlite3.OperationalError, match="locked"):
+                    other.execute("BEGIN IMMEDIATE")
+            finally:
+                other.close()
+            await conn.commit()
+    finally:
+        await write_engine.dispose()
+        await read_engine.dispose()
+
+@pytest.mark.asyncio
+async def test_read_engine_is_query_only():
+    async with async_read_engine.connect() as conn:
+        assert (await conn.execute(text("SELECT 1"))).scalar() == 1
+        with pytest.raises(OperationalError):
+            await conn.execute(text("CREATE TABLE read_only_probe (id INTEGER)"))
+
+def test_database_url_normalized_to_async_driver():
+    assert normalize_database_url("postgres://u:p@db/stepflow") == "postgresql+asyncpg://u:p@db/stepflow"
+    assert normalize_database_url("postgresql://u:p@db/stepflow") == "postgresql+asyncpg://u:p@db/stepflow"
+    assert normalize_database_url("sqlite:///stepflow.db") == "sqlite+aiosqlite:///stepflow.db"
+    assert normalize_database_url("postgresql+psycopg://db/x") == "postgresql+psycopg://db/x"
+    assert sync_database_url("sqlite+aiosqlite:///stepflow.db") == "sqlite:///stepflow.db"
+
+def test_postgres_engines_cache_statements(monkeypatch):
+    pytest.importorskip("asyncpg")
+    monkeypatch.setenv("DATABASE_READ_URL", "postgresql://u:p@replica/stepflow")
+    write_engine, read_engine = database.create_engines("postgresql+asyncpg://u:p@primary/stepflow")
+    assert write_engine.url.host == "primary"
+    assert write_engine.url.query["prepared_statement_cache_size"] == str(database.PG_STATEMENT_CACHE_SIZE)
+    assert read_engine.url.host == "replica"
+
+def test_alembic_accepts_driverless_database_url(tmp_path, monkeypatch):
+    # 与应用一样, 不带驱动的 DATABASE_URL 也能直接用于 alembic upgrade
+    from alembic import command
+    from alembic.config import Config
+
+    db_file = tmp_path / "migrated.db"
+    monkeypatch.setenv("DATABASE_URL", f"sqlite:///{db_file}")
+    config = Config("alembic.ini")
+    command.upgrade(config, "head")
+    assert config.get_main_option("sqlalchemy.url") == normalize_database_url(f"sqlite:///{db_file}")
+
+    conn = sqlite3.connect(db_file)
+    try:
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    finally:
+        conn.close()
+    assert "workflow_executions" in tables
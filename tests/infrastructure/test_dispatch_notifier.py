@@ -0,0 +1,31 @@
+import asyncio
+import pytest
+
+from stepflow.infrastructure.dispatch_notifier import DispatchNotifier, AdaptivePoller
+
+@pytest.mark.asyncio
+async def test_notify_wakes_waiter():
+    notifier = DispatchNotifier()
+    waiter = asyncio.create_task(notifier.wait("activity", 5))
+    await asyncio.sleep(0)
+    notifier.notify("activity")
+    assert await asyncio.wait_for(waiter, 1) is True
+
+@pytest.mark.asyncio
+async def test_notify_without_waiter_is_not_lost():
+    notifier = DispatchNotifier()
+    notifier.notify("activity")
+    assert await notifier.wait("activity", 5) is True
+    # 标记只消费一次
+    assert await notifier.wait("activity", 0.01) is False
+
+@pytest.mark.asyncio
+async def test_poller_backs_off_and_resets():
+    poller = AdaptivePoller(DispatchNotifier(), "activity", min_interval=0.01, max_interval=0.04)
+    await poller.wait(0, 10)
+    await poller.wait(0, 10)
+    await poller.wait(0, 10)
+    assert poller.interval == 0.04
+    # 满批不等待并重置间隔
+    await poller.wait(10, 10)
+    assert poller.interval == 0.01
@@ -0,0 +1,116 @@
+import asyncio
+from datetime import datetime, timedelta, UTC
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import event, select
+
+from stepflow.infrastructure.database import Base, async_engine, AsyncSessionLocal
+from stepflow.infrastructure.heartbeat_buffer import HeartbeatBuffer
+from stepflow.infrastructure.models import ActivityTask
+
+@pytest_asyncio.fixture(scope="module", autouse=True)
+async def setup_database():
+    async with async_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    yield
+    async with async_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+
+@pytest.mark.asyncio
+async def test_beats_coalesced_into_one_update():
+    async with AsyncSessionLocal() as db:
+        for i, status in enumerate(["running", "running", "completed"]):
+            db.add(ActivityTask(
+                task_token=f"beat-{i}", run_id="run-hb", seq=i, activity_type="a", status=status, worker_id="worker-a"
+            ))
+        await db.commit()
+
+    buffer = HeartbeatBuffer(AsyncSessionLocal)
+    start = datetime.now(UTC)
+    for n in range(5):
+        buffer.record("beat-0", "worker-a", start + timedelta(seconds=n), start + timedelta(seconds=60 + n), details=f"{n}" if n < 3 else None)
+    buffer.record("beat-1", "worker-a", start)
+    buffer.record("beat-2", "worker-a", start)
+    assert len(buffer) == 3
+
+    statements = []
+    def count_updates(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("UPDATE activity_tasks"):
+            statements.append(executemany)
+    event.listen(async_engine.sync_engine, "before_cursor_execute", count_updates)
+    try:
+        assert await buffer.flush() == 3
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", count_updates)
+    assert statements == [True]
+    assert len(buffer) == 0
+
+    async with AsyncSessionLocal() as db:
+        rows = {t.task_token: t for t in (await db.execute(
+            select(ActivityTask).where(ActivityTask.run_id == "run-hb")
+        )).scalars()}
+    assert rows["beat-0"].heartbeat_at.replace(tzinfo=UTC) == start + timedelta(seconds=4)
+    assert rows["beat-0"].lease_expiry.replace(tzinfo=UTC) == start + timedelta(seconds=64)
+    assert rows["beat-0"].heartbeat_details == "2"
+    assert rows["beat-1"].heartbeat_at is not None and rows["beat-1"].lease_expiry is None
+    # 已结束的任务不再续租
+    assert rows["beat-2"].heartbeat_at is None
+
+@pytest.mark.asyncio
+async def test_late_beat_does_not_renew_task_owned_by_another_worker():
+    async with AsyncSessionLocal() as db:
+        db.add(ActivityTask(task_token="beat-moved", run_id="run-hb-moved", seq=0, activity_type="a", status="running", worker_id="worker-b"))
+        db.add(ActivityTask(task_token="beat-api", run_id="run-hb-moved", seq=1, activity_type="a", status="running"))
+        await db.commit()
+
+    buffer = HeartbeatBuffer(AsyncSessionLocal)
+    now = datetime.now(UTC)
+    # 任务已被重新排队并由 worker-b 认领, worker-a 迟到的心跳不能为它续租
+    buffer.record("beat-moved", "worker-a", now, now + timedelta(seconds=60))
+    # 通过接口开始的任务没有 worker_id
+    buffer.record("beat-api", None, now, now + timedelta(seconds=60))
+    await buffer.flush()
+
+    async with AsyncSessionLocal() as db:
+        rows = {t.task_token: t for t in (await db.execute(
+            select(ActivityTask).where(ActivityTask.run_id == "run-hb-moved")
+        )).scalars()}
+    assert rows["beat-moved"].heartbeat_at is None and rows["beat-moved"].lease_expiry is None
+    assert rows["beat-api"].lease_expiry.replace(tzinfo=UTC) == now + timedelta(seconds=60)
+
+@pytest.mark.asyncio
+async def test_beat_flushed_at_once_when_lease_expires_within_interval():
+    now = datetime.now(UTC)
+    async with AsyncSessionLocal() as db:
+        # HeartbeatSeconds 小于写入间隔: 等到定时写入时租约早已到期
+        db.add(ActivityTask(task_token="beat-tight", run_id="run-hb-tight", seq=0, activity_type="a",
+                            status="running", worker_id="worker-a", lease_expiry=now + timedelta(seconds=2)))
+        db.add(ActivityTask(task_token="beat-loose", run_id="run-hb-tight", seq=1, activity_type="a",
+                            status="running", worker_id="worker-a", lease_expiry=now + timedelta(seconds=60)))
+        await db.commit()
+
+    buffer = HeartbeatBuffer(AsyncSessionLocal, flush_interval=5)
+    runner = asyncio.create_task(buffer.run())
+    await asyncio.sleep(0)
+    try:
+        assert not buffer.record("beat-loose", "worker-a", now, now + timedelta(seconds=60),
+                                 current_expiry=now + timedelta(seconds=60))
+        assert buffer.record("beat-tight", "worker-a", now, now + timedelta(seconds=2),
+                             current_expiry=now + timedelta(seconds=2))
+        for _ in range(100):
+            if not len(buffer):
+                break
+            await asyncio.sleep(0.01)
+        # 不等 5 秒的定时写入, 缓冲中的心跳 (包括顺带的 beat-loose) 立即写入
+        assert len(buffer) == 0
+        async with AsyncSessionLocal() as db:
+            tight = await db.get(ActivityTask, "beat-tight")
+        assert tight.heartbeat_at is not None
+
+        # 写入后的租约仍在一个写入间隔内 => 下一次心跳同样立即写入
+        assert buffer.record("beat-tight", "worker-a", now + timedelta(seconds=1), now + timedelta(seconds=3))
+        assert not buffer.record("beat-loose", "worker-a", now + timedelta(seconds=1), now + timedelta(seconds=61))
+    finally:
+        runner.cancel()
+        await asyncio.gather(runner, return_exceptions=True)
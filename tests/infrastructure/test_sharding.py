@@ -0,0 +1,22 @@
+from stepflow.infrastructure.sharding import shard_for, assign_shards
+
+def test_shard_for_is_stable_and_in_range():
+    shards = [shard_for(f"run-{i}", 8) for i in range(200)]
+    assert all(0 <= s < 8 for s in shards)
+    assert shards == [shard_for(f"run-{i}", 8) for i in range(200)]
+    # 200 个 run_id 应该覆盖全部分片
+    assert set(shards) == set(range(8))
+
+def test_assign_shards_covers_every_shard_once():
+    assignment = assign_shards(["w1", "w2", "w3"], 32)
+    owned = sorted(s for shards in assignment.values() for s in shards)
+    assert owned == list(range(32))
+    assert assign_shards([], 32) == {}
+
+def test_member_join_only_moves_its_own_shards():
+    before = assign_shards(["w1", "w2"], 64)
+    after = assign_shards(["w1", "w2", "w3"], 64)
+    # 新成员只从已有成员手中拿走分片, 已有成员之间不互换
+    for member in ("w1", "w2"):
+        assert set(after[member]) <= set(before[member])
+    assert after["w3"]
@@ -43,4 +43,19 @@ async def test_delete_visibility(db_session):
     assert deleted is True
 
     again = await repo.get_by_run_id("run-1")
-    assert again is None
\ No newline at end of file
+    assert again is None
+@pytest.mark.asyncio
+async def test_list_paginates_in_sql(db_session):
+    repo = WorkflowVisibilityRepository(db_session)
+    for i in range(5):
+        await repo.create(WorkflowVisibility(
+            run_id=f"page-{i}",
+            workflow_id=f"wf-page-{i}",
+            workflow_type="PagedFlow",
+            status="paged"
+        ))
+
+    page = await repo.list_by_status("paged", offset=1, limit=2)
+    assert [v.run_id for v in page] == ["page-1", "page-2"]
+    by_type = await repo.list_by_workflow_type("PagedFlow", offset=4)
+    assert [v.run_id for v in by_type] == ["page-4"]
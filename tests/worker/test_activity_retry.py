@@ -0,0 +1,117 @@
+import json
+from datetime import datetime, UTC
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import select
+
+from stepflow.domain.engine import retry
+from stepflow.domain.engine.execution_engine import advance_workflow
+from stepflow.infrastructure.database import Base, async_engine, AsyncSessionLocal
+from stepflow.infrastructure.models import WorkflowTemplate, WorkflowExecution, ActivityTask, Timer
+from stepflow.infrastructure.repositories.activity_task_repository import ActivityTaskRepository
+from stepflow.worker.activity_worker import finish_activity_task
+from stepflow.worker.timer_worker import fire_due_timers
+from stepflow.interfaces.api.activity_endpoints import fail_task
+from stepflow.interfaces.api.schemas import FailRequest
+
+@pytest_asyncio.fixture(scope="module", autouse=True)
+async def setup_database():
+    async with async_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    yield
+    async with async_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+
+async def start_run(run_id: str, retry_defs):
+    dsl = json.dumps({
+        "Version": "1.0",
+        "Name": "RetryFlow",
+        "StartAt": "Call",
+        "States": {"Call": {"Type": "Task", "ActivityType": "http", "Retry": retry_defs, "End": True}}
+    })
+    async with AsyncSessionLocal() as db:
+        db.add(WorkflowTemplate(template_id=f"tpl-{run_id}", name="Retry", dsl_definition=dsl))
+        db.add(WorkflowExecution(
+            run_id=run_id,
+            workflow_id=f"wf-{run_id}",
+            shard_id=0,
+            template_id=f"tpl-{run_id}",
+            status="running",
+            workflow_type="RetryFlow",
+            input="{}",
+            start_time=datetime.now(UTC)
+        ))
+        await db.commit()
+        await advance_workflow(db, run_id)
+    return await claim(run_id)
+
+async def claim(run_id: str):
+    """模拟 worker 认领该工作流的任务"""
+    async with AsyncSessionLocal() as db:
+        claimed = await ActivityTaskRepository(db).claim_scheduled("worker-test", 100, 300)
+        return next(t for t in claimed if t.run_id == run_id)
+
+async def load(run_id: str):
+    async with AsyncSessionLocal() as db:
+        task = (await db.execute(select(ActivityTask).where(ActivityTask.run_id == run_id))).scalars().one()
+        wf_exec = (await db.execute(select(WorkflowExecution).where(WorkflowExecution.run_id == run_id))).scalars().one()
+        timers = (await db.execute(select(Timer).where(Timer.run_id == run_id))).scalars().all()
+        return task, wf_exec, timers
+
+@pytest.mark.asyncio
+async def test_failed_task_rescheduled_by_retry_timer(monkeypatch):
+    monkeypatch.setattr(retry, "RETRY_JITTER", 0)
+    task = await start_run("run-retry", [{"ErrorEquals": ["Http.ServerError"], "IntervalSeconds": 5, "MaxAttempts": 1}])
+    assert task.max_attempts == 2
+    memo_before = (await load("run-retry"))[1].memo
+
+    await finish_activity_task(task, error="HTTP 503", error_type="Http.ServerError")
+    task, wf_exec, timers = await load("run-retry")
+    assert task.status == "retrying" and task.error == "HTTP 503"
+    assert wf_exec.status == "running" and wf_exec.memo == memo_before
+    assert [(t.timer_type, t.task_token, t.status) for t in timers] == [("activity_retry", task.task_token, "scheduled")]
+    delay = (timers[0].fire_at - task.completed_at).total_seconds()
+    assert 4.5 < delay < 5.5
+
+    async with AsyncSessionLocal() as db:
+        timer = (await db.execute(select(Timer).where(Timer.run_id == "run-retry"))).scalars().one()
+    assert [t.timer_id for t in await fire_due_timers([timer])] == [timer.timer_id]
+    task, wf_exec, timers = await load("run-retry")
+    assert task.status == "scheduled" and task.attempt == 2
+    assert timers[0].status == "fired"
+    task = await claim("run-retry")
+
+    # 重试次数用完 => 工作流失败
+    await finish_activity_task(task, error="HTTP 503", error_type="Http.ServerError")
+    task, wf_exec, _ = await load("run-retry")
+    assert task.status == "failed"
+    assert wf_exec.status == "failed"
+
+@pytest.mark.asyncio
+async def test_unmatched_error_fails_immediately():
+    task = await start_run("run-no-retry", [{"ErrorEquals": ["Http.ServerError"], "MaxAttempts": 3}])
+    await finish_activity_task(task, error="HTTP 404", error_type="Http.ClientError")
+    task, wf_exec, timers = await load("run-no-retry")
+    assert task.status == "failed" and wf_exec.status == "failed"
+    assert timers == []
+
+@pytest.mark.asyncio
+async def test_fail_endpoint_uses_retry_policy(monkeypatch):
+    monkeypatch.setattr(retry, "RETRY_JITTER", 0)
+    task = await start_run("run-api-retry", [{"ErrorEquals": ["Http.ServerError"], "IntervalSeconds": 5, "MaxAttempts": 1}])
+
+    # 外部 worker 通过 REST 接口上报失败, 与 worker 内部上报一样先按 Retry 策略重试
+    req = FailRequest(reason="HTTP 503", error_type="Http.ServerError")
+    async with AsyncSessionLocal() as db:
+        await fail_task(task.task_token, req, db=db)
+    task, wf_exec, timers = await load("run-api-retry")
+    assert task.status == "retrying" and wf_exec.status == "running"
+    assert [(t.timer_type, t.status) for t in timers] == [("activity_retry", "scheduled")]
+
+    assert len(await fire_due_timers(timers)) == 1
+    await claim("run-api-retry")
+    async with AsyncSessionLocal() as db:
+        await fail_task(task.task_token, req, db=db)
+    task, wf_exec, _ = await load("run-api-retry")
+    assert task.status == "failed" and wf_exec.status == "failed"
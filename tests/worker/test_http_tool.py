@@ -0,0 +1,102 @@
+import os
+import time
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from stepflow.worker.tools import http_tool
+from stepflow.worker.tools.http_tool import HttpTool, sweep_spill_dir
+
+@pytest.mark.asyncio
+async def test_sessions_are_shared_per_options():
+    tool = HttpTool()
+    first = tool._get_session(True, None, None)
+    assert tool._get_session(True, None, None) is first
+    assert tool._get_session(False, None, None) is not first
+    assert tool._get_session(True, None, "login") is not first
+
+    await tool.close()
+    assert first.closed
+
+@pytest.mark.asyncio
+async def test_requests_reuse_connection():
+    async def hello(request):
+        return web.json_response({"peer": request.transport.get_extra_info("peername")[1]})
+
+    app = web.Application()
+    app.router.add_get("/hello", hello)
+    async with TestServer(app) as server:
+        tool = HttpTool()
+        url = str(server.make_url("/hello"))
+        first = await tool.execute({"url": url})
+        second = await tool.execute({"url": url})
+        await tool.close()
+
+    assert first["ok"] and second["ok"]
+    # keep-alive: 两次请求来自同一个客户端端口
+    assert first["json"]["peer"] == second["json"]["peer"]
+
+@pytest.mark.asyncio
+async def test_size_cap_and_result_selector(tmp_path, monkeypatch):
+    monkeypatch.setattr("stepflow.worker.tools.http_tool.HTTP_SPILL_DIR", str(tmp_path))
+
+    async def big(request):
+        return web.Response(text="x" * 5000)
+
+    async def data(request):
+        return web.json_response({"data": {"items": [1, 2, 3]}, "noise": "y" * 100})
+
+    app = web.Application()
+    app.router.add_get("/big", big)
+    app.router.add_get("/data", data)
+    async with TestServer(app) as server:
+        tool = HttpTool()
+        spilled = await tool.execute({"url": str(server.make_url("/big")), "max_response_bytes": 1000})
+        truncated = await tool.execute({
+            "url": str(server.make_url("/big")), "max_response_bytes": 1000, "on_oversize": "truncate"
+        })
+        rejected = await tool.execute({
+            "url": str(server.make_url("/big")), "max_response_bytes": 1000, "on_oversize": "error"
+        })
+        selected = await tool.execute({"url": str(server.make_url("/data")), "result_selector": "$.data.items"})
+        await tool.close()
+
+    assert "body" not in spilled and spilled["body_ref"]["size"] == 5000
+    with open(spilled["body_ref"]["path"]) as f:
+        assert f.read() == "x" * 5000
+    assert truncated["truncated"] and len(truncated["body"]) == 1000
+    assert rejected["ok"] is False and "error" in rejected
+    assert selected["json"] == [1, 2, 3]
+    assert "text" not in selected
+
+@pytest.mark.asyncio
+async def test_raise_for_status_reports_error_type():
+    async def unavailable(request):
+        return web.Response(status=503, text="busy")
+
+    app = web.Application()
+    app.router.add_get("/busy", unavailable)
+    async with TestServer(app) as server:
+        tool = HttpTool()
+        url = str(server.make_url("/busy"))
+        lenient = await tool.execute({"url": url})
+        strict = await tool.execute({"url": url, "raise_for_status": True})
+        await tool.close()
+
+    assert lenient["ok"] is False and "error" not in lenient
+    assert strict["error"] == "HTTP 503" and strict["error_type"] == "Http.ServerError"
+
+def test_sweep_removes_expired_spill_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(http_tool, "HTTP_SPILL_DIR", str(tmp_path))
+    old = tmp_path / "old.body"
+    fresh = tmp_path / "fresh.body"
+    other = tmp_path / "keep.txt"
+    for path in (old, fresh, other):
+        path.write_text("x")
+    past = time.time() - 7200
+    os.utime(old, (past, past))
+    os.utime(other, (past, past))
+
+    assert sweep_spill_dir(max_age=3600) == 1
+    assert not old.exists() and fresh.exists() and other.exists()
@@ -0,0 +1,107 @@
+import json
+from datetime import datetime, timedelta, UTC
+
+import pytest
+import pytest_asyncio
+
+from stepflow.infrastructure.database import Base, async_engine, AsyncSessionLocal
+from stepflow.infrastructure.models import WorkflowTemplate, WorkflowExecution, ActivityTask, Timer
+from stepflow.infrastructure.repositories.activity_task_repository import ActivityTaskRepository
+from stepflow.worker.shard_manager import ShardManager
+
+@pytest_asyncio.fixture(scope="module", autouse=True)
+async def setup_database():
+    async with async_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    yield
+    async with async_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+
+@pytest.mark.asyncio
+async def test_members_split_and_take_over_shards():
+    now = datetime.now(UTC)
+    a = ShardManager("member-a", num_shards=8, lease_seconds=30)
+    b = ShardManager("member-b", num_shards=8, lease_seconds=30)
+
+    # a 先启动 => 持有全部分片
+    assert await a.rebalance(now) == frozenset(range(8))
+    # b 加入时 a 还没交出分片 => b 暂时拿不到
+    assert await b.rebalance(now) == frozenset()
+    # a 续期时交出属于 b 的分片, b 下一次续期时获取
+    owned_a = await a.rebalance(now)
+    owned_b = await b.rebalance(now)
+    assert owned_a and owned_b
+    assert owned_a | owned_b == frozenset(range(8)) and not owned_a & owned_b
+
+    # a 正常退出 => b 接手全部分片
+    await a.leave()
+    assert await b.rebalance(now) == frozenset(range(8))
+    assert a.owned_shards(now) == frozenset()
+
+    # b 没有按时续期 => 不再认为自己持有分片, 其他成员在租约到期后可以接管
+    late = now + timedelta(seconds=31)
+    assert b.owned_shards(late) == frozenset()
+    c = ShardManager("member-c", num_shards=8, lease_seconds=30)
+    assert await c.rebalance(late) == frozenset(range(8))
+    await c.leave()
+
+@pytest.mark.asyncio
+async def test_claim_only_owned_shards():
+    async with AsyncSessionLocal() as db:
+        db.add(WorkflowTemplate(template_id="tpl-shard", name="Shard", dsl_definition=json.dumps({})))
+        for shard_id in (0, 1):
+            run_id = f"run-shard-{shard_id}"
+            db.add(WorkflowExecution(
+                run_id=run_id,
+                workflow_id=f"wf-{run_id}",
+                shard_id=shard_id,
+                template_id="tpl-shard",
+                status="running",
+                workflow_type="ShardFlow",
+                start_time=datetime.now(UTC)
+            ))
+            db.add(ActivityTask(
+                task_token=f"task-shard-{shard_id}",
+                run_id=run_id,
+                shard_id=shard_id,
+                activity_type="noop",
+                status="scheduled"
+            ))
+        await db.commit()
+
+    async with AsyncSessionLocal() as db:
+        repo = ActivityTaskRepository(db)
+        assert await repo.claim_scheduled("worker-none", 10, 300, frozenset()) == []
+        claimed = await repo.claim_scheduled("worker-1", 10, 300, frozenset({1}))
+        assert [t.task_token for t in claimed] == ["task-shard-1"]
+        claimed = await repo.claim_scheduled("worker-0", 10, 300)
+        assert [t.task_token for t in claimed] == ["task-shard-0"]
+
+@pytest.mark.asyncio
+async def test_refuses_to_start_with_work_on_dropped_shards():
+    # 分片数从 8 调小到 4 时, shard 5 上还没触发的定时器不会再分配给任何成员
+    async with AsyncSessionLocal() as db:
+        db.add(WorkflowTemplate(template_id="tpl-shrink", name="Shrink", dsl_definition=json.dumps({})))
+        db.add(WorkflowExecution(
+            run_id="run-shrink",
+            workflow_id="wf-run-shrink",
+            shard_id=1,
+            template_id="tpl-shrink",
+            status="running",
+            workflow_type="ShrinkFlow",
+            start_time=datetime.now(UTC)
+        ))
+        db.add(Timer(timer_id="timer-shrink", run_id="run-shrink", shard_id=5,
+                     fire_at=datetime.now(UTC), status="scheduled"))
+        await db.commit()
+
+    with pytest.raises(RuntimeError, match="shard 5"):
+        await ShardManager("member-shrink", num_shards=4).check_shard_ids()
+    await ShardManager("member-shrink", num_shards=8).check_shard_ids()
+
+    # 定时器触发后旧分片上没有未结束的工作, 可以调小
+    async with AsyncSessionLocal() as db:
+        timer = await db.get(Timer, "timer-shrink")
+        timer.status = "fired"
+        await db.commit()
+    await ShardManager("member-shrink", num_shards=4).check_shard_ids()
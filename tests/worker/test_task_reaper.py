@@ -0,0 +1,128 @@
+import json
+from datetime import datetime, timedelta, UTC
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import select
+
+from stepflow.domain.engine.execution_engine import advance_workflow
+from stepflow.infrastructure.database import Base, async_engine, AsyncSessionLocal
+from stepflow.infrastructure.models import WorkflowTemplate, WorkflowExecution, ActivityTask
+from stepflow.infrastructure.repositories.activity_task_repository import ActivityTaskRepository
+from stepflow.worker.activity_worker import finish_activity_task
+from stepflow.worker.task_reaper import reap_expired_tasks
+
+@pytest_asyncio.fixture(scope="module", autouse=True)
+async def setup_database():
+    async with async_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    yield
+    async with async_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+
+async def start_and_claim(run_id: str, task_def: dict) -> ActivityTask:
+    dsl = json.dumps({
+        "Version": "1.0",
+        "Name": "ReaperFlow",
+        "StartAt": "Work",
+        "States": {
+            "Work": dict({"Type": "Task", "ActivityType": "slow", "Next": "Done"}, **task_def),
+            "Fallback": {"Type": "Pass", "Result": "late", "ResultPath": "$.mode", "End": True},
+            "Done": {"Type": "Succeed"}
+        }
+    })
+    async with AsyncSessionLocal() as db:
+        db.add(WorkflowTemplate(template_id=f"tpl-{run_id}", name="Reaper", dsl_definition=dsl))
+        db.add(WorkflowExecution(
+            run_id=run_id,
+            workflow_id=f"wf-{run_id}",
+            shard_id=0,
+            template_id=f"tpl-{run_id}",
+            status="running",
+            workflow_type="ReaperFlow",
+            input="{}",
+            start_time=datetime.now(UTC)
+        ))
+        await db.commit()
+        await advance_workflow(db, run_id)
+    async with AsyncSessionLocal() as db:
+        claimed = await ActivityTaskRepository(db).claim_scheduled("worker-a", 100, 300)
+        return next(t for t in claimed if t.run_id == run_id)
+
+async def load(run_id: str):
+    async with AsyncSessionLocal() as db:
+        task = (await db.execute(select(ActivityTask).where(ActivityTask.run_id == run_id))).scalars().one()
+        wf_exec = (await db.execute(select(WorkflowExecution).where(WorkflowExecution.run_id == run_id))).scalars().one()
+        return task, wf_exec
+
+@pytest.mark.asyncio
+async def test_claim_lease_capped_by_timeouts():
+    task = await start_and_claim("run-lease", {"TimeoutSeconds": 30, "HeartbeatSeconds": 10})
+    lease = task.lease_expiry.replace(tzinfo=UTC) - task.started_at.replace(tzinfo=UTC)
+    assert lease == timedelta(seconds=10)
+    assert task.timeout_seconds == 30 and task.heartbeat_seconds == 10
+
+@pytest.mark.asyncio
+async def test_lost_worker_task_is_requeued():
+    task = await start_and_claim("run-lost", {"Retry": [{"ErrorEquals": ["States.ALL"], "MaxAttempts": 1}]})
+    scanned = await reap_expired_tasks("reaper-test", now=datetime.now(UTC) + timedelta(seconds=301))
+    assert scanned >= 1
+    task, wf_exec = await load("run-lost")
+    assert task.status == "scheduled" and task.worker_id is None
+    # 重新排队计为一次新的执行
+    assert task.attempt == 2
+    assert wf_exec.status == "running"
+
+@pytest.mark.asyncio
+async def test_task_that_keeps_losing_its_worker_fails_into_catch():
+    """反复让 worker 失联的任务在执行次数用完后按失败处理, 经过 Catch 而不是无限重新排队"""
+    await start_and_claim("run-crashy", {
+        "Retry": [{"ErrorEquals": ["States.TaskFailed"], "MaxAttempts": 1}],
+        "Catch": [{"ErrorEquals": ["States.ALL"], "Next": "Fallback", "ResultPath": "$.error"}]
+    })
+    await reap_expired_tasks("reaper-test", now=datetime.now(UTC) + timedelta(seconds=301))
+    async with AsyncSessionLocal() as db:
+        claimed = await ActivityTaskRepository(db).claim_scheduled("worker-a", 100, 300)
+    assert any(t.run_id == "run-crashy" for t in claimed)
+
+    await reap_expired_tasks("reaper-test", now=datetime.now(UTC) + timedelta(seconds=301))
+    task, wf_exec = await load("run-crashy")
+    assert task.status == "failed" and task.attempt == 2
+    assert task.error_type == "States.TaskFailed"
+    assert wf_exec.status == "completed"
+    assert json.loads(wf_exec.result)["error"]["Error"] == "States.TaskFailed"
+
+@pytest.mark.asyncio
+async def test_timed_out_task_fails_into_catch():
+    task = await start_and_claim("run-timeout", {
+        "TimeoutSeconds": 5,
+        "Catch": [{"ErrorEquals": ["States.Timeout"], "Next": "Fallback", "ResultPath": "$.error"}]
+    })
+    await reap_expired_tasks("reaper-test", now=datetime.now(UTC) + timedelta(seconds=6))
+    reaped, wf_exec = await load("run-timeout")
+    assert reaped.status == "failed" and reaped.error_type == "States.Timeout"
+    assert wf_exec.status == "completed"
+    assert json.loads(wf_exec.result)["error"]["Error"] == "States.Timeout"
+
+    # 原 worker 之后才上报结果: 任务已被接管, 结果被丢弃
+    await finish_activity_task(task, result_data='{"late": true}')
+    reaped, _ = await load("run-timeout")
+    assert reaped.status == "failed" and reaped.result is None
+
+@pytest.mark.asyncio
+async def test_stale_owner_cannot_overwrite_reclaimed_task():
+    stale = await start_and_claim("run-reclaimed", {"Retry": [{"ErrorEquals": ["States.ALL"], "MaxAttempts": 1}]})
+    await reap_expired_tasks("reaper-test", now=datetime.now(UTC) + timedelta(seconds=301))
+    async with AsyncSessionLocal() as db:
+        claimed = await ActivityTaskRepository(db).claim_scheduled("worker-b", 100, 300)
+        current = next(t for t in claimed if t.run_id == "run-reclaimed")
+
+    # 任务重新处于 running, 但已由 worker-b 持有: 原 worker 的结果被条件 UPDATE 拒绝
+    await finish_activity_task(stale, error="lost connection")
+    task, wf_exec = await load("run-reclaimed")
+    assert task.status == "running" and task.worker_id == "worker-b"
+    assert wf_exec.status == "running"
+
+    await finish_activity_task(current, result_data='{"ok": true}')
+    task, wf_exec = await load("run-reclaimed")
+    assert task.status == "completed" and wf_exec.status == "completed"
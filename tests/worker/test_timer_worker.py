@@ -0,0 +1,141 @@
+import json
+from datetime import datetime, timedelta, UTC
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import select
+
+from stepflow.infrastructure.database import Base, async_engine, AsyncSessionLocal
+from stepflow.domain.engine.execution_engine import advance_workflow
+from stepflow.infrastructure.models import Timer, WorkflowTemplate, WorkflowExecution
+from stepflow.worker.timer_worker import TimerWindow, fire_due_timers
+
+@pytest_asyncio.fixture(scope="module", autouse=True)
+async def setup_database():
+    async with async_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    yield
+    async with async_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+
+def make_timer(timer_id: str, fire_at: datetime, status: str = "scheduled") -> Timer:
+    return Timer(
+        timer_id=timer_id,
+        run_id="run-window",
+        shard_id=0,
+        fire_at=fire_at,
+        status=status,
+        timer_type="activity_retry",
+        task_token=f"task-{timer_id}",
+    )
+
+def test_window_pops_due_timers_in_order():
+    now = datetime.now(UTC)
+    window = TimerWindow(window_seconds=60, limit=10)
+    window.load([
+        make_timer("t3", now + timedelta(seconds=30)),
+        make_timer("t1", now - timedelta(seconds=2)),
+        make_timer("t2", now - timedelta(seconds=1)),
+    ], now)
+
+    assert window.horizon == now + timedelta(seconds=60)
+    assert [t.timer_id for t in window.pop_due(now)] == ["t1", "t2"]
+    assert window.next_deadline() == now + timedelta(seconds=30)
+    assert len(window) == 1
+    assert 0 < window.sleep_seconds(now) <= 30
+
+def test_full_window_stops_at_last_loaded_timer():
+    now = datetime.now(UTC)
+    window = TimerWindow(window_seconds=60, limit=2)
+    window.load([make_timer("a", now + timedelta(seconds=1)), make_timer("b", now + timedelta(seconds=3))], now)
+
+    assert window.horizon == now + timedelta(seconds=3)
+    assert not window.stale(now)
+    assert window.stale(now + timedelta(seconds=3))
+    window.invalidate()
+    assert window.stale(now)
+
+@pytest.mark.asyncio
+async def test_fire_due_timers_skips_already_handled():
+    now = datetime.now(UTC)
+    async with AsyncSessionLocal() as db:
+        db.add_all([
+            make_timer("f1", now - timedelta(seconds=1)),
+            make_timer("f2", now - timedelta(seconds=1)),
+            make_timer("f3", now - timedelta(seconds=1), status="canceled"),
+        ])
+        await db.commit()
+
+    window = TimerWindow()
+    await window.refill(now)
+    assert sorted(t.timer_id for t in window.pop_due(now)) == ["f1", "f2"]
+
+    async with AsyncSessionLocal() as db:
+        timers = (await db.execute(select(Timer).where(Timer.timer_id.in_(["f1", "f2", "f3"])))).scalars().all()
+    fired = await fire_due_timers(list(timers))
+    assert sorted(t.timer_id for t in fired) == ["f1", "f2"]
+    # 再次触发同一批定时器不会重复处理
+    assert await fire_due_timers(list(timers)) == []
+
+async def start_wait_run(run_id: str, wait_def: dict, input_data: dict = None) -> WorkflowExecution:
+    dsl = json.dumps({
+        "Version": "1.0",
+        "Name": "WaitFlow",
+        "StartAt": "Pause",
+        "States": {
+            "Pause": dict({"Type": "Wait", "Next": "Done"}, **wait_def),
+            "Done": {"Type": "Pass", "Result": "woke", "ResultPath": "$.status", "End": True}
+        }
+    })
+    async with AsyncSessionLocal() as db:
+        db.add(WorkflowTemplate(template_id=f"tpl-{run_id}", name="Wait", dsl_definition=dsl))
+        db.add(WorkflowExecution(
+            run_id=run_id,
+            workflow_id=f"wf-{run_id}",
+            shard_id=0,
+            template_id=f"tpl-{run_id}",
+            status="running",
+            workflow_type="WaitFlow",
+            input=json.dumps(input_data or {}),
+            start_time=datetime.now(UTC)
+        ))
+        await db.commit()
+        await advance_workflow(db, run_id)
+        return (await db.execute(select(WorkflowExecution).where(WorkflowExecution.run_id == run_id))).scalars().one()
+
+async def load_timers(run_id: str):
+    async with AsyncSessionLocal() as db:
+        return (await db.execute(select(Timer).where(Timer.run_id == run_id))).scalars().all()
+
+@pytest.mark.asyncio
+async def test_wait_parks_until_timer_fires():
+    wf_exec = await start_wait_run("run-wait", {"SecondsPath": "$.delay"}, {"delay": 30})
+    assert wf_exec.status == "running" and wf_exec.current_state_name == "Pause"
+    timers = await load_timers("run-wait")
+    assert [(t.timer_type, t.status) for t in timers] == [("workflow", "scheduled")]
+
+    # 定时器未触发前再次推进 => 继续等待
+    async with AsyncSessionLocal() as db:
+        await advance_workflow(db, "run-wait")
+        wf_exec = (await db.execute(select(WorkflowExecution).where(WorkflowExecution.run_id == "run-wait"))).scalars().one()
+        assert wf_exec.current_state_name == "Pause" and wf_exec.status == "running"
+
+    assert [t.timer_id for t in await fire_due_timers(timers)] == [timers[0].timer_id]
+    async with AsyncSessionLocal() as db:
+        wf_exec = (await db.execute(select(WorkflowExecution).where(WorkflowExecution.run_id == "run-wait"))).scalars().one()
+    assert wf_exec.status == "completed"
+    assert json.loads(wf_exec.result) == {"delay": 30, "status": "woke"}
+    assert (await load_timers("run-wait"))[0].status == "fired"
+
+@pytest.mark.asyncio
+async def test_wait_with_past_timestamp_continues_inline():
+    past = (datetime.now(UTC) - timedelta(minutes=1)).isoformat()
+    wf_exec = await start_wait_run("run-wait-past", {"Timestamp": past})
+    assert wf_exec.status == "completed"
+    assert await load_timers("run-wait-past") == []
+
+@pytest.mark.asyncio
+async def test_wait_with_invalid_seconds_fails():
+    wf_exec = await start_wait_run("run-wait-bad", {"SecondsPath": "$.delay"}, {"delay": "soon"})
+    assert wf_exec.status == "failed"
+    assert await load_timers("run-wait-bad") == []